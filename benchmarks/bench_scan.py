@@ -0,0 +1,355 @@
+"""
+Offline benchmarks of the scan and decision hot path, fed with synthetic
+GraphQL pages. Reports the throughput and the peak memory of each step,
+the memory kept by the scanned projects per 10k projects, and compares
+them with the committed baseline.
+
+    python -m benchmarks.bench_scan                     # 1k and 10k projects
+    python -m benchmarks.bench_scan --sizes 100000
+    python -m benchmarks.bench_scan --check             # fail on regressions
+    python -m benchmarks.bench_scan --save              # update the baseline
+"""
+
+import argparse
+import gc
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List
+
+os.environ.setdefault("ENV", "test")
+
+from benchmarks.generators import generate_pages  # noqa: E402
+from gitlab2sentry import Gitlab2Sentry  # noqa: E402
+from gitlab2sentry.resources import settings  # noqa: E402
+from gitlab2sentry.utils import (  # noqa: E402
+    JSON_BACKEND_ORJSON,
+    STREAM_CHUNK_SIZE,
+    JSONArrayStream,
+    JSONCodec,
+)
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+DEFAULT_SIZES = [1000, 10000]
+DEFAULT_TOLERANCE = 0.3
+
+
+class FakeGitlabProvider:
+    def create_sentryclirc_mr(self, g2s_project) -> bool:
+        return True
+
+    def create_dsn_mr(self, g2s_project, dsn, project_slug) -> bool:
+        return True
+
+
+class FakeSentryProvider:
+    def ensure_sentry_team(self, team_name) -> bool:
+        return True
+
+    def get_cached_dsn(self, project_slug) -> None:
+        return None
+
+    def get_or_create_project(self, group_name, project_name, project_slug):
+        return {"slug": project_slug}
+
+    def set_rate_limit_for_key(self, project_slug) -> str:
+        return settings.sentry_dsn
+
+
+def get_g2s() -> Gitlab2Sentry:
+    g2s = Gitlab2Sentry()
+    g2s.gitlab_provider = FakeGitlabProvider()  # type: ignore
+    g2s.sentry_provider = FakeSentryProvider()  # type: ignore
+    return g2s
+
+
+class BodyCache:
+    """
+    GraphQL response bodies of the pages, encoded once per page set and
+    before any measure.
+    """
+
+    def __init__(self) -> None:
+        self.pages: List[List[Dict[str, Any]]] = list()
+        self.bodies: List[bytes] = list()
+
+    def get(self, pages: List[List[Dict[str, Any]]]) -> List[bytes]:
+        if pages is not self.pages:
+            self.pages = pages
+            self.bodies = [
+                json.dumps(
+                    {
+                        "data": {
+                            "projects": {
+                                "pageInfo": {
+                                    "endCursor": "cursor",
+                                    "hasNextPage": True,
+                                },
+                                "edges": page,
+                            }
+                        }
+                    }
+                ).encode()
+                for page in pages
+            ]
+        return self.bodies
+
+
+body_cache = BodyCache()
+
+
+def iter_nodes(pages: List[List[Dict[str, Any]]]):
+    for page in pages:
+        for edge in page:
+            yield edge["node"]
+
+
+def bench_get_g2s_project(g2s: Gitlab2Sentry, pages) -> int:
+    count = 0
+    for node in iter_nodes(pages):
+        g2s._get_g2s_project(node)
+        count += 1
+    return count
+
+
+def bench_get_mr_states(g2s: Gitlab2Sentry, pages) -> int:
+    count = 0
+    for node in iter_nodes(pages):
+        g2s._get_mr_states(
+            node["sentryclircMergeRequests"]["nodes"]
+            + node["dsnMergeRequests"]["nodes"]
+        )
+        count += 1
+    return count
+
+
+def bench_get_sentryclirc_file(g2s: Gitlab2Sentry, pages) -> int:
+    count = 0
+    for node in iter_nodes(pages):
+        if node.get("repository"):
+            g2s._get_sentryclirc_file(node["repository"]["blobs"]["nodes"])
+            count += 1
+    return count
+
+
+def bench_get_gitlab_groups(g2s: Gitlab2Sentry, pages) -> int:
+    g2s._iter_paginated_projects = lambda: iter(pages)  # type: ignore
+    groups = g2s._get_gitlab_groups()
+    return sum(len(projects) for projects in groups.values())
+
+
+def bench_decode_page(g2s: Gitlab2Sentry, pages) -> int:
+    count = 0
+    for body in body_cache.get(pages):
+        for edge in json.loads(body)["data"]["projects"]["edges"]:
+            g2s._get_g2s_project(edge["node"])
+            count += 1
+    return count
+
+
+def bench_decode_page_orjson(g2s: Gitlab2Sentry, pages) -> int:
+    codec = JSONCodec(JSON_BACKEND_ORJSON)
+    count = 0
+    for body in body_cache.get(pages):
+        for edge in codec.loads(body)["data"]["projects"]["edges"]:
+            g2s._get_g2s_project(edge["node"])
+            count += 1
+    return count
+
+
+def bench_stream_page(g2s: Gitlab2Sentry, pages) -> int:
+    count = 0
+    for body in body_cache.get(pages):
+        chunks = (
+            memoryview(body)[start:][:STREAM_CHUNK_SIZE].tobytes()
+            for start in range(0, len(body), STREAM_CHUNK_SIZE)
+        )
+        for edge in JSONArrayStream(chunks, ("data", "projects", "edges")):
+            g2s._get_g2s_project(edge["node"])
+            count += 1
+    return count
+
+
+def bench_handle_g2s_project(g2s: Gitlab2Sentry, pages) -> int:
+    count = 0
+    for node in iter_nodes(pages):
+        g2s_project = g2s._get_g2s_project(node)
+        if g2s_project:
+            g2s._handle_g2s_project(g2s_project, g2s_project.group)
+            count += 1
+    return count
+
+
+BENCHMARKS: Dict[str, Callable[[Gitlab2Sentry, Any], int]] = {
+    "get_g2s_project": bench_get_g2s_project,
+    "get_mr_states": bench_get_mr_states,
+    "get_sentryclirc_file": bench_get_sentryclirc_file,
+    "get_gitlab_groups": bench_get_gitlab_groups,
+    "decode_page": bench_decode_page,
+    "decode_page_orjson": bench_decode_page_orjson,
+    "stream_page": bench_stream_page,
+    "handle_g2s_project": bench_handle_g2s_project,
+}
+
+
+if JSONCodec(JSON_BACKEND_ORJSON).backend != JSON_BACKEND_ORJSON:
+    # orjson is optional, nothing to compare without it
+    del BENCHMARKS["decode_page_orjson"]
+
+
+def run_benchmark(
+    name: str, pages: List[List[Dict[str, Any]]], repeat: int
+) -> Dict[str, float]:
+    bench = BENCHMARKS[name]
+    best = None
+    for _ in range(repeat):
+        g2s = get_g2s()
+        start_time = time.perf_counter()
+        count = bench(g2s, pages)
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+
+    # Separate pass: tracemalloc slows down the code it traces
+    g2s = get_g2s()
+    gc.collect()
+    tracemalloc.start()
+    bench(g2s, pages)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "items": count,
+        "seconds": round(best, 4),  # type: ignore
+        "items_per_second": round(count / best, 1) if best else 0.0,
+        "peak_mib": round(peak / 1024 / 1024, 3),
+    }
+
+
+def measure_projects_memory(pages: List[List[Dict[str, Any]]]) -> float:
+    """
+    MiB kept by the G2SProjects of a scan (the pages are already
+    allocated and not counted), per 10k projects.
+    """
+    g2s = get_g2s()
+    g2s._iter_paginated_projects = lambda: iter(pages)  # type: ignore
+    tracemalloc.start()
+    groups = g2s._get_gitlab_groups()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    count = sum(len(projects) for projects in groups.values())
+    return round(current / count * 10000 / 1024 / 1024, 3) if count else 0.0
+
+
+def run(sizes: List[int], repeat: int) -> Dict[str, Dict[str, Dict[str, float]]]:
+    results: Dict[str, Dict[str, Dict[str, float]]] = dict()
+    for size in sizes:
+        pages = list(generate_pages(size))
+        body_cache.get(pages)
+        results[str(size)] = {
+            name: run_benchmark(name, pages, repeat) for name in BENCHMARKS
+        }
+        results[str(size)]["get_gitlab_groups"]["retained_mib_per_10k"] = (
+            measure_projects_memory(pages)
+        )
+        del pages
+    return results
+
+
+def print_results(results, baseline) -> None:
+    print(
+        "{:>8} {:<22} {:>14} {:>10} {:>10} {:>10}".format(
+            "projects", "benchmark", "items/s", "peak MiB", "MiB/10k", "vs base"
+        )
+    )
+    for size, benches in results.items():
+        for name, result in benches.items():
+            base = baseline.get(size, {}).get(name)
+            ratio = (
+                "{:.2f}x".format(result["items_per_second"] / base["items_per_second"])
+                if base and base["items_per_second"]
+                else "-"
+            )
+            print(
+                "{:>8} {:<22} {:>14} {:>10} {:>10} {:>10}".format(
+                    size,
+                    name,
+                    result["items_per_second"],
+                    result["peak_mib"],
+                    result.get("retained_mib_per_10k", "-"),
+                    ratio,
+                )
+            )
+
+
+def get_regressions(results, baseline, tolerance: float) -> List[str]:
+    regressions = list()
+    for size, benches in results.items():
+        for name, result in benches.items():
+            base = baseline.get(size, {}).get(name)
+            if not base:
+                continue
+            if result["items_per_second"] < base["items_per_second"] * (1 - tolerance):
+                regressions.append(
+                    "{} ({} projects): {} items/s < baseline {}".format(
+                        name, size, result["items_per_second"], base["items_per_second"]
+                    )
+                )
+            if result["peak_mib"] > base["peak_mib"] * (1 + tolerance) + 0.1:
+                regressions.append(
+                    "{} ({} projects): {} MiB > baseline {}".format(
+                        name, size, result["peak_mib"], base["peak_mib"]
+                    )
+                )
+            retained = result.get("retained_mib_per_10k")
+            base_retained = base.get("retained_mib_per_10k")
+            if (
+                retained
+                and base_retained
+                and retained > base_retained * (1 + tolerance)
+            ):
+                regressions.append(
+                    "{} ({} projects): {} MiB per 10k projects > baseline {}".format(
+                        name, size, retained, base_retained
+                    )
+                )
+    return regressions
+
+
+def load_baseline() -> Dict[str, Any]:
+    if not os.path.exists(BASELINE_PATH):
+        return dict()
+    with open(BASELINE_PATH) as baseline_file:
+        return json.load(baseline_file)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", nargs="+", type=int, default=DEFAULT_SIZES)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--check", action="store_true")
+    parser.add_argument("--save", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    baseline = load_baseline()
+    results = run(args.sizes, args.repeat)
+    print_results(results, baseline)
+
+    if args.save:
+        baseline.update(results)
+        with open(BASELINE_PATH, "w") as baseline_file:
+            json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write("\n")
+    if args.check:
+        regressions = get_regressions(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION {}".format(regression))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
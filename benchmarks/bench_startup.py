@@ -0,0 +1,160 @@
+"""
+Startup benchmarks: the time to import gitlab2sentry, to build
+Gitlab2Sentry() and to get the first page of projects from the GitLab
+stub server, each measured in a fresh interpreter (median of the runs),
+with and without GITLAB_GRAPHQL_STREAMING. Also lists the heavy modules
+imported before the first request, which should wait for the code paths
+needing them.
+
+    python -m benchmarks.bench_startup
+    python -m benchmarks.bench_startup --runs 10 --check     # fail over budget
+"""
+
+import argparse
+import json
+import logging
+import os
+import socket
+import statistics
+import subprocess
+import sys
+from typing import Any, Dict, List
+
+# Seconds, generous enough for a loaded CI runner
+STARTUP_BUDGETS = {"import": 1.0, "init": 0.05, "first_request": 0.5}
+LAZY_MODULES = ["gitlab", "slugify"]
+MODES = {"buffered": "false", "streaming": "true"}
+
+CHILD = """
+import json, sys, time
+
+start = time.perf_counter()
+import gitlab2sentry
+from gitlab2sentry.resources import GRAPHQL_LIST_PROJECTS_QUERY
+
+imported = time.perf_counter()
+g2s = gitlab2sentry.Gitlab2Sentry()
+built = time.perf_counter()
+modules = set(sys.modules)
+list(next(g2s.gitlab_provider.get_all_projects(GRAPHQL_LIST_PROJECTS_QUERY)))
+fetched = time.perf_counter()
+print(json.dumps({
+    "import": imported - start,
+    "init": built - imported,
+    "first_request": fetched - built,
+    "modules": sorted(module for module in modules if "." not in module),
+}))
+"""
+
+
+def _get_free_port(host: str) -> int:
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def get_env(host: str, gitlab_port: int, sentry_port: int) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update(
+        {
+            "ENV": "bench",
+            "GITLAB_URL": "http://{}:{}".format(host, gitlab_port),
+            "GITLAB_TOKEN": "stub-token",
+            "GITLAB_GRAPHQL_SUFFIX": "api/graphql",
+            "SENTRY_URL": "http://{}:{}".format(host, sentry_port),
+            "SENTRY_TOKEN": "stub-token",
+            "SENTRY_ORG_SLUG": "stub",
+            "PYTHONPATH": os.pathsep.join(
+                filter(None, [os.getcwd(), env.get("PYTHONPATH")])
+            ),
+        }
+    )
+    return env
+
+
+def measure(env: Dict[str, str], runs: int) -> Dict[str, Any]:
+    samples: List[Dict[str, Any]] = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", CHILD],
+            env=env,
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout
+        samples.append(json.loads(output.splitlines()[-1]))
+    result: Dict[str, Any] = {
+        step: round(statistics.median(sample[step] for sample in samples), 4)
+        for step in STARTUP_BUDGETS
+    }
+    result["lazy_modules_imported"] = sorted(
+        set(LAZY_MODULES).intersection(samples[-1]["modules"])
+    )
+    return result
+
+
+def get_regressions(results: Dict[str, Dict[str, Any]]) -> List[str]:
+    regressions = []
+    for mode, result in results.items():
+        for step, budget in STARTUP_BUDGETS.items():
+            if result[step] > budget:
+                regressions.append(
+                    "{} {}: {}s > {}s".format(mode, step, result[step], budget)
+                )
+        if result["lazy_modules_imported"]:
+            regressions.append(
+                "{}: imported {} before the first request".format(
+                    mode, ", ".join(result["lazy_modules_imported"])
+                )
+            )
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--check", action="store_true")
+    args = parser.parse_args()
+
+    from benchmarks.stub_server import FaultInjector, StubState, start_servers
+
+    host = "127.0.0.1"
+    gitlab_port, sentry_port = _get_free_port(host), _get_free_port(host)
+    servers = start_servers(
+        StubState(100), FaultInjector(0, 0, 0, 0), host, gitlab_port, sentry_port
+    )
+    logging.disable(logging.WARNING)
+
+    results = dict()
+    print(
+        "{:<10} {:>10} {:>10} {:>14}  {}".format(
+            "mode", "import", "init", "first_request", "lazy modules imported"
+        )
+    )
+    for mode, streaming in MODES.items():
+        env = get_env(host, gitlab_port, sentry_port)
+        env["GITLAB_GRAPHQL_STREAMING"] = streaming
+        results[mode] = measure(env, args.runs)
+        lazy_modules = results[mode]["lazy_modules_imported"]
+        print(
+            "{:<10} {:>9}s {:>9}s {:>13}s  {}".format(
+                mode,
+                results[mode]["import"],
+                results[mode]["init"],
+                results[mode]["first_request"],
+                ", ".join(lazy_modules) or "-",
+            )
+        )
+    for server in servers:
+        server.shutdown()
+
+    if args.check:
+        regressions = get_regressions(results)
+        for regression in regressions:
+            print("REGRESSION {}".format(regression))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,113 @@
+"""
+Synthetic GitLab GraphQL payloads shaped like the answers to
+GRAPHQL_LIST_PROJECTS_QUERY, used by the benchmarks and the stub servers.
+"""
+
+import random
+from datetime import datetime, timedelta
+from typing import Any, Dict, Generator, List
+
+from gitlab2sentry.resources import settings
+
+MR_STATES = ["opened", "closed", "merged"]
+GROUP_COUNT = 50
+
+
+def _get_mr_nodes(
+    rand: random.Random, project_name: str, index: int
+) -> List[Dict[str, Any]]:
+    # Mostly nothing, sometimes a long history of closed duplicates (oldest
+    # first) of which the queries only get the latest MR of each branch
+    history = rand.choice([0, 0, 0, 1, 1, 2, 5, 20])
+    nodes = list()
+    for mr_index in range(history):
+        is_dsn = rand.random() < 0.3
+        nodes.append(
+            {
+                "id": "gid://gitlab/MergeRequest/{}{:03d}".format(index, mr_index),
+                "title": (
+                    settings.dsn_mr_title if is_dsn else settings.sentryclirc_mr_title
+                ).format(project_name=project_name),
+                "sourceBranch": (
+                    settings.dsn_branch_name
+                    if is_dsn
+                    else settings.sentryclirc_branch_name
+                ),
+                "state": rand.choice(MR_STATES),
+            }
+        )
+    return nodes
+
+
+def get_latest_mr(
+    mr_nodes: List[Dict[str, Any]], branch_name: str
+) -> Dict[str, List[Dict[str, Any]]]:
+    # Answer of mergeRequests(sourceBranches: [branch_name] sort: CREATED_DESC
+    # first: 1)
+    for mr in reversed(mr_nodes):
+        if mr["sourceBranch"] == branch_name:
+            return {"nodes": [{"sourceBranch": branch_name, "state": mr["state"]}]}
+    return {"nodes": []}
+
+
+def _get_blob_nodes(rand: random.Random) -> List[Dict[str, Any]]:
+    kind = rand.choice(["none", "none", "sentryclirc", "dsn", "large"])
+    if kind == "none":
+        return []
+    content = settings.sentryclirc_mr_content.format(sentry_url=settings.sentry_url)
+    if kind == "dsn":
+        content = settings.dsn_mr_content.format(
+            sentry_url=settings.sentry_url,
+            dsn=settings.sentry_dsn,
+            project_slug="project",
+        )
+    elif kind == "large":
+        # Hand written .sentryclirc with lots of unrelated settings
+        content += "\n".join("option_{} = {}".format(i, "x" * 64) for i in range(200))
+    return [{"name": settings.sentryclirc_filepath, "rawTextBlob": content}]
+
+
+def generate_project_node(
+    index: int, created_at: datetime, rand: random.Random
+) -> Dict[str, Any]:
+    group_name = "{}group-{}".format(
+        settings.gitlab_group_identifier, index % GROUP_COUNT
+    )
+    project_name = "project-{}".format(index)
+    node: Dict[str, Any] = {
+        "id": "gid://gitlab/Project/{}".format(index + 1),
+        "fullPath": "{}/{}".format(group_name, project_name),
+        "name": project_name,
+        "createdAt": created_at.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "mergeRequestsEnabled": rand.random() > 0.05,
+        "group": {"name": group_name} if rand.random() > 0.05 else None,
+    }
+    mr_nodes = _get_mr_nodes(rand, project_name, index)
+    node["sentryclircMergeRequests"] = get_latest_mr(
+        mr_nodes, settings.sentryclirc_branch_name
+    )
+    node["dsnMergeRequests"] = get_latest_mr(mr_nodes, settings.dsn_branch_name)
+    if rand.random() > 0.03:
+        node["repository"] = {"blobs": {"nodes": _get_blob_nodes(rand)}}
+    else:
+        node["repository"] = None
+    return {"cursor": "cursor-{}".format(index), "node": node}
+
+
+def generate_pages(
+    project_count: int, page_length: int = 100, seed: int = 0
+) -> Generator[List[Dict[str, Any]], None, None]:
+    """
+    Yields pages of edges sorted by creation date (newest first), as
+    get_all_projects does. All the projects are inside the creation limit.
+    """
+    rand = random.Random(seed)
+    now = datetime.utcnow()
+    step = timedelta(
+        seconds=(settings.gitlab_project_creation_limit or 30) * 86400 / project_count
+    )
+    for page_start in range(0, project_count, page_length):
+        yield [
+            generate_project_node(index, now - step * index, rand)
+            for index in range(page_start, min(page_start + page_length, project_count))
+        ]
@@ -0,0 +1,136 @@
+"""
+End-to-end load test: runs Gitlab2Sentry.update() against the local stub
+servers and reports the run duration, the run stats and the API calls by
+endpoint.
+
+    python -m benchmarks.load_test --projects 10000
+    python -m benchmarks.load_test --latency 0.05 --throttle-rate 0.02 --runs 2
+    python -m benchmarks.load_test --latency 0.05 --async-concurrency 50
+"""
+
+import argparse
+import logging
+import os
+import socket
+import sys
+import time
+
+
+def _get_free_port(host: str) -> int:
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def _configure(
+    host: str,
+    gitlab_port: int,
+    sentry_port: int,
+    page_length: int,
+    async_concurrency: int,
+) -> None:
+    # Settings are read when gitlab2sentry is imported: this runs first
+    os.environ.update(
+        {
+            "ENV": "loadtest",
+            "GITLAB_URL": "http://{}:{}".format(host, gitlab_port),
+            "GITLAB_TOKEN": "stub-token",
+            "GITLAB_GRAPHQL_SUFFIX": "api/graphql",
+            "GITLAB_GRAPHQL_PAGE_LENGTH": str(page_length),
+            "SENTRY_URL": "http://{}:{}".format(host, sentry_port),
+            "SENTRY_TOKEN": "stub-token",
+            "SENTRY_ORG_SLUG": "stub",
+            "ASYNC_CONCURRENCY": str(async_concurrency),
+        }
+    )
+    os.environ.setdefault("RETRY_MAX_WAIT", "2")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--projects", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--page-length", type=int, default=100)
+    parser.add_argument("--runs", type=int, default=1)
+    parser.add_argument(
+        "--async-concurrency",
+        type=int,
+        default=0,
+        help="run the asyncio engine with this many concurrent projects",
+    )
+    parser.add_argument(
+        "--max-calls-per-mr",
+        type=float,
+        default=0,
+        help="fail when a run needs more API calls per created MR",
+    )
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    host = "127.0.0.1"
+    gitlab_port, sentry_port = _get_free_port(host), _get_free_port(host)
+    _configure(host, gitlab_port, sentry_port, args.page_length, args.async_concurrency)
+
+    from benchmarks.stub_server import FaultInjector, StubState, start_servers
+    from gitlab2sentry import AsyncGitlab2Sentry, Gitlab2Sentry
+    from gitlab2sentry.utils import call_accounting
+
+    state = StubState(args.projects, args.seed)
+    faults = FaultInjector(
+        args.latency, args.jitter, args.error_rate, args.throttle_rate, args.seed
+    )
+    gitlab_server, sentry_server = start_servers(
+        state, faults, host, gitlab_port, sentry_port
+    )
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+
+    failed = False
+    for run in range(1, args.runs + 1):
+        state.calls.clear()
+        start_time = time.monotonic()
+        g2s = AsyncGitlab2Sentry() if args.async_concurrency else Gitlab2Sentry()
+        g2s.update()
+        elapsed = time.monotonic() - start_time
+        calls = sum(state.calls.values())
+        print(
+            "run {}: {} projects in {}s - {} API calls ({}/s)".format(
+                run,
+                args.projects,
+                round(elapsed, 2),
+                calls,
+                round(calls / elapsed, 1) if elapsed else 0,
+            )
+        )
+        print("  stats: {}".format(dict(g2s.run_stats)))
+        for endpoint, count in state.calls.most_common():
+            print("  {:>8} {}".format(count, endpoint))
+        report = call_accounting.get_report(
+            g2s.run_stats["mr_sentryclirc_created"] + g2s.run_stats["mr_dsn_created"]
+        )
+        print(
+            "  calls by phase: {} - per project: {} - per MR: {}".format(
+                report["calls_by_phase"],
+                report["calls_per_project"],
+                report["calls_per_mr"],
+            )
+        )
+        if args.max_calls_per_mr and report["calls_per_mr"] > args.max_calls_per_mr:
+            print(
+                "REGRESSION {} API calls per MR > {}".format(
+                    report["calls_per_mr"], args.max_calls_per_mr
+                )
+            )
+            failed = True
+
+    gitlab_server.shutdown()
+    sentry_server.shutdown()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,597 @@
+"""
+Local stand-in for the GitLab (GraphQL + REST) and Sentry APIs used by
+gitlab2sentry, serving synthetic projects with configurable latency,
+error rate and 429 throttling.
+
+    python -m benchmarks.stub_server --projects 10000 --latency 0.02 \\
+        --throttle-rate 0.01 --error-rate 0.01
+
+GitLab answers on http://127.0.0.1:8081 (GraphQL at /api/graphql), Sentry on
+http://127.0.0.1:8082. Writes (branches, files, MRs, Sentry teams/projects)
+are kept in memory so that a second run sees the MRs opened by the first.
+REST GETs carry an ETag and answer 304 to a matching If-None-Match.
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlparse
+
+from graphql import build_schema, graphql_sync
+
+from benchmarks.generators import generate_pages
+
+GRAPHQL_SCHEMA = """
+scalar Time
+
+enum MergeRequestSort {
+    CREATED_ASC
+    CREATED_DESC
+}
+
+enum ProjectArchived {
+    EXCLUDE
+    INCLUDE
+    ONLY
+}
+
+type Query {
+    projects(
+        first: Int
+        after: String
+        searchNamespaces: Boolean
+        sort: String
+        ids: [ID!]
+        archived: ProjectArchived
+        withMergeRequestsEnabled: Boolean
+        notAimedForDeletion: Boolean
+    ): ProjectConnection
+    project(fullPath: ID!): Project
+}
+
+type PageInfo {
+    endCursor: String
+    hasNextPage: Boolean!
+}
+
+type ProjectConnection {
+    count: Int!
+    edges: [ProjectEdge]
+    nodes: [Project]
+    pageInfo: PageInfo!
+}
+
+type ProjectEdge {
+    cursor: String!
+    node: Project
+}
+
+type Group {
+    name: String!
+}
+
+type Project {
+    id: ID!
+    fullPath: ID!
+    name: String!
+    createdAt: Time
+    mergeRequestsEnabled: Boolean
+    archived: Boolean
+    group: Group
+    repository: Repository
+    mergeRequests(
+        sourceBranches: [String!]
+        first: Int
+        sort: MergeRequestSort
+        state: String
+    ): MergeRequestConnection
+}
+
+type Repository {
+    empty: Boolean
+    blobs(paths: [String!]!): RepositoryBlobConnection
+}
+
+type RepositoryBlobConnection {
+    nodes: [RepositoryBlob]
+}
+
+type RepositoryBlob {
+    name: String
+    rawTextBlob: String
+}
+
+type MergeRequestConnection {
+    nodes: [MergeRequest]
+}
+
+type MergeRequest {
+    id: ID!
+    title: String!
+    state: String!
+    sourceBranch: String
+    createdAt: Time
+}
+"""
+
+
+class StubState:
+    """
+    Projects, branches, files and Sentry objects shared by the stub
+    servers. Projects are generated newest first, like the GraphQL
+    listing sorted by createdAt_desc.
+    """
+
+    def __init__(self, project_count: int, seed: int = 0) -> None:
+        self.lock = threading.Lock()
+        self.projects: List[Dict[str, Any]] = [
+            edge["node"]
+            for page in generate_pages(project_count, seed=seed)
+            for edge in page
+        ]
+        for node in self.projects:
+            # MRs of both branches, oldest first like the ones opened later
+            node["mergeRequests"] = {
+                "nodes": node.pop("sentryclircMergeRequests")["nodes"]
+                + node.pop("dsnMergeRequests")["nodes"]
+            }
+        self.by_pid = {int(node["id"].split("/")[-1]): node for node in self.projects}
+        self.by_path = {node["fullPath"]: node for node in self.projects}
+        self.branches: Dict[int, set] = {pid: set() for pid in self.by_pid}
+        self.sentry_teams: set = set()
+        self.sentry_projects: Dict[str, Dict[str, Any]] = dict()
+        self.calls: Counter = Counter()
+        self.mr_count = 0
+
+    def count(self, endpoint: str) -> None:
+        with self.lock:
+            self.calls[endpoint] += 1
+
+
+class FaultInjector:
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        throttle_rate: float = 0.0,
+        seed: int = 0,
+    ) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def draw(self) -> Tuple[float, Optional[int]]:
+        with self._lock:
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            roll = self._random.random()
+        if roll < self.throttle_rate:
+            return delay, 429
+        if roll < self.throttle_rate + self.error_rate:
+            return delay, 503
+        return delay, None
+
+
+def _get_graphql_schema(state: StubState):
+    schema = build_schema(GRAPHQL_SCHEMA)
+
+    def resolve_projects(
+        _,
+        info,
+        first=100,
+        after=None,
+        ids=None,
+        archived=None,
+        withMergeRequestsEnabled=None,
+        **kwargs
+    ):
+        projects = state.projects
+        if ids:
+            wanted = {str(gid) for gid in ids}
+            projects = [node for node in projects if node["id"] in wanted]
+        if archived in ("EXCLUDE", "ONLY"):
+            projects = [
+                node
+                for node in projects
+                if bool(node.get("archived")) == (archived == "ONLY")
+            ]
+        if withMergeRequestsEnabled:
+            projects = [node for node in projects if node["mergeRequestsEnabled"]]
+        start = int(after.split("-")[-1]) + 1 if after else 0
+        end = start + (first or 100)
+        page = projects[start:end]
+        edges = [
+            {"cursor": "cursor-{}".format(start + index), "node": node}
+            for index, node in enumerate(page)
+        ]
+        return {
+            "count": len(projects),
+            "edges": edges,
+            "nodes": page,
+            "pageInfo": {
+                "endCursor": edges[-1]["cursor"] if edges else None,
+                "hasNextPage": start + len(page) < len(projects),
+            },
+        }
+
+    def resolve_project(_, info, fullPath):
+        return state.by_path.get(fullPath)
+
+    def resolve_blobs(repository, info, paths):
+        return {
+            "nodes": [
+                blob for blob in repository["blobs"]["nodes"] if blob["name"] in paths
+            ]
+        }
+
+    def resolve_repository_empty(repository, info):
+        return not repository["blobs"]["nodes"]
+
+    def resolve_merge_requests(
+        project, info, sourceBranches=None, first=None, sort=None, state=None
+    ):
+        nodes = project["mergeRequests"]["nodes"]
+        if sourceBranches:
+            nodes = [
+                node
+                for node in nodes
+                if node.get("sourceBranch") is None
+                or node["sourceBranch"] in sourceBranches
+            ]
+        if state:
+            nodes = [node for node in nodes if node["state"] == state]
+        if sort == "CREATED_DESC":
+            nodes = list(reversed(nodes))
+        return {"nodes": nodes[:first] if first else nodes}
+
+    schema.query_type.fields["projects"].resolve = resolve_projects
+    schema.query_type.fields["project"].resolve = resolve_project
+    schema.get_type("Repository").fields["blobs"].resolve = resolve_blobs
+    schema.get_type("Repository").fields["empty"].resolve = resolve_repository_empty
+    schema.get_type("Project").fields["mergeRequests"].resolve = resolve_merge_requests
+    return schema
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately: avoid delayed ACK stalls
+    disable_nagle_algorithm = True
+    state: StubState
+    faults: FaultInjector
+    schema: Any
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logging.debug(format, *args)
+
+    def _send(
+        self,
+        status: int,
+        body: Any = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> None:
+        payload = b"" if body is None else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _send_cacheable(self, body: Any) -> None:
+        etag = '"{}"'.format(
+            hashlib.sha1(json.dumps(body, sort_keys=True).encode()).hexdigest()
+        )
+        if self.headers.get("If-None-Match") == etag:
+            self.state.count("GET not modified")
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self._send(200, body, {"ETag": etag})
+
+    def _read_body(self) -> Any:
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        if not raw:
+            return dict()
+        if "json" in (self.headers.get("Content-Type") or ""):
+            return json.loads(raw)
+        return {key: values[0] for key, values in parse_qs(raw.decode()).items()}
+
+    def _inject_faults(self) -> bool:
+        delay, status = self.faults.draw()
+        if delay:
+            time.sleep(delay)
+        if status == 429:
+            reset = int(time.time()) + 1
+            self._send(
+                429,
+                {"message": "Too Many Requests"},
+                {
+                    "Retry-After": "1",
+                    "RateLimit-Reset": str(reset),
+                    "X-Sentry-Rate-Limit-Reset": str(reset),
+                },
+            )
+            return True
+        if status:
+            self._send(status, {"message": "Service Unavailable"})
+            return True
+        return False
+
+    def _handle(self, method: str) -> None:
+        parsed = urlparse(self.path)
+        body = self._read_body() if method in ("POST", "PUT") else dict()
+        if self._inject_faults():
+            self.state.count("{} throttled/errors".format(method))
+            return
+        for pattern, route_method, handler in ROUTES:
+            match = re.fullmatch(pattern, parsed.path)
+            if match and route_method == method:
+                self.state.count("{} {}".format(method, pattern))
+                status, result = handler(self, *map(unquote, match.groups()), body)
+                if method == "GET" and status == 200:
+                    self._send_cacheable(result)
+                else:
+                    self._send(status, result)
+                return
+        self.state.count("{} unknown".format(method))
+        self._send(404, {"message": "404 Not Found"})
+
+    def do_GET(self) -> None:
+        self._handle("GET")
+
+    def do_POST(self) -> None:
+        self._handle("POST")
+
+    def do_PUT(self) -> None:
+        self._handle("PUT")
+
+    def do_DELETE(self) -> None:
+        self._handle("DELETE")
+
+    # GitLab GraphQL
+    def graphql(self, body):
+        result = graphql_sync(
+            self.schema, body.get("query", ""), variable_values=body.get("variables")
+        )
+        response: Dict[str, Any] = {"data": result.data}
+        if result.errors:
+            response["errors"] = [error.formatted for error in result.errors]
+        return 200, response
+
+    # GitLab REST
+    def _get_project(self, pid: str) -> Optional[Dict[str, Any]]:
+        return self.state.by_pid.get(int(pid)) if pid.isdigit() else None
+
+    def _get_project_json(self, node: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "id": int(node["id"].split("/")[-1]),
+            "name": node["name"],
+            "path_with_namespace": node["fullPath"],
+            "default_branch": "main",
+        }
+
+    def gitlab_user(self, body):
+        return 200, {"id": 1, "username": "gitlab2sentry"}
+
+    def gitlab_project(self, pid, body):
+        node = self._get_project(pid)
+        return (200, self._get_project_json(node)) if node else (404, None)
+
+    def gitlab_get_branch(self, pid, branch, body):
+        if branch in self.state.branches.get(int(pid), set()):
+            return 200, {"name": branch}
+        return 404, {"message": "404 Branch Not Found"}
+
+    def gitlab_delete_branch(self, pid, branch, body):
+        self.state.branches[int(pid)].discard(branch)
+        return 204, None
+
+    def gitlab_create_branch(self, pid, body):
+        self.state.branches[int(pid)].add(body["branch"])
+        return 201, {"name": body["branch"]}
+
+    def gitlab_get_file(self, pid, file_path, body):
+        node = self._get_project(pid)
+        blobs = (node or {}).get("repository") or {"blobs": {"nodes": []}}
+        for blob in blobs["blobs"]["nodes"]:
+            if blob["name"] == file_path:
+                return 200, {
+                    "file_path": file_path,
+                    "file_name": file_path,
+                    "encoding": "base64",
+                    "content": base64.b64encode(
+                        (blob["rawTextBlob"] or "").encode()
+                    ).decode(),
+                    "ref": "main",
+                }
+        return 404, {"message": "404 File Not Found"}
+
+    def gitlab_write_file(self, pid, file_path, body):
+        return 201, {"file_path": file_path, "branch": body.get("branch")}
+
+    def gitlab_members(self, pid, body):
+        return 200, [
+            {"id": 1, "username": "maintainer", "access_level": 40, "state": "active"},
+            {"id": 2, "username": "developer", "access_level": 30, "state": "active"},
+        ]
+
+    def gitlab_create_mr(self, pid, body):
+        node = self._get_project(pid)
+        if not node:
+            return 404, None
+        with self.state.lock:
+            self.state.mr_count += 1
+            iid = self.state.mr_count
+        node["mergeRequests"]["nodes"].append(
+            {
+                "id": "gid://gitlab/MergeRequest/{}".format(iid),
+                "title": body["title"],
+                "state": "opened",
+                "sourceBranch": body["source_branch"],
+            }
+        )
+        return 201, {"id": iid, "iid": iid, "title": body["title"]}
+
+    # Sentry
+    def sentry_get_team(self, org, team_slug, body):
+        if team_slug in self.state.sentry_teams:
+            return 200, {"slug": team_slug}
+        return 404, {"detail": "The requested resource does not exist"}
+
+    def sentry_create_team(self, org, body):
+        self.state.sentry_teams.add(body["slug"])
+        return 201, {"slug": body["slug"], "name": body["name"]}
+
+    def sentry_get_project(self, org, project_slug, body):
+        if project_slug in self.state.sentry_projects:
+            return 200, self.state.sentry_projects[project_slug]
+        return 404, {"detail": "The requested resource does not exist"}
+
+    def sentry_create_project(self, org, team_slug, body):
+        project = {"slug": body["slug"], "name": body["name"]}
+        self.state.sentry_projects[body["slug"]] = project
+        return 201, project
+
+    def sentry_get_keys(self, org, project_slug, body):
+        if project_slug not in self.state.sentry_projects:
+            return 404, {"detail": "The requested resource does not exist"}
+        return 200, [
+            {
+                "id": "key-{}".format(project_slug),
+                "dsn": {"public": "http://public@sentry.stub/{}".format(project_slug)},
+            }
+        ]
+
+    def sentry_update_key(self, org, project_slug, key_id, body):
+        return 200, {"id": key_id, "rateLimit": body.get("rateLimit")}
+
+
+ROUTES = [
+    (r"/api/graphql", "POST", StubHandler.graphql),
+    (r"/api/v4/user", "GET", StubHandler.gitlab_user),
+    (r"/api/v4/projects/([^/]+)", "GET", StubHandler.gitlab_project),
+    (
+        r"/api/v4/projects/([^/]+)/repository/branches/(.+)",
+        "GET",
+        StubHandler.gitlab_get_branch,
+    ),
+    (
+        r"/api/v4/projects/([^/]+)/repository/branches/(.+)",
+        "DELETE",
+        StubHandler.gitlab_delete_branch,
+    ),
+    (
+        r"/api/v4/projects/([^/]+)/repository/branches",
+        "POST",
+        StubHandler.gitlab_create_branch,
+    ),
+    (
+        r"/api/v4/projects/([^/]+)/repository/files/(.+)",
+        "GET",
+        StubHandler.gitlab_get_file,
+    ),
+    (
+        r"/api/v4/projects/([^/]+)/repository/files/(.+)",
+        "POST",
+        StubHandler.gitlab_write_file,
+    ),
+    (
+        r"/api/v4/projects/([^/]+)/repository/files/(.+)",
+        "PUT",
+        StubHandler.gitlab_write_file,
+    ),
+    (r"/api/v4/projects/([^/]+)/members/all", "GET", StubHandler.gitlab_members),
+    (r"/api/v4/projects/([^/]+)/merge_requests", "POST", StubHandler.gitlab_create_mr),
+    (r"/api/0/teams/([^/]+)/([^/]+)/", "GET", StubHandler.sentry_get_team),
+    (r"/api/0/organizations/([^/]+)/teams/", "POST", StubHandler.sentry_create_team),
+    (r"/api/0/projects/([^/]+)/([^/]+)/", "GET", StubHandler.sentry_get_project),
+    (
+        r"/api/0/teams/([^/]+)/([^/]+)/projects/",
+        "POST",
+        StubHandler.sentry_create_project,
+    ),
+    (r"/api/0/projects/([^/]+)/([^/]+)/keys/", "GET", StubHandler.sentry_get_keys),
+    (
+        r"/api/0/projects/([^/]+)/([^/]+)/keys/([^/]+)/",
+        "PUT",
+        StubHandler.sentry_update_key,
+    ),
+]
+
+
+def start_servers(
+    state: StubState,
+    faults: FaultInjector,
+    host: str = "127.0.0.1",
+    gitlab_port: int = 8081,
+    sentry_port: int = 8082,
+) -> Tuple[ThreadingHTTPServer, ThreadingHTTPServer]:
+    """
+    Starts the GitLab and the Sentry stub servers in daemon threads.
+    Port 0 picks a free port (see server.server_address).
+    """
+    handler = type(
+        "BoundStubHandler",
+        (StubHandler,),
+        {"state": state, "faults": faults, "schema": _get_graphql_schema(state)},
+    )
+    servers = (
+        ThreadingHTTPServer((host, gitlab_port), handler),
+        ThreadingHTTPServer((host, sentry_port), handler),
+    )
+    for server in servers:
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    return servers
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--projects", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--gitlab-port", type=int, default=8081)
+    parser.add_argument("--sentry-port", type=int, default=8082)
+    args = parser.parse_args()
+
+    state = StubState(args.projects, args.seed)
+    faults = FaultInjector(
+        args.latency, args.jitter, args.error_rate, args.throttle_rate, args.seed
+    )
+    servers = start_servers(
+        state, faults, gitlab_port=args.gitlab_port, sentry_port=args.sentry_port
+    )
+    print(
+        "GitLab stub on http://{}:{} - Sentry stub on http://{}:{}".format(
+            *servers[0].server_address, *servers[1].server_address
+        )
+    )
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        for server in servers:
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
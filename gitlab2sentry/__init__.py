@@ -1,9 +1,13 @@
+import asyncio
+import functools
+import itertools
 import logging
+import multiprocessing
 import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
-from typing import Any, Dict, List, Optional
-
-from slugify import slugify
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Set, Tuple
 
 from gitlab2sentry.exceptions import SentryProjectCreationFailed
 from gitlab2sentry.resources import (
@@ -11,9 +15,38 @@ from gitlab2sentry.resources import (
     GRAPHQL_FETCH_PROJECT_QUERY,
     GRAPHQL_LIST_PROJECTS_QUERY,
     G2SProject,
+    MRState,
     settings,
 )
-from gitlab2sentry.utils import GitlabProvider, SentryProvider
+from gitlab2sentry.utils import (
+    G2S_ACTION_DSN,
+    G2S_ACTION_NONE,
+    G2S_ACTION_SENTRYCLIRC,
+    RUN_STATS,
+    AsyncGitlabProvider,
+    AsyncSentryProvider,
+    Backlog,
+    DSNCache,
+    G2STask,
+    GitlabProvider,
+    HTTPCache,
+    PendingSet,
+    PipelineStage,
+    ProjectReader,
+    RunJournal,
+    Scheduler,
+    SentryProvider,
+    WriteBudget,
+    call_accounting,
+    get_slug,
+    http_transport,
+    project_scope,
+    read_worker_page,
+    run_cassette,
+    run_pipeline,
+    tracer,
+    track_phase,
+)
 
 logging.basicConfig(
     level=logging.INFO,
@@ -22,23 +55,57 @@ logging.basicConfig(
 )
 
 
-class Gitlab2Sentry:
+class Gitlab2Sentry(ProjectReader):
     def __init__(self):
+        super().__init__()
+        self.journal = self._get_journal()
+        self.http_cache = self._get_http_cache()
+        self.pending = self._get_pending()
         self.gitlab_provider = self._get_gitlab_provider()
         self.sentry_provider = self._get_sentry_provider()
         self.run_stats = {key: value for key, value in G2S_STATS}
         self.yesterday = datetime.utcnow() - timedelta(hours=24)
         self.sentry_groups = set()
+        # Projects a gitlab2sentry MR was opened for by this run
+        self.mr_created_pids: Set[int] = set()
+        # Projects read back by the scan of this run
+        self.scanned_pids: Set[int] = set()
 
     def __str__(self) -> str:
         return "<Gitlab2Sentry>"
 
+    def _get_shard_path(self, path: str) -> str:
+        # Every shard keeps its own state files
+        if path and settings.shard_count > 1:
+            return "{}.{}".format(path, settings.shard_index)
+        return path
+
+    def _get_journal(self) -> RunJournal:
+        return RunJournal(self._get_shard_path(settings.journal_path))
+
+    def _get_http_cache(self) -> HTTPCache:
+        http_cache = HTTPCache(self._get_shard_path(settings.http_cache_path))
+        http_transport.set_cache(http_cache)
+        return http_cache
+
+    def _get_pending(self) -> PendingSet:
+        return PendingSet(self._get_shard_path(settings.pending_path))
+
     def _get_gitlab_provider(self) -> GitlabProvider:
-        return GitlabProvider(settings.gitlab_url, settings.gitlab_token)
+        return GitlabProvider(settings.gitlab_url, settings.gitlab_token, self.journal)
 
     def _get_sentry_provider(self) -> SentryProvider:
         return SentryProvider(
-            settings.sentry_url, settings.sentry_token, settings.sentry_org_slug
+            settings.sentry_url,
+            settings.sentry_token,
+            settings.sentry_org_slug,
+            DSNCache(self._get_shard_path(settings.sentry_dsn_cache_path)),
+        )
+
+    def _get_scheduler(self) -> Scheduler:
+        return Scheduler(
+            budget=WriteBudget(),
+            backlog=Backlog(self._get_shard_path(settings.budget_backlog_path)),
         )
 
     def _ensure_sentry_group(self, name: str) -> None:
@@ -56,8 +123,10 @@ class Gitlab2Sentry:
             self.run_stats["mr_disabled"] += 1
         return g2s_project.mrs_enabled
 
-    def _is_opened_mr(self, full_path: str, state: Optional[str], label: str) -> bool:
-        if state and state == "opened":
+    def _is_opened_mr(
+        self, full_path: str, state: Optional[MRState], label: str
+    ) -> bool:
+        if state == MRState.OPENED:
             logging.info(
                 "{}: [Skipping] Project {} - Has a pending {} MR.".format(
                     self.__str__(), full_path, label
@@ -80,8 +149,10 @@ class Gitlab2Sentry:
             "sentryclirc",
         )
 
-    def _is_closed_mr(self, full_path: str, state: Optional[str], label: str) -> bool:
-        if state and state == "closed":
+    def _is_closed_mr(
+        self, full_path: str, state: Optional[MRState], label: str
+    ) -> bool:
+        if state == MRState.CLOSED:
             logging.info(
                 "{}: [Skipping] Project {} - Has a closed {} MR.".format(
                     self.__str__(), full_path, label
@@ -105,43 +176,6 @@ class Gitlab2Sentry:
             "sentryclirc",
         )
 
-    def _get_mr_states(
-        self, project_name: str, mr_list: Optional[List[Dict[str, Any]]]
-    ) -> tuple:
-        sentryclirc_mr_state, dsn_mr_state = None, None
-        if mr_list:
-            for mr in mr_list:
-                if mr["title"] == settings.sentryclirc_mr_title.format(
-                    project_name=project_name
-                ):
-                    if not (sentryclirc_mr_state and sentryclirc_mr_state == "opened"):
-                        sentryclirc_mr_state = mr["state"]
-                elif mr["title"] == settings.dsn_mr_title.format(
-                    project_name=project_name
-                ):
-                    if not (dsn_mr_state and dsn_mr_state == "opened"):
-                        dsn_mr_state = mr["state"]
-                else:
-                    pass
-        return sentryclirc_mr_state, dsn_mr_state
-
-    def _is_group_project(self, group: Optional[Dict[str, Any]]) -> bool:
-        if group and group.get("name"):
-            return True
-        else:
-            return False
-
-    def _get_sentryclirc_file(self, blob: List[Dict[str, Any]]) -> tuple:
-        has_sentryclirc_file, has_dsn = False, False
-        if blob and blob[0]["name"] == settings.sentryclirc_filepath:
-            has_sentryclirc_file = True
-            if blob[0].get("rawTextBlob"):
-                for line in blob[0]["rawTextBlob"].split("\n"):
-                    if line.startswith("dsn"):
-                        has_dsn = True
-
-        return has_sentryclirc_file, has_dsn
-
     def _has_already_sentry(self, g2s_project: G2SProject) -> bool:
         if g2s_project.has_sentryclirc_file and g2s_project.has_dsn:
             logging.info(
@@ -151,89 +185,165 @@ class Gitlab2Sentry:
             )
         return g2s_project.has_sentryclirc_file and g2s_project.has_dsn
 
-    def _get_g2s_project(self, result: Dict[str, Any]) -> Optional[G2SProject]:
-        if result.get("repository"):
-            full_path = result["fullPath"]
-            group_name = full_path.split("/")[0]
-            project_name = result["name"]
-            created_at = result["createdAt"]
-            mrs_enabled = result["mergeRequestsEnabled"]
-            id_url = result["id"].split("/")[len(result["id"].split("/")) - 1]
-            sentryclirc_mr_state, dsn_mr_state = self._get_mr_states(
-                result["name"], result["mergeRequests"]["nodes"]
-            )
-            has_sentryclirc_file, has_dsn = self._get_sentryclirc_file(
-                result["repository"]["blobs"]["nodes"]
-            )
-            name_with_namespace = "{} / {}".format(group_name, project_name)
-            pid = int(id_url.split("/")[len(id_url.split("/")) - 1])
-            return G2SProject(
-                pid,
-                full_path,
-                project_name,
-                group_name,
-                mrs_enabled,
-                created_at,
-                name_with_namespace,
-                has_sentryclirc_file,
-                has_dsn,
-                sentryclirc_mr_state,
-                dsn_mr_state,
+    def _is_pending(self, g2s_project: G2SProject) -> bool:
+        # Waiting for the team to merge a gitlab2sentry MR, or for the DSN MR
+        if g2s_project.pid in self.mr_created_pids:
+            return True
+        if not g2s_project.mrs_enabled:
+            return False
+        if g2s_project.has_sentryclirc_file:
+            return (
+                not g2s_project.has_dsn and g2s_project.dsn_mr_state != MRState.CLOSED
             )
-        return None
+        return g2s_project.sentryclirc_mr_state == MRState.OPENED
 
-    def _get_paginated_projects(self) -> List[Dict[str, Any]]:
+    def _iter_paginated_projects(self) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Yields the pages of projects without keeping them: a page can be
+        freed as soon as its nodes are parsed into G2SProjects.
+        """
         query_start_time = time.time()
+        page_count = 0
+        for page in self._iter_resumed_pages():
+            page_count += 1
+            yield page
+        if self.journal.scan_done:
+            return
+        self._log_scan_start()
+        request_gen = self.gitlab_provider.get_all_projects(
+            GRAPHQL_LIST_PROJECTS_QUERY, self.journal.cursor
+        )
+        for page in request_gen:
+            if self.journal.enabled:
+                # The journal keeps the nodes, a streamed page is decoded first
+                page = list(page)
+            self.journal.record_page(self.gitlab_provider.end_cursor, page)
+            page_count += 1
+            yield page
+        self._record_scan_done(page_count, query_start_time)
+        self._count_prefiltered(self.gitlab_provider.get_prefilter_savings())
+
+    def _iter_resumed_pages(self) -> Iterator[List[Dict[str, Any]]]:
+        # Pages scanned by an interrupted run are not fetched again
+        resumed_pages, self.journal.pages = self.journal.pages, list()
+        if self.journal.scan_done:
+            logging.info(
+                "{}: Reusing the {} pages scanned by the interrupted run".format(
+                    self.__str__(), len(resumed_pages)
+                )
+            )
+        resumed_pages.reverse()
+        while resumed_pages:
+            yield resumed_pages.pop()
+
+    def _log_scan_start(self) -> None:
         logging.info(
             "{}: Starting querying all Gitlab group-projects with Graphql at {}/{}".format(  # noqa
                 self.__str__(), settings.gitlab_url, settings.gitlab_graphql_suffix
             )
         )
-        request_gen = self.gitlab_provider.get_all_projects(GRAPHQL_LIST_PROJECTS_QUERY)
-        page_results = [page for page in request_gen]
+
+    def _record_scan_done(self, page_count: int, query_start_time: float) -> None:
+        self.journal.record_scan_done()
         logging.info(
             "{}: Fetched {} pages. Total time: {} seconds".format(
                 self.__str__(),
-                len(page_results),
+                page_count,
                 round(time.time() - query_start_time, 2),
             )
         )
-        return page_results
+
+    def _count_prefiltered(self, savings: Dict[str, int]) -> None:
+        for name, saved in savings.items():
+            self.run_stats["prefiltered_{}".format(name)] += saved
+
+    def _iter_pending_projects(
+        self, scanned_pids: Set[int]
+    ) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Pages of the pending projects the scan did not find, e.g. created
+        more than GITLAB_PROJECT_CREATION_LIMIT days ago. Called once the
+        scan is done, scanned_pids then holds every scanned project.
+        """
+        pids = self._get_missing_pending(scanned_pids)
+        if not pids:
+            return
+        for page in self.gitlab_provider.get_projects_by_ids(
+            GRAPHQL_LIST_PROJECTS_QUERY, pids
+        ):
+            self.run_stats["pending_refreshed"] += len(page)
+            yield page
+
+    def _get_missing_pending(self, scanned_pids: Set[int]) -> List[int]:
+        pids = self.pending.get_missing(scanned_pids)
+        if pids:
+            logging.info(
+                "{}: Refreshing {} pending projects out of the scan window".format(
+                    self.__str__(), len(pids)
+                )
+            )
+        return pids
 
     def _get_gitlab_project(self, full_path: str) -> Optional[G2SProject]:
+        return self._read_gitlab_project(
+            self.gitlab_provider.get_project(self._get_fetch_query(full_path))
+        )
+
+    def _get_fetch_query(self, full_path: str) -> Dict[str, str]:
         GRAPHQL_FETCH_PROJECT_QUERY["full_path"] = full_path
         logging.info(
             "{}: Starting querying for specific Gitlab project with Graphql at {}/{}".format(  # noqa
                 self.__str__(), settings.gitlab_url, settings.gitlab_graphql_suffix
             )
         )
-        result = self.gitlab_provider.get_project(GRAPHQL_FETCH_PROJECT_QUERY)
-        return (
-            self._get_g2s_project(result.get("project"))
-            if result.get("project")
-            else None
-        )
+        return GRAPHQL_FETCH_PROJECT_QUERY
+
+    def _read_gitlab_project(self, result: Dict[str, Any]) -> Optional[G2SProject]:
+        project = result.get("project")
+        return self._get_g2s_project(project) if project else None
 
     def _get_gitlab_groups(self):
         groups = dict()
         valid_projects = 0
-        for page_result in self._get_paginated_projects():
+        pages = itertools.chain(
+            self._iter_paginated_projects(),
+            self._iter_pending_projects(self.scanned_pids),
+        )
+        for page_result in pages:
             for result_node in page_result:
-                result = result_node["node"]
-                if self._is_group_project(result["group"]):
-                    group_name = result["fullPath"].split("/")[0]
-                    if group_name.startswith(settings.gitlab_group_identifier):
-                        g2s_project = self._get_g2s_project(result)
-
-                        if g2s_project:
-                            if not groups.get(group_name):
-                                groups[group_name] = list()
-                            groups[group_name].append(g2s_project)
-                            valid_projects += 1
+                if self._add_result(groups, result_node["node"], self.scanned_pids):
+                    valid_projects += 1
+        self._log_filtered_projects(valid_projects)
+        return groups
+
+    def _add_result(
+        self,
+        groups: Dict[str, List[G2SProject]],
+        result: Dict[str, Any],
+        scanned_pids: Set[int],
+    ) -> Optional[G2SProject]:
+        scanned_pids.add(self._get_pid(result))
+        g2s_project = self.read_result(result)
+        if g2s_project:
+            self._add_g2s_project(groups, g2s_project)
+        return g2s_project
+
+    def _add_g2s_project(
+        self, groups: Dict[str, List[G2SProject]], g2s_project: G2SProject
+    ) -> None:
+        if not groups.get(g2s_project.group):
+            groups[g2s_project.group] = list()
+        groups[g2s_project.group].append(g2s_project)
+
+    def _log_filtered_projects(self, valid_projects: int) -> None:
         logging.info(
-            "{}: Total filtered projects: {}".format(self.__str__(), valid_projects)
+            "{}: Total filtered projects: {} (shard {}/{})".format(
+                self.__str__(),
+                valid_projects,
+                settings.shard_index,
+                settings.shard_count,
+            )
         )
-        return groups
 
     def _create_sentry_project(
         self,
@@ -262,23 +372,10 @@ class Gitlab2Sentry:
             )
         return None
 
-    def _handle_g2s_project(
-        self,
-        g2s_project: G2SProject,
-        sentry_group_name: str,
-        custom_name: Optional[str] = None,
-    ) -> bool:
+    def _get_g2s_action(self, g2s_project: G2SProject) -> str:
         """
-        Creates sentry project for all given gitlab projects. It
-        follows a two steps process.
-            1. Adds the .sentryclirc file to the gitlab repo (via
-                a mergeRequest).
-            2. If the .sentryclirc file is added to master branch (
-                or another default branch) it creates the sentry
-                project and it inserts the dsn inside the .sentryclirc
-                file.
-        The flow for creating mrs inlcudes specific cases for creating
-        or skiping. These cases are:
+        Action to take for a project, the skipped ones being logged and
+        counted. The cases are:
             1. Project is already in sentry [skip]
             2. Project has MRs disabled [skip]
             3. Project has an opened dsn MR and a .sentryclirc file.
@@ -291,50 +388,18 @@ class Gitlab2Sentry:
                 this. Create the sentryclirc file [create]
         """
         if self._has_already_sentry(g2s_project):
-            return False
+            return G2S_ACTION_NONE
 
         if not self._has_mrs_enabled(g2s_project):
-            return False
+            return G2S_ACTION_NONE
         # Case sentryclirc found but
         # dsn not found: Pending MR
         elif g2s_project.has_sentryclirc_file and not g2s_project.has_dsn:
             if self._opened_dsn_mr_found(g2s_project) or self._closed_dsn_mr_found(
                 g2s_project
             ):
-                return False
-            else:
-
-                sentry_project_name = (
-                    custom_name
-                    if custom_name
-                    else "-".join(g2s_project.full_path.split("/")[1:])
-                )
-                sentry_project_slug = slugify(sentry_project_name).lower()
-                sentry_project = self._create_sentry_project(
-                    g2s_project.full_path,
-                    sentry_group_name,
-                    sentry_project_name,
-                    sentry_project_slug,
-                )
-
-                # If Sentry fails to create project skip
-                if not sentry_project:
-                    return False
-
-                dsn = self.sentry_provider.set_rate_limit_for_key(
-                    sentry_project["slug"]
-                )
-
-                # If fetch of dsn failed skip
-                if not dsn:
-                    return False
-
-                mr_created = self.gitlab_provider.create_dsn_mr(
-                    g2s_project, dsn, sentry_project_slug
-                )
-                if mr_created:
-                    self.run_stats["mr_dsn_created"] += 1
-                return True
+                return G2S_ACTION_NONE
+            return G2S_ACTION_DSN
         # Case sentryclirc not found:
         # Declined sentryclirc MR or
         # need to create one
@@ -342,12 +407,8 @@ class Gitlab2Sentry:
             if self._opened_sentryclirc_mr_found(
                 g2s_project
             ) or self._closed_sentryclirc_mr_found(g2s_project):
-                return False
-            else:
-                mr_created = self.gitlab_provider.create_sentryclirc_mr(g2s_project)
-                if mr_created:
-                    self.run_stats["mr_sentryclirc_created"] += 1
-                return True
+                return G2S_ACTION_NONE
+            return G2S_ACTION_SENTRYCLIRC
         else:
             logging.info(
                 "{}: Project {} - Not included in Gitlab2Sentry cases".format(
@@ -355,7 +416,108 @@ class Gitlab2Sentry:
                 )
             )
             self.run_stats["not_in_g2s_cases"] += 1
-        return False
+        return G2S_ACTION_NONE
+
+    def _get_sentry_project_name(
+        self, g2s_project: G2SProject, custom_name: Optional[str]
+    ) -> str:
+        return (
+            custom_name
+            if custom_name
+            else "-".join(g2s_project.full_path.split("/")[1:])
+        )
+
+    def _count_mr(self, g2s_project: G2SProject, label: str, created: bool) -> None:
+        if created:
+            self.run_stats["mr_{}_created".format(label)] += 1
+            self.mr_created_pids.add(g2s_project.pid)
+        elif self.journal.is_step_done(
+            g2s_project.pid, self._get_branch_name(label), "mr"
+        ):
+            # Opened by the interrupted run this one resumes: still pending
+            self.mr_created_pids.add(g2s_project.pid)
+
+    def _get_branch_name(self, label: str) -> str:
+        return (
+            settings.dsn_branch_name
+            if label == "dsn"
+            else settings.sentryclirc_branch_name
+        )
+
+    def _create_dsn_mr(
+        self,
+        g2s_project: G2SProject,
+        sentry_group_name: str,
+        custom_name: Optional[str],
+    ) -> bool:
+        sentry_project_name = self._get_sentry_project_name(g2s_project, custom_name)
+        sentry_project_slug = get_slug(sentry_project_name).lower()
+        # A DSN already set up by a previous run needs no Sentry call
+        dsn = self.sentry_provider.get_cached_dsn(sentry_project_slug)
+        if not dsn:
+            sentry_project = self._create_sentry_project(
+                g2s_project.full_path,
+                sentry_group_name,
+                sentry_project_name,
+                sentry_project_slug,
+            )
+
+            # If Sentry fails to create project skip
+            if not sentry_project:
+                return False
+
+            dsn = self.sentry_provider.set_rate_limit_for_key(sentry_project["slug"])
+
+        # If fetch of dsn failed skip
+        if not dsn:
+            return False
+
+        self._count_mr(
+            g2s_project,
+            "dsn",
+            self.gitlab_provider.create_dsn_mr(g2s_project, dsn, sentry_project_slug),
+        )
+        return True
+
+    def _handle_g2s_project(
+        self,
+        g2s_project: G2SProject,
+        sentry_group_name: str,
+        custom_name: Optional[str] = None,
+        action: Optional[str] = None,
+    ) -> bool:
+        """
+        Creates sentry project for all given gitlab projects. It
+        follows a two steps process.
+            1. Adds the .sentryclirc file to the gitlab repo (via
+                a mergeRequest).
+            2. If the .sentryclirc file is added to master branch (
+                or another default branch) it creates the sentry
+                project and it inserts the dsn inside the .sentryclirc
+                file.
+        The cases for creating or skipping are the ones of
+        _get_g2s_action, unless the action was already decided.
+        """
+        with tracer.start_span(
+            "handle_project", attributes={"g2s.project": g2s_project.full_path}
+        ), project_scope(g2s_project.full_path):
+            if action is None:
+                action = self._get_g2s_action(g2s_project)
+            if action == G2S_ACTION_DSN:
+                return self._create_dsn_mr(g2s_project, sentry_group_name, custom_name)
+            elif action == G2S_ACTION_SENTRYCLIRC:
+                self._count_mr(
+                    g2s_project,
+                    "sentryclirc",
+                    self.gitlab_provider.create_sentryclirc_mr(g2s_project),
+                )
+                return True
+            return False
+
+    def _handle_g2s_task(self, task: G2STask) -> bool:
+        return self._handle_g2s_project(
+            task.g2s_project, task.sentry_group_name, action=task.action
+        )
 
     def update(
         self, full_path: Optional[str] = None, custom_name: Optional[str] = None
@@ -375,33 +537,466 @@ class Gitlab2Sentry:
         creation_days_limit is provided it will fetch all projects
         created after this period. If no it will fetch every project
         """
-        if full_path:
-            g2s_project = self._get_gitlab_project(full_path)
-            if g2s_project:
-                sentry_group_name = g2s_project.group.split("/")[0].strip()
-                self._handle_g2s_project(
-                    g2s_project, sentry_group_name, custom_name  # type: ignore
-                )
+        call_accounting.reset()
+        with tracer.start_span("update", attributes={"g2s.full_path": full_path}):
+            if full_path:
+                g2s_project = self._get_gitlab_project(full_path)
+                if g2s_project:
+                    self._handle_g2s_project(
+                        g2s_project,
+                        self._get_sentry_group_name(g2s_project.group),
+                        custom_name,
+                    )
+                else:
+                    self._log_not_found(full_path)
+            # If no kwarg is given fetch all
             else:
-                logging.info(
-                    "{}: Project with fullPath - {} not found".format(
-                        self.__str__(), full_path
+                with tracer.start_span("scan"), track_phase("scan"):
+                    groups = self._get_gitlab_groups()
+                scheduler = self._get_scheduler()
+
+                with tracer.start_span("provision"), track_phase("provision"):
+                    for group_name in groups.keys():
+                        self._ensure_sentry_group(
+                            self._get_sentry_group_name(group_name)
+                        )
+                with tracer.start_span("decide"), track_phase("decide"):
+                    self._schedule(scheduler, groups)
+                # DSN MRs first, then newest projects, as long as the
+                # run deadline allows to start a new action
+                with tracer.start_span("write"), track_phase("write"):
+                    scheduler.run(self._handle_g2s_task)
+                self._finish_scan(scheduler, groups)
+        self._report()
+
+    def _get_sentry_group_name(self, group_name: str) -> str:
+        return group_name.split("/")[0].strip()
+
+    def _log_not_found(self, full_path: str) -> None:
+        logging.info(
+            "{}: Project with fullPath - {} not found".format(self.__str__(), full_path)
+        )
+
+    def _schedule(
+        self, scheduler: Scheduler, groups: Dict[str, List[G2SProject]]
+    ) -> None:
+        for group_name in groups.keys():
+            sentry_group_name = self._get_sentry_group_name(group_name)
+            for g2s_project in groups[group_name]:
+                # Decided once: the rank and the handling of the task agree
+                scheduler.add(
+                    G2STask(
+                        self._get_g2s_action(g2s_project),
+                        g2s_project,
+                        sentry_group_name,
                     )
                 )
-        # If no kwarg is given fetch all
-        else:
-            groups = self._get_gitlab_groups()
-
-            for group_name in groups.keys():
-                sentry_group_name = group_name.split("/")[0].strip()
-                self._ensure_sentry_group(sentry_group_name)
-                for g2s_project in groups[group_name]:
-                    # Skip if sentry is installed or
-                    # Project has disabled MRs
-                    self._handle_g2s_project(
-                        g2s_project, sentry_group_name  # type: ignore
-                    )
+
+    def _finish_scan(
+        self, scheduler: Scheduler, groups: Dict[str, List[G2SProject]]
+    ) -> None:
+        self.run_stats["deadline_deferred"] += scheduler.deferred
+        self.run_stats["budget_deferred"] += scheduler.budget_deferred
+        pending_pids = {
+            g2s_project.pid
+            for g2s_projects in groups.values()
+            for g2s_project in g2s_projects
+            if self._is_pending(g2s_project)
+        }
+        # Only the projects read back by this run can leave the set: a
+        # failed refresh keeps them pending
+        read_pids = self.scanned_pids | self.gitlab_provider.refreshed_pids
+        self.pending.save(pending_pids, read_pids - pending_pids)
+        # Every project went through, next run starts a new scan
+        # (deferred projects are still pending and found again)
+        self.journal.clear()
+
+    def _report(self) -> None:
         for key in self.run_stats.keys():
             logging.info(
                 "{}: RESULTS - {}: {}".format(self.__str__(), key, self.run_stats[key])
             )
+            RUN_STATS.labels(stat=key).set(self.run_stats[key])
+        call_accounting.report(
+            self.run_stats["mr_sentryclirc_created"] + self.run_stats["mr_dsn_created"]
+        )
+        self.http_cache.report()
+        self.http_cache.save()
+        self.sentry_provider.dsn_cache.save()
+        run_cassette.close()
+        tracer.flush()
+
+
+# A project admitted by the provision stage, on its way to the write stage
+G2SWrite = namedtuple("G2SWrite", ["task", "dsn", "sentry_project_slug", "start_time"])
+
+
+class AsyncGitlab2Sentry(Gitlab2Sentry):
+    """
+    Gitlab2Sentry on a single asyncio event loop: the scan, the Sentry
+    provisioning and the MR writes are coroutines of the async providers
+    instead of blocking calls. A full scan runs them as the stages of a
+    pipeline (scan, classify, provision, write) connected by bounded
+    queues, so that the MRs are opened while the scan goes on. Decisions,
+    stats, journal, pending set and admission are the ones of
+    Gitlab2Sentry.
+    """
+
+    gitlab_provider: AsyncGitlabProvider
+    sentry_provider: AsyncSentryProvider
+    sentry_teams: Dict[str, "asyncio.Future[Any]"]
+
+    def __str__(self) -> str:
+        return "<AsyncGitlab2Sentry>"
+
+    def _get_gitlab_provider(self) -> AsyncGitlabProvider:
+        return AsyncGitlabProvider(
+            settings.gitlab_url, settings.gitlab_token, self.journal
+        )
+
+    def _get_sentry_provider(self) -> AsyncSentryProvider:
+        return AsyncSentryProvider(
+            settings.sentry_url,
+            settings.sentry_token,
+            settings.sentry_org_slug,
+            DSNCache(self._get_shard_path(settings.sentry_dsn_cache_path)),
+        )
+
+    def _get_concurrency(self) -> int:
+        return max(settings.async_concurrency, 1)
+
+    def _get_workers(self, workers: int) -> int:
+        # 0 follows ASYNC_CONCURRENCY
+        return workers if workers > 0 else self._get_concurrency()
+
+    def _get_process_pool(self) -> Optional[ProcessPoolExecutor]:
+        if settings.pipeline_classify_processes <= 0:
+            return None
+        # Spawned: a fork would copy the event loop, its threads and sessions
+        return ProcessPoolExecutor(
+            settings.pipeline_classify_processes,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+    async def _ensure_sentry_group(self, name: str) -> None:  # type: ignore[override]
+        # The projects of a group wait for the same team creation
+        if name not in self.sentry_teams:
+            self.sentry_groups.add(name)
+            self.sentry_teams[name] = asyncio.ensure_future(
+                self.sentry_provider.ensure_sentry_team(name)
+            )
+        await self.sentry_teams[name]
+
+    async def _iter_paginated_projects(  # type: ignore[override]
+        self,
+    ) -> AsyncIterator[List[Dict[str, Any]]]:
+        query_start_time = time.time()
+        page_count = 0
+        for page in self._iter_resumed_pages():
+            page_count += 1
+            yield page
+        if self.journal.scan_done:
+            return
+        # Counted while the pages are fetched
+        savings = asyncio.ensure_future(self.gitlab_provider.get_prefilter_savings())
+        self._log_scan_start()
+        async for page in self.gitlab_provider.get_all_projects(
+            GRAPHQL_LIST_PROJECTS_QUERY, self.journal.cursor
+        ):
+            self.journal.record_page(self.gitlab_provider.end_cursor, page)
+            page_count += 1
+            yield page
+        self._record_scan_done(page_count, query_start_time)
+        self._count_prefiltered(await savings)
+
+    async def _iter_pending_projects(  # type: ignore[override]
+        self, scanned_pids: Set[int]
+    ) -> AsyncIterator[List[Dict[str, Any]]]:
+        pids = self._get_missing_pending(scanned_pids)
+        if not pids:
+            return
+        async for page in self.gitlab_provider.get_projects_by_ids(
+            GRAPHQL_LIST_PROJECTS_QUERY, pids
+        ):
+            self.run_stats["pending_refreshed"] += len(page)
+            yield page
+
+    async def _get_gitlab_project(  # type: ignore[override]
+        self, full_path: str
+    ) -> Optional[G2SProject]:
+        return self._read_gitlab_project(
+            await self.gitlab_provider.get_project(self._get_fetch_query(full_path))
+        )
+
+    async def _create_sentry_project(  # type: ignore[override]
+        self,
+        full_path: str,
+        sentry_group_name: str,
+        sentry_project_name: str,
+        sentry_project_slug: str,
+    ) -> Optional[Dict[str, Any]]:
+        try:
+            return await self.sentry_provider.get_or_create_project(
+                sentry_group_name,
+                sentry_project_name,
+                sentry_project_slug,
+            )
+        except SentryProjectCreationFailed as creation_err:
+            logging.error(
+                "{} Project {} - Failed to create sentry project: {}".format(
+                    self.__str__(), full_path, str(creation_err)
+                )
+            )
+        except Exception as err:
+            logging.warning(
+                "{} Project {} - Failed to get/create its sentry project: {}".format(
+                    self.__str__(), full_path, str(err)
+                )
+            )
+        return None
+
+    async def _get_dsn(
+        self,
+        g2s_project: G2SProject,
+        sentry_group_name: str,
+        custom_name: Optional[str],
+    ) -> Tuple[Optional[str], str]:
+        sentry_project_name = self._get_sentry_project_name(g2s_project, custom_name)
+        sentry_project_slug = get_slug(sentry_project_name).lower()
+        dsn = self.sentry_provider.get_cached_dsn(sentry_project_slug)
+        if not dsn:
+            sentry_project = await self._create_sentry_project(
+                g2s_project.full_path,
+                sentry_group_name,
+                sentry_project_name,
+                sentry_project_slug,
+            )
+            if not sentry_project:
+                return None, sentry_project_slug
+            dsn = await self.sentry_provider.set_rate_limit_for_key(
+                sentry_project["slug"]
+            )
+        return dsn, sentry_project_slug
+
+    async def _create_dsn_mr(  # type: ignore[override]
+        self,
+        g2s_project: G2SProject,
+        sentry_group_name: str,
+        custom_name: Optional[str],
+    ) -> bool:
+        dsn, sentry_project_slug = await self._get_dsn(
+            g2s_project, sentry_group_name, custom_name
+        )
+        if not dsn:
+            return False
+        self._count_mr(
+            g2s_project,
+            "dsn",
+            await self.gitlab_provider.create_dsn_mr(
+                g2s_project, dsn, sentry_project_slug
+            ),
+        )
+        return True
+
+    async def _handle_g2s_project(  # type: ignore[override]
+        self,
+        g2s_project: G2SProject,
+        sentry_group_name: str,
+        custom_name: Optional[str] = None,
+        action: Optional[str] = None,
+    ) -> bool:
+        with tracer.start_span(
+            "handle_project", attributes={"g2s.project": g2s_project.full_path}
+        ), project_scope(g2s_project.full_path):
+            if action is None:
+                action = self._get_g2s_action(g2s_project)
+            if action == G2S_ACTION_DSN:
+                return await self._create_dsn_mr(
+                    g2s_project, sentry_group_name, custom_name
+                )
+            elif action == G2S_ACTION_SENTRYCLIRC:
+                self._count_mr(
+                    g2s_project,
+                    "sentryclirc",
+                    await self.gitlab_provider.create_sentryclirc_mr(g2s_project),
+                )
+                return True
+            return False
+
+    async def _handle_g2s_task(self, task: G2STask) -> bool:  # type: ignore[override]
+        return await self._handle_g2s_project(
+            task.g2s_project, task.sentry_group_name, action=task.action
+        )
+
+    async def _scan(
+        self, classify_stage: PipelineStage, scanned_pids: Set[int]
+    ) -> None:
+        with tracer.start_span("scan"), track_phase("scan"):
+            async for page_result in self._iter_paginated_projects():
+                # Needed by the pending refresh before classify is done
+                scanned_pids.update(
+                    self._get_pid(result_node["node"]) for result_node in page_result
+                )
+                await classify_stage.put(page_result)
+            async for page_result in self._iter_pending_projects(scanned_pids):
+                await classify_stage.put(page_result)
+
+    async def _classify_page(
+        self,
+        scheduler: Scheduler,
+        provision_stage: PipelineStage,
+        groups: Dict[str, List[G2SProject]],
+        process_pool: Optional[ProcessPoolExecutor],
+        page_result: List[Dict[str, Any]],
+    ) -> None:
+        if process_pool:
+            # The event loop keeps fetching pages meanwhile
+            g2s_projects = await asyncio.get_running_loop().run_in_executor(
+                process_pool, read_worker_page, page_result
+            )
+        else:
+            g2s_projects = self.read_page(page_result)
+        for g2s_project in g2s_projects:
+            self._add_g2s_project(groups, g2s_project)
+            task = G2STask(
+                self._get_g2s_action(g2s_project),
+                g2s_project,
+                self._get_sentry_group_name(g2s_project.full_path),
+            )
+            await provision_stage.put(task, scheduler.get_rank(task))
+
+    async def _provision_g2s_task(
+        self, scheduler: Scheduler, write_stage: PipelineStage, task: G2STask
+    ) -> None:
+        # Every scanned group gets its team, as with the synchronous engine
+        team_ready = await self._provision_sentry_group(task)
+        if task.action == G2S_ACTION_NONE or not await scheduler.async_admit(task):
+            return
+        start_time = time.monotonic()
+        dsn, sentry_project_slug = None, None
+        if task.action == G2S_ACTION_DSN:
+            if team_ready:
+                with project_scope(task.g2s_project.full_path):
+                    try:
+                        dsn, sentry_project_slug = await self._get_dsn(
+                            task.g2s_project, task.sentry_group_name, None
+                        )
+                    except Exception as err:
+                        self._log_provision_failure(task, err)
+            if not dsn:
+                scheduler.done(task, start_time)
+                return
+        await write_stage.put(
+            G2SWrite(task, dsn, sentry_project_slug, start_time),
+            scheduler.get_rank(task),
+        )
+
+    async def _provision_sentry_group(self, task: G2STask) -> bool:
+        with project_scope(task.g2s_project.full_path):
+            try:
+                await self._ensure_sentry_group(task.sentry_group_name)
+                return True
+            except Exception as err:
+                self._log_provision_failure(task, err)
+                return False
+
+    def _log_provision_failure(self, task: G2STask, err: Exception) -> None:
+        # The other projects of the run keep going
+        logging.warning(
+            "{} Project {} - Failed to provision its sentry project: {}".format(
+                self.__str__(), task.g2s_project.full_path, str(err)
+            )
+        )
+
+    async def _write_g2s_task(self, scheduler: Scheduler, g2s_write: G2SWrite) -> None:
+        g2s_project = g2s_write.task.g2s_project
+        with tracer.start_span(
+            "handle_project", attributes={"g2s.project": g2s_project.full_path}
+        ), project_scope(g2s_project.full_path):
+            if g2s_write.task.action == G2S_ACTION_DSN:
+                self._count_mr(
+                    g2s_project,
+                    "dsn",
+                    await self.gitlab_provider.create_dsn_mr(
+                        g2s_project, g2s_write.dsn, g2s_write.sentry_project_slug
+                    ),
+                )
+            else:
+                self._count_mr(
+                    g2s_project,
+                    "sentryclirc",
+                    await self.gitlab_provider.create_sentryclirc_mr(g2s_project),
+                )
+        scheduler.done(g2s_write.task, g2s_write.start_time)
+
+    async def _run_pipeline(self, scheduler: Scheduler) -> Dict[str, List[G2SProject]]:
+        groups: Dict[str, List[G2SProject]] = dict()
+        write_stage = PipelineStage(
+            "write",
+            functools.partial(self._write_g2s_task, scheduler),
+            self._get_workers(settings.pipeline_write_workers),
+        )
+        provision_stage = PipelineStage(
+            "provision",
+            functools.partial(self._provision_g2s_task, scheduler, write_stage),
+            self._get_workers(settings.pipeline_provision_workers),
+        )
+        process_pool = self._get_process_pool()
+        classify_stage = PipelineStage(
+            "classify",
+            functools.partial(
+                self._classify_page, scheduler, provision_stage, groups, process_pool
+            ),
+            # Enough pages in flight to keep every process busy
+            max(
+                settings.pipeline_classify_workers, settings.pipeline_classify_processes
+            ),
+        )
+        try:
+            await run_pipeline(
+                functools.partial(self._scan, classify_stage, self.scanned_pids),
+                [classify_stage, provision_stage, write_stage],
+            )
+        finally:
+            if process_pool:
+                process_pool.shutdown(cancel_futures=True)
+        self._log_filtered_projects(
+            sum(len(g2s_projects) for g2s_projects in groups.values())
+        )
+        return groups
+
+    def update(
+        self, full_path: Optional[str] = None, custom_name: Optional[str] = None
+    ) -> None:
+        """
+        Gitlab2Sentry.update run on a new event loop.
+        """
+        call_accounting.reset()
+        asyncio.run(self._update(full_path, custom_name))
+        self._report()
+
+    async def _update(
+        self, full_path: Optional[str] = None, custom_name: Optional[str] = None
+    ) -> None:
+        self.sentry_teams = dict()
+        try:
+            with tracer.start_span("update", attributes={"g2s.full_path": full_path}):
+                if full_path:
+                    g2s_project = await self._get_gitlab_project(full_path)
+                    if g2s_project:
+                        await self._handle_g2s_project(
+                            g2s_project,
+                            self._get_sentry_group_name(g2s_project.group),
+                            custom_name,
+                        )
+                    else:
+                        self._log_not_found(full_path)
+                else:
+                    scheduler = self._get_scheduler()
+                    groups = await self._run_pipeline(scheduler)
+                    scheduler.finish()
+                    self._finish_scan(scheduler, groups)
+        finally:
+            # The sessions belong to the event loop of this run
+            await self.gitlab_provider.close()
+            await self.sentry_provider.close()
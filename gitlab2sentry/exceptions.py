@@ -1,6 +1,38 @@
+from typing import Mapping, Optional
+
+
 class SentryProjectCreationFailed(Exception):
     pass
 
 
 class SentryProjectKeyIDNotFound(Exception):
     pass
+
+
+class RetryLimitExceeded(Exception):
+    pass
+
+
+class CassetteInteractionNotFound(Exception):
+    pass
+
+
+class GitlabAuthenticationFailed(Exception):
+    pass
+
+
+class GraphQLQueryFailed(Exception):
+    pass
+
+
+class GraphQLRequestFailed(Exception):
+    def __init__(
+        self, status_code: Optional[int], headers: Optional[Mapping[str, str]] = None
+    ) -> None:
+        super().__init__("Returned {}".format(status_code))
+        self.status_code = status_code
+        self.headers = headers
+
+
+class GitlabRequestFailed(Exception):
+    pass
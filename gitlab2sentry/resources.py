@@ -1,11 +1,22 @@
-from collections import namedtuple
-from typing import List, Tuple
+from dataclasses import dataclass
+from enum import Enum
+from typing import Dict, List, Optional, Tuple
 
-from pydantic import Field
+from pydantic import AliasChoices, Field
 from pydantic_settings import BaseSettings
 
 
 class Settings(BaseSettings):
+    accounting_report_path: str = Field("")
+    accounting_top_projects: int = Field(10)
+    async_concurrency: int = Field(0)
+    budget_backlog_path: str = Field("")
+    budget_mrs_per_group: int = Field(0)
+    budget_mrs_per_minute: int = Field(0)
+    budget_mrs_per_run: int = Field(0)
+    cassette_mode: str = Field("", examples=["record", "replay"])
+    cassette_path: str = Field("")
+    cassette_realtime: bool = Field(False)
     dsn_branch_name: str = Field("auto_add_sentry_dsn")
     dsn_mr_content: str = Field(
         """
@@ -26,6 +37,7 @@ class Settings(BaseSettings):
     gitlab_author_email: str = Field("default-email@example.com")
     gitlab_author_name: str = Field("Default Author")
     gitlab_graphql_page_length: int = Field(0)
+    gitlab_graphql_streaming: bool = Field(False)
     gitlab_graphql_suffix: str = Field("default-content")
     gitlab_graphql_timeout: int = Field(10)
     gitlab_group_identifier: str = Field("")
@@ -33,12 +45,45 @@ class Settings(BaseSettings):
     gitlab_mentions_access_level: int = Field(40)
     gitlab_mr_keyword: str = Field("sentry")
     gitlab_mr_label_list: List[str] = Field(["sentry"])
+    gitlab_prefilter_counts: bool = Field(False)
     gitlab_project_creation_limit: int = Field(30)
+    gitlab_project_prefilters: List[str] = Field(
+        ["archived", "merge_requests_disabled", "pending_deletion"]
+    )
     gitlab_rmv_src_branch: bool = Field(True)
     gitlab_signed_commit: bool = Field(False)
     gitlab_token: str = Field("default-token")
     gitlab_url: str = Field("http://default-gitlab-url")
+    http_cache_max_entries: int = Field(10000)
+    http_cache_path: str = Field("")
+    http_cache_ttl: int = Field(0)
+    http_dns_cache_ttl: int = Field(300)
+    http_pool_size: int = Field(10)
+    http_timeout: int = Field(60)
+    journal_max_age: int = Field(24)
+    journal_path: str = Field("")
+    json_backend: str = Field("auto", examples=["auto", "orjson", "json"])
+    metrics_port: int = Field(0)
+    metrics_pushgateway_url: str = Field("")
+    metrics_textfile_path: str = Field("")
+    pending_batch_size: int = Field(100)
+    pending_path: str = Field("")
+    pipeline_classify_processes: int = Field(0)
+    pipeline_classify_workers: int = Field(1)
+    pipeline_provision_workers: int = Field(0)
+    pipeline_queue_size: int = Field(100)
+    pipeline_write_workers: int = Field(0)
+    profiling_interval: int = Field(60)
+    profiling_path: str = Field("")
+    profiling_top: int = Field(25)
+    retry_max_attempts: int = Field(5)
+    retry_max_wait: int = Field(120)
+    run_deadline: int = Field(0)
+    run_interval: int = Field(0)
+    scheduler_action_estimate: int = Field(10)
     sentry_dsn: str = Field("http://default.sentry.com")
+    sentry_dsn_cache_max_age: int = Field(168)
+    sentry_dsn_cache_path: str = Field("")
     sentry_env: str = Field("production")
     sentry_org_slug: str = Field("default_org")
     sentry_token: str = Field("default-token")
@@ -59,27 +104,63 @@ class Settings(BaseSettings):
     sentryclirc_mr_title: str = Field(
         """"[gitlab2sentry] Merge me to add Sentry to {project_name} or close me"""
     )
+    tracing_file_path: str = Field("")
+    tracing_otlp_endpoint: str = Field("")
+    # SHARD_INDEX falls back on the index of a Kubernetes Indexed Job
+    shard_count: int = Field(1)
+    shard_index: int = Field(
+        0, validation_alias=AliasChoices("shard_index", "job_completion_index")
+    )
 
 
 settings = Settings()  # type: ignore
 
-# G2SProject namedtuple configuration
-G2SProject = namedtuple(
-    "G2SProject",
-    [
-        "pid",
-        "full_path",
-        "name",
-        "group",
-        "mrs_enabled",
-        "created_at",
-        "name_with_namespace",
-        "has_sentryclirc_file",
-        "has_dsn",
-        "sentryclirc_mr_state",
-        "dsn_mr_state",
-    ],
-)
+
+class MRState(str, Enum):
+    """
+    States of a gitlab2sentry MR. Members compare equal to the state
+    strings of the API, and each project refers to the same few members
+    instead of holding its own copy of the string.
+    """
+
+    OPENED = "opened"
+    CLOSED = "closed"
+    MERGED = "merged"
+    LOCKED = "locked"
+
+
+MR_STATES: Dict[str, MRState] = {state.value: state for state in MRState}
+
+
+# G2SProject record: one per scanned project, kept for the whole run
+@dataclass(frozen=True, slots=True)
+class G2SProject:
+    pid: int
+    full_path: str
+    name: str
+    group: str
+    mrs_enabled: bool
+    created_at: str
+    has_sentryclirc_file: bool
+    has_dsn: bool
+    sentryclirc_mr_state: Optional[MRState]
+    dsn_mr_state: Optional[MRState]
+
+    @property
+    def name_with_namespace(self) -> str:
+        return "{} / {}".format(self.group, self.name)
+
+
+# GitLab silently caps the nodes of a GraphQL page at this count
+GRAPHQL_MAX_PAGE_LENGTH = 100
+
+# Arguments of the projects queries by GITLAB_PROJECT_PREFILTERS name:
+# the projects they exclude are never downloaded
+GRAPHQL_PROJECT_PREFILTERS: Dict[str, str] = {
+    "archived": "archived: EXCLUDE",
+    "merge_requests_disabled": "withMergeRequestsEnabled: true",
+    "pending_deletion": "notAimedForDeletion: true",
+}
 
 # Statistics configuration
 G2S_STATS: List[Tuple[str, int]] = [
@@ -91,7 +172,10 @@ G2S_STATS: List[Tuple[str, int]] = [
     ("mr_dsn_created", 0),
     ("mr_sentryclirc_closed", 0),
     ("mr_dsn_closed", 0),
-]
+    ("deadline_deferred", 0),
+    ("budget_deferred", 0),
+    ("pending_refreshed", 0),
+] + [("prefiltered_{}".format(name), 0) for name in GRAPHQL_PROJECT_PREFILTERS]
 
 # GraphQL Queries.
 GRAPHQL_LIST_PROJECTS_QUERY = {
@@ -100,6 +184,10 @@ GRAPHQL_LIST_PROJECTS_QUERY = {
     "body": """
 {
     projects%s {
+        pageInfo {
+            endCursor
+            hasNextPage
+        }
         edges {
             node {
                 id
@@ -118,19 +206,20 @@ GRAPHQL_LIST_PROJECTS_QUERY = {
                         }
                     }
                 }
-                mergeRequests%s {
+                sentryclircMergeRequests: mergeRequests%s {
+                    nodes {
+                        sourceBranch
+                        state
+                    }
+                }
+                dsnMergeRequests: mergeRequests%s {
                     nodes {
-                        id
-                        title
+                        sourceBranch
                         state
                     }
                 }
             }
         }
-        pageInfo {
-            endCursor
-            hasNextPage
-        }
     }
 }
 """,
@@ -158,10 +247,15 @@ GRAPHQL_FETCH_PROJECT_QUERY = {
                 }
             }
         }
-        mergeRequests%s {
+        sentryclircMergeRequests: mergeRequests%s {
             nodes {
-                id
-                title
+                sourceBranch
+                state
+            }
+        }
+        dsnMergeRequests: mergeRequests%s {
+            nodes {
+                sourceBranch
                 state
             }
         }
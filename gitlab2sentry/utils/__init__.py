@@ -1,2 +1,20 @@
+from .accounting import *  # noqa
+from .async_http import *  # noqa
+from .budget import *  # noqa
+from .cassette import *  # noqa
+from .codec import *  # noqa
+from .dsn_cache import *  # noqa
 from .gitlab_provider import *  # noqa
+from .http_cache import *  # noqa
+from .journal import *  # noqa
+from .json_stream import *  # noqa
+from .metrics import *  # noqa
+from .pending import *  # noqa
+from .pipeline import *  # noqa
+from .profiling import *  # noqa
+from .project_reader import *  # noqa
+from .retry import *  # noqa
+from .scheduler import *  # noqa
 from .sentry_provider import *  # noqa
+from .tracing import *  # noqa
+from .transport import *  # noqa
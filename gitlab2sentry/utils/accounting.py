@@ -0,0 +1,145 @@
+import collections
+import json
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Generator
+
+from gitlab2sentry.resources import settings
+
+NO_PHASE = "none"
+NO_PROJECT = "-"
+
+current_phase: ContextVar[str] = ContextVar("g2s_phase", default=NO_PHASE)
+current_project: ContextVar[str] = ContextVar("g2s_project", default=NO_PROJECT)
+
+
+@contextmanager
+def phase_scope(phase: str) -> Generator[None, None, None]:
+    token = current_phase.set(phase)
+    try:
+        yield
+    finally:
+        current_phase.reset(token)
+
+
+@contextmanager
+def project_scope(full_path: str) -> Generator[None, None, None]:
+    token = current_project.set(full_path)
+    try:
+        yield
+    finally:
+        current_project.reset(token)
+
+
+def get_size(payload: Any) -> int:
+    # Mocked or streamed payloads have no known size
+    return len(payload) if isinstance(payload, (bytes, str)) else 0
+
+
+class CallAccounting:
+    """
+    Counts the API calls of a run and the bytes they transferred, by
+    phase, by project (the one being handled, "-" for calls outside of
+    a project such as scan pages or Sentry teams) and by endpoint.
+    """
+
+    def __init__(
+        self,
+        top_projects: int = settings.accounting_top_projects,
+        report_path: str = settings.accounting_report_path,
+    ) -> None:
+        self.top_projects = top_projects
+        self.report_path = report_path
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __str__(self) -> str:
+        return "<CallAccounting>"
+
+    def reset(self) -> None:
+        self.calls = 0
+        self.bytes = 0
+        self.calls_by_phase: collections.Counter = collections.Counter()
+        self.calls_by_endpoint: collections.Counter = collections.Counter()
+        self.calls_by_project: collections.Counter = collections.Counter()
+        self.bytes_by_project: collections.Counter = collections.Counter()
+
+    def record(self, client: str, endpoint: str, size: int) -> None:
+        project = current_project.get()
+        with self._lock:
+            self.calls += 1
+            self.bytes += size
+            self.calls_by_phase[current_phase.get()] += 1
+            self.calls_by_endpoint["{} {}".format(client, endpoint)] += 1
+            self.calls_by_project[project] += 1
+            self.bytes_by_project[project] += size
+
+    def get_report(self, mrs_created: int) -> Dict[str, Any]:
+        project_calls = collections.Counter(
+            {
+                project: calls
+                for project, calls in self.calls_by_project.items()
+                if project != NO_PROJECT
+            }
+        )
+        return {
+            "calls": self.calls,
+            "bytes": self.bytes,
+            "calls_by_phase": dict(self.calls_by_phase),
+            "calls_by_endpoint": dict(self.calls_by_endpoint.most_common()),
+            "calls_per_project": (
+                round(sum(project_calls.values()) / len(project_calls), 2)
+                if project_calls
+                else 0.0
+            ),
+            "calls_per_mr": (
+                round(self.calls_by_phase["write"] / mrs_created, 2)
+                if mrs_created
+                else 0.0
+            ),
+            "mrs_created": mrs_created,
+            "top_projects": [
+                {
+                    "project": project,
+                    "calls": calls,
+                    "bytes": self.bytes_by_project[project],
+                }
+                for project, calls in project_calls.most_common(self.top_projects)
+            ],
+        }
+
+    def report(self, mrs_created: int) -> Dict[str, Any]:
+        """
+        Logs the report of the run and writes it to the report path
+        (json) so that call counts can be compared between runs.
+        """
+        report = self.get_report(mrs_created)
+        logging.info(
+            "{}: API CALLS - total: {} ({} bytes), per project: {}, per MR: {}".format(
+                self.__str__(),
+                report["calls"],
+                report["bytes"],
+                report["calls_per_project"],
+                report["calls_per_mr"],
+            )
+        )
+        for phase, calls in report["calls_by_phase"].items():
+            logging.info("{}: API CALLS - {}: {}".format(self.__str__(), phase, calls))
+        for project in report["top_projects"]:
+            logging.info(
+                "{}: API CALLS - {}: {} ({} bytes)".format(
+                    self.__str__(),
+                    project["project"],
+                    project["calls"],
+                    project["bytes"],
+                )
+            )
+        if self.report_path:
+            with open(self.report_path, "w") as report_file:
+                json.dump(report, report_file, indent=2)
+        return report
+
+
+call_accounting = CallAccounting()
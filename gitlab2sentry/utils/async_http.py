@@ -0,0 +1,141 @@
+import time
+from collections import namedtuple
+from typing import TYPE_CHECKING, Any, Mapping, Optional
+
+from gitlab2sentry.resources import settings
+from gitlab2sentry.utils.accounting import get_size
+from gitlab2sentry.utils.cassette import Cassette, get_request_path, run_cassette
+from gitlab2sentry.utils.codec import json_codec
+from gitlab2sentry.utils.metrics import get_endpoint, track_request
+from gitlab2sentry.utils.retry import RetryPolicy
+from gitlab2sentry.utils.tracing import SPAN_KIND_CLIENT, tracer
+
+# aiohttp is only imported by the asyncio engine
+if TYPE_CHECKING:
+    from aiohttp import ClientSession
+
+AsyncResponse = namedtuple("AsyncResponse", ["status_code", "headers", "content"])
+
+
+class AsyncHTTPClient:
+    """
+    aiohttp client of the asyncio engine, the counterpart of the shared
+    HTTPTransport sessions: one connection pool per client with at most
+    pool_size connections per host, DNS answers kept HTTP_DNS_CACHE_TTL
+    seconds and gzip bodies. Throttled and failed calls are retried
+    with a RetryPolicy whose waits let the other coroutines run. Calls
+    are timed, counted, traced and go through the cassette like the
+    ones of the synchronous clients. The session is opened by the first
+    call, in the running event loop, and closed by close().
+    """
+
+    def __init__(
+        self,
+        client: str,
+        headers: Mapping[str, str],
+        policy: Optional[RetryPolicy] = None,
+        cassette: Cassette = run_cassette,
+        pool_size: int = settings.http_pool_size,
+        timeout: int = settings.http_timeout,
+    ) -> None:
+        self.client = client
+        self.headers = dict(headers)
+        self.policy = policy if policy else RetryPolicy()
+        self.cassette = cassette
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._session: Optional["ClientSession"] = None
+
+    def __str__(self) -> str:
+        return "<AsyncHTTPClient>"
+
+    def _get_session(self) -> "ClientSession":
+        if self._session is None:
+            import aiohttp
+
+            self._session = aiohttp.ClientSession(
+                headers=self.headers,
+                connector=aiohttp.TCPConnector(
+                    limit=0,
+                    limit_per_host=self.pool_size,
+                    ttl_dns_cache=settings.http_dns_cache_ttl or None,
+                ),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    async def fetch(
+        self, method: str, url: str, body: Optional[str] = None
+    ) -> AsyncResponse:
+        """
+        Sends a single request, without retries, metrics or cassette.
+        """
+        headers = {"Content-Type": "application/json"} if body is not None else None
+        async with self._get_session().request(
+            method, url, data=body, headers=headers
+        ) as response:
+            return AsyncResponse(
+                response.status, dict(response.headers), await response.read()
+            )
+
+    async def _send(self, method: str, url: str, body: Optional[str]) -> AsyncResponse:
+        path = get_request_path(url)
+        key = self.cassette.get_key(self.client, method, path, body)
+        with track_request(self.client, get_endpoint(method, path)) as tracked:
+            if self.cassette.replaying:
+                interaction = await self.cassette.async_play(key)
+                response = AsyncResponse(
+                    interaction["status_code"],
+                    interaction["headers"],
+                    (interaction["body"] or "").encode(),
+                )
+            else:
+                start_time = time.monotonic()
+                response = await self.fetch(method, url, body)
+                self.cassette.record(
+                    key,
+                    response.status_code,
+                    response.headers,
+                    response.content.decode("utf-8", "replace"),
+                    time.monotonic() - start_time,
+                )
+            tracked["status"] = str(response.status_code)
+            tracked["size"] = get_size(body) + get_size(response.content)
+        return response
+
+    async def request(self, method: str, url: str, data: Any = None) -> AsyncResponse:
+        """
+        Sends data as a json body and retries the throttled and failed
+        calls. The last response is returned once the retries are over.
+        """
+        body = json_codec.dumps(data) if data is not None else None
+        path = get_request_path(url)
+        endpoint = get_endpoint(method, path)
+        with tracer.start_span(
+            "{} {}".format(self.client, endpoint),
+            SPAN_KIND_CLIENT,
+            {"http.route": endpoint},
+        ) as span:
+            attempt = 0
+            while True:
+                span.set_attribute("g2s.retries", attempt)
+                await self.policy.async_throttle()
+                response = await self._send(method, url, body)
+                span.set_attribute("http.status_code", response.status_code)
+                self.policy.observe(response.headers)
+                if not await self.policy.async_wait(
+                    "{} {}".format(method, path),
+                    response.status_code,
+                    response.headers,
+                    attempt,
+                    method,
+                ):
+                    if response.status_code >= 400:
+                        span.set_error("Returned {}".format(response.status_code))
+                    return response
+                attempt += 1
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
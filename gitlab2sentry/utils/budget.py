@@ -0,0 +1,145 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import defaultdict, deque
+from typing import Deque, Dict, Iterable, Optional
+
+from gitlab2sentry.resources import settings
+from gitlab2sentry.utils.retry import RunDeadline, run_deadline
+
+
+class WriteBudget:
+    """
+    Caps the MRs opened by a run: in total, per group and per minute.
+    A limit of 0 means no limit.
+    """
+
+    def __init__(
+        self,
+        per_run: int = settings.budget_mrs_per_run,
+        per_group: int = settings.budget_mrs_per_group,
+        per_minute: int = settings.budget_mrs_per_minute,
+        deadline: RunDeadline = run_deadline,
+    ) -> None:
+        self.per_run = per_run
+        self.per_group = per_group
+        self.per_minute = per_minute
+        self.deadline = deadline
+        self.spent = 0
+        self.spent_per_group: Dict[str, int] = defaultdict(int)
+        self._last_minute: Deque[float] = deque()
+
+    def __str__(self) -> str:
+        return "<WriteBudget>"
+
+    def allows(self, group_name: str) -> bool:
+        if self.per_run and self.spent >= self.per_run:
+            return False
+        if self.per_group and self.spent_per_group[group_name] >= self.per_group:
+            return False
+        return True
+
+    def get_rate_wait(self) -> Optional[float]:
+        """
+        Seconds until the per minute rate allows a new MR, None when
+        waiting would go past the run deadline.
+        """
+        if not self.per_minute:
+            return 0.0
+        while self._last_minute and self._last_minute[0] <= time.monotonic() - 60:
+            self._last_minute.popleft()
+        if len(self._last_minute) < self.per_minute:
+            return 0.0
+        wait_time = self._last_minute[0] + 60 - time.monotonic()
+        remaining = self.deadline.remaining()
+        if remaining is not None and wait_time >= remaining:
+            return None
+        logging.info(
+            "{}: {} MRs per minute reached, waiting {}s".format(
+                self.__str__(), self.per_minute, round(wait_time, 2)
+            )
+        )
+        return wait_time
+
+    def wait_for_rate(self) -> bool:
+        """
+        Sleeps until the per minute rate allows a new MR. Returns False
+        when waiting would go past the run deadline.
+        """
+        wait_time = self.get_rate_wait()
+        if wait_time is None:
+            return False
+        if wait_time:
+            time.sleep(wait_time)
+            self._last_minute.popleft()
+        return True
+
+    async def async_wait_for_rate(self) -> bool:
+        wait_time = self.get_rate_wait()
+        if wait_time is None:
+            return False
+        if wait_time:
+            await asyncio.sleep(wait_time)
+            self._last_minute.popleft()
+        return True
+
+    def consume(self, group_name: str) -> None:
+        self.spent += 1
+        self.spent_per_group[group_name] += 1
+        self._last_minute.append(time.monotonic())
+
+
+class Backlog:
+    """
+    Projects deferred by a run (write budget or deadline) with the time
+    they were first deferred. The next run handles them before the
+    projects of the same kind. An empty path keeps it in memory only.
+    """
+
+    def __init__(self, path: str = settings.budget_backlog_path) -> None:
+        self.path = path
+        self.deferred_at: Dict[int, float] = self._load()
+
+    def __str__(self) -> str:
+        return "<Backlog>"
+
+    def _load(self) -> Dict[int, float]:
+        if not (self.path and os.path.exists(self.path)):
+            return dict()
+        try:
+            with open(self.path) as backlog_file:
+                return {
+                    int(pid): deferred_at
+                    for pid, deferred_at in json.load(backlog_file).items()
+                }
+        except (ValueError, AttributeError) as load_err:
+            logging.warning(
+                "{}: Ignoring unreadable backlog: {}".format(
+                    self.__str__(), str(load_err)
+                )
+            )
+            return dict()
+
+    def __contains__(self, pid: int) -> bool:
+        return pid in self.deferred_at
+
+    def __len__(self) -> int:
+        return len(self.deferred_at)
+
+    def get_deferred_at(self, pid: int) -> float:
+        return self.deferred_at.get(pid, time.time())
+
+    def save(self, deferred_pids: Iterable[int]) -> None:
+        """
+        Keeps the projects deferred by this run only: handled ones and
+        the ones that are not pending anymore leave the backlog.
+        """
+        self.deferred_at = {pid: self.get_deferred_at(pid) for pid in deferred_pids}
+        if not self.path:
+            return
+        tmp_path = "{}.tmp".format(self.path)
+        with open(tmp_path, "w") as backlog_file:
+            json.dump(self.deferred_at, backlog_file)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,195 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import defaultdict, deque
+from typing import IO, Any, Deque, Dict, Mapping, Optional, Union
+from urllib.parse import urlsplit
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from gitlab2sentry.exceptions import CassetteInteractionNotFound
+from gitlab2sentry.resources import settings
+
+CASSETTE_RECORD = "record"
+CASSETTE_REPLAY = "replay"
+
+
+class Cassette:
+    """
+    Gzipped recording (one json interaction per line) of the API
+    responses of a run: GraphQL pages, Sentry and GitLab REST calls.
+    A replayed run gets, for each request, the recorded responses in
+    their original order, either as fast as possible or after the
+    recorded duration of each call (realtime). A request whose body
+    changed (e.g. another Sentry URL in a file) gets the next response
+    recorded for the same method and path. An empty path or mode
+    disables it. Each run of a long-running process (per_run) records
+    its own cassette, suffixed with the time of its first call, and
+    replays the whole path again.
+    """
+
+    def __init__(
+        self,
+        path: str = settings.cassette_path,
+        mode: str = settings.cassette_mode,
+        realtime: bool = settings.cassette_realtime,
+        per_run: bool = bool(settings.run_interval),
+    ) -> None:
+        self.path = path
+        self.mode = mode if path else ""
+        self.realtime = realtime
+        self.per_run = per_run
+        self._file: Optional[IO[str]] = None
+        self._interactions: Optional[Dict[str, Deque[Dict[str, Any]]]] = None
+
+    def __str__(self) -> str:
+        return "<Cassette>"
+
+    @property
+    def recording(self) -> bool:
+        return self.mode == CASSETTE_RECORD
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == CASSETTE_REPLAY
+
+    def get_key(
+        self, client: str, method: str, path: str, body: Union[str, bytes, None] = None
+    ) -> str:
+        # Hosts are left out so that a recording replays against any URL
+        return "{} {} {} {}".format(
+            client,
+            method.upper(),
+            path,
+            hashlib.sha1(_get_canonical_body(body)).hexdigest()[:16],
+        )
+
+    def record(
+        self,
+        key: str,
+        status_code: int,
+        headers: Optional[Mapping[str, str]],
+        body: Any,
+        elapsed: float,
+    ) -> None:
+        if not self.recording:
+            return
+        if self._file is None:
+            self._file = gzip.open(self._get_record_path(), "wt")
+        self._file.write(
+            json.dumps(
+                {
+                    "key": key,
+                    "status_code": status_code,
+                    "headers": dict(headers or {}),
+                    "body": body,
+                    "elapsed": round(elapsed, 6),
+                }
+            )
+            + "\n"
+        )
+
+    def _get_record_path(self) -> str:
+        if not self.per_run:
+            return self.path
+        # run.jsonl.gz -> run.jsonl-20240101T000000Z.gz
+        root, ext = os.path.splitext(self.path)
+        path = "{}-{}{}".format(
+            root, time.strftime("%Y%m%dT%H%M%SZ", time.gmtime()), ext
+        )
+        logging.info("{}: Recording the run in {}".format(self.__str__(), path))
+        return path
+
+    def _load(self) -> Dict[str, Deque[Dict[str, Any]]]:
+        interactions: Dict[str, Deque[Dict[str, Any]]] = defaultdict(deque)
+        with gzip.open(self.path, "rt") as cassette_file:
+            try:
+                for line in cassette_file:
+                    interaction = json.loads(line)
+                    interactions[_get_request(interaction["key"])].append(interaction)
+            except (EOFError, json.JSONDecodeError):
+                # Recording of a killed run
+                logging.warning(
+                    "{}: Cassette {} is truncated".format(self.__str__(), self.path)
+                )
+        return interactions
+
+    def _next(self, key: str) -> Dict[str, Any]:
+        if self._interactions is None:
+            self._interactions = self._load()
+        interactions = self._interactions.get(_get_request(key))
+        if not interactions:
+            raise CassetteInteractionNotFound(key)
+        interaction = next(
+            (item for item in interactions if item["key"] == key), interactions[0]
+        )
+        interactions.remove(interaction)
+        return interaction
+
+    def play(self, key: str) -> Dict[str, Any]:
+        interaction = self._next(key)
+        if self.realtime:
+            time.sleep(interaction["elapsed"])
+        return interaction
+
+    async def async_play(self, key: str) -> Dict[str, Any]:
+        # play for the asyncio engine: other calls are replayed meanwhile
+        interaction = self._next(key)
+        if self.realtime:
+            await asyncio.sleep(interaction["elapsed"])
+        return interaction
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        # The next run replays the cassette from its start
+        self._interactions = None
+
+
+def _get_canonical_body(body: Union[str, bytes, None]) -> bytes:
+    """
+    Body digested in the keys: json bodies are sorted and a null one is
+    no body, so that the keys of a call do not depend on the client
+    (python-gitlab, requests or aiohttp) or the engine sending it.
+    """
+    if not body:
+        return b""
+    try:
+        data = json.loads(body)
+    except (UnicodeDecodeError, ValueError):
+        return body.encode() if isinstance(body, str) else body
+    if data is None:
+        return b""
+    return json.dumps(data, sort_keys=True).encode()
+
+
+def _get_request(key: str) -> str:
+    # Key without the body digest
+    return key.rsplit(" ", 1)[0]
+
+
+def get_request_path(url: str) -> str:
+    parts = urlsplit(url)
+    return "{}?{}".format(parts.path, parts.query) if parts.query else parts.path
+
+
+def get_response(
+    interaction: Dict[str, Any], request: Optional[requests.PreparedRequest] = None
+) -> requests.Response:
+    response = requests.Response()
+    response.status_code = interaction["status_code"]
+    response.headers = CaseInsensitiveDict(interaction["headers"])
+    response._content = (interaction["body"] or "").encode()
+    response.encoding = "utf-8"
+    response.request = request  # type: ignore
+    response.url = request.url if request else ""  # type: ignore
+    return response
+
+
+run_cassette = Cassette()
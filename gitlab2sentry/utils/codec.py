@@ -0,0 +1,55 @@
+import json
+import logging
+from typing import Any, Union
+
+from gitlab2sentry.resources import settings
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore
+
+JSON_BACKEND_AUTO = "auto"
+JSON_BACKEND_ORJSON = "orjson"
+JSON_BACKEND_STDLIB = "json"
+
+
+class JSONCodec:
+    """
+    JSON backend of the API clients: orjson when it is installed (or
+    asked for with JSON_BACKEND=orjson), the standard library otherwise
+    or with JSON_BACKEND=json. Both raise json.JSONDecodeError on an
+    invalid document, orjson's error being a subclass of it.
+    """
+
+    def __init__(self, backend: str = settings.json_backend) -> None:
+        self.backend = self._get_backend(backend)
+
+    def __str__(self) -> str:
+        return "<JSONCodec>"
+
+    def _get_backend(self, backend: str) -> str:
+        if backend == JSON_BACKEND_STDLIB:
+            return JSON_BACKEND_STDLIB
+        if orjson is None:
+            if backend == JSON_BACKEND_ORJSON:
+                logging.warning(
+                    "{}: orjson is not installed, using json".format(self.__str__())
+                )
+            return JSON_BACKEND_STDLIB
+        return JSON_BACKEND_ORJSON
+
+    def loads(self, document: Union[bytes, str]) -> Any:
+        if self.backend == JSON_BACKEND_ORJSON:
+            return orjson.loads(document)
+        return json.loads(document)
+
+    def dumps(self, value: Any, sort_keys: bool = False) -> str:
+        if self.backend == JSON_BACKEND_ORJSON:
+            return orjson.dumps(
+                value, option=orjson.OPT_SORT_KEYS if sort_keys else None
+            ).decode()
+        return json.dumps(value, sort_keys=sort_keys)
+
+
+json_codec = JSONCodec()
@@ -0,0 +1,74 @@
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, Optional
+
+from gitlab2sentry.resources import settings
+
+
+class DSNCache:
+    """
+    Sentry project slug -> key id, public DSN and the rate limit set
+    on the key by a previous run. An entry younger than max_age hours
+    answers a DSN MR without any Sentry call; older ones are checked
+    again against Sentry. An empty path keeps it in memory only.
+    """
+
+    def __init__(
+        self,
+        path: str = settings.sentry_dsn_cache_path,
+        max_age: int = settings.sentry_dsn_cache_max_age,
+    ) -> None:
+        self.path = path
+        self.max_age = max_age
+        self.keys: Dict[str, Dict[str, Any]] = self._load()
+
+    def __str__(self) -> str:
+        return "<DSNCache>"
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        if not (self.path and os.path.exists(self.path)):
+            return dict()
+        try:
+            with open(self.path) as cache_file:
+                return dict(json.load(cache_file))
+        except (ValueError, TypeError) as load_err:
+            logging.warning(
+                "{}: Ignoring unreadable DSN cache: {}".format(
+                    self.__str__(), str(load_err)
+                )
+            )
+            return dict()
+
+    def get(self, project_slug: str, rate_limit: Dict[str, int]) -> Optional[str]:
+        """
+        DSN of the project when its key was checked less than max_age
+        hours ago with the same rate limit, None otherwise.
+        """
+        key = self.keys.get(project_slug)
+        if (
+            not key
+            or key["rate_limit"] != rate_limit
+            or time.time() - key["validated_at"] > self.max_age * 3600
+        ):
+            return None
+        return key["dsn"]
+
+    def set(
+        self, project_slug: str, key_id: str, dsn: str, rate_limit: Dict[str, int]
+    ) -> None:
+        self.keys[project_slug] = {
+            "key_id": key_id,
+            "dsn": dsn,
+            "rate_limit": rate_limit,
+            "validated_at": time.time(),
+        }
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        tmp_path = "{}.tmp".format(self.path)
+        with open(tmp_path, "w") as cache_file:
+            json.dump(self.keys, cache_file)
+        os.replace(tmp_path, self.path)
@@ -1,17 +1,56 @@
+import asyncio
+import itertools
 import logging
 import time
 from datetime import datetime, timedelta
-from typing import Any, Dict, Generator, Optional
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncGenerator,
+    Dict,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
+from urllib.parse import quote
 
-import aiohttp
-from gitlab import Gitlab
-from gitlab.exceptions import GitlabGetError
-from gitlab.v4.objects import Project
-from gql import Client, gql
-from gql.transport.aiohttp import AIOHTTPTransport
-from gql.transport.aiohttp import log as websockets_logger
+import requests
 
-from gitlab2sentry.resources import G2SProject, settings
+from gitlab2sentry.exceptions import (
+    GitlabAuthenticationFailed,
+    GitlabRequestFailed,
+    GraphQLQueryFailed,
+    GraphQLRequestFailed,
+    RetryLimitExceeded,
+)
+from gitlab2sentry.resources import (
+    GRAPHQL_MAX_PAGE_LENGTH,
+    GRAPHQL_PROJECT_PREFILTERS,
+    G2SProject,
+    settings,
+)
+from gitlab2sentry.utils.accounting import get_size
+from gitlab2sentry.utils.async_http import AsyncHTTPClient, AsyncResponse
+from gitlab2sentry.utils.cassette import Cassette, run_cassette
+from gitlab2sentry.utils.codec import json_codec
+from gitlab2sentry.utils.journal import RunJournal
+from gitlab2sentry.utils.json_stream import STREAM_CHUNK_SIZE, JSONArrayStream
+from gitlab2sentry.utils.metrics import track_request
+from gitlab2sentry.utils.retry import RetryPolicy, RetrySession, is_retryable
+from gitlab2sentry.utils.tracing import SPAN_KIND_CLIENT, Span, tracer
+from gitlab2sentry.utils.transport import http_transport
+
+# python-gitlab is imported by the first MR to create
+if TYPE_CHECKING:
+    from gitlab import Gitlab
+    from gitlab.v4.objects import Project
 
 
 class GraphQLClient:
@@ -19,66 +58,432 @@ class GraphQLClient:
         self,
         url: Optional[str] = settings.gitlab_url,
         token: Optional[str] = settings.gitlab_token,
+        cassette: Cassette = run_cassette,
     ):
-        self._client = Client(
-            transport=self._get_transport(url, token),
-            fetch_schema_from_transport=True,
-            execute_timeout=settings.gitlab_graphql_timeout,
+        self._retry_policy = RetryPolicy()
+        self._cassette = cassette
+        self._response_headers: Optional[Mapping[str, str]] = None
+        self._url = "{}/{}".format(url, settings.gitlab_graphql_suffix)
+        self._session = http_transport.get_session(
+            {"PRIVATE-TOKEN": token or "", "Content-Type": "application/json"}
         )
-        websockets_logger.setLevel(logging.WARNING)
+        self.prefilters = self._get_prefilters()
 
     def __str__(self) -> str:
         return "<GraphQLClient>"
 
-    def _get_transport(
-        self, url: Optional[str], token: Optional[str]
-    ) -> AIOHTTPTransport:
-        return AIOHTTPTransport(
-            url="{}/{}".format(url, settings.gitlab_graphql_suffix),
-            headers={
-                "PRIVATE-TOKEN": token,  # type: ignore
-                "Content-Type": "application/json",
-            },
+    def _get_prefilters(self) -> List[str]:
+        prefilters = list()
+        for name in settings.gitlab_project_prefilters:
+            if name in GRAPHQL_PROJECT_PREFILTERS:
+                prefilters.append(name)
+            else:
+                logging.warning(
+                    "{}: Ignoring unknown project prefilter {}".format(
+                        self.__str__(), name
+                    )
+                )
+        return prefilters
+
+    def _get_prefilter_statement(self, prefilters: Iterable[str]) -> str:
+        return "".join(
+            " {}".format(GRAPHQL_PROJECT_PREFILTERS[name]) for name in prefilters
         )
 
-    def _query(self, name: str, query: str) -> Dict[str, Any]:
-        try:
-            start_time = time.time()
-            result = self._client.execute(gql(query))
-            logging.info(
-                "{}: Query {} execution_time: {}s".format(  # noqa
-                    self.__str__(), name, round(time.time() - start_time, 2)
+    def _post(self, query: str, stream: bool = False) -> requests.Response:
+        return self._session.post(
+            self._url,
+            data=json_codec.dumps({"query": query}),
+            stream=stream,
+            timeout=settings.gitlab_graphql_timeout,
+        )
+
+    def _get_data(self, document: Dict[str, Any]) -> Dict[str, Any]:
+        if document.get("errors"):
+            raise GraphQLQueryFailed(
+                "; ".join(error.get("message", "") for error in document["errors"])
+            )
+        return document.get("data") or dict()
+
+    def _play(self, key: str, query: str, tracked: Dict[str, Any]) -> Dict[str, Any]:
+        return self._read_interaction(self._cassette.play(key), query, tracked)
+
+    def _read_interaction(
+        self, interaction: Dict[str, Any], query: str, tracked: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        self._response_headers = interaction["headers"]
+        tracked["status"] = str(interaction["status_code"])
+        tracked["size"] = get_size(query) + self._get_response_size()
+        if interaction["status_code"] != 200:
+            raise GraphQLRequestFailed(
+                interaction["status_code"], self._response_headers
+            )
+        return interaction["body"]
+
+    def _read(
+        self,
+        key: str,
+        query: str,
+        http_response: Union[requests.Response, AsyncResponse],
+        start_time: float,
+        tracked: Dict[str, Any],
+    ) -> Dict[str, Any]:
+        self._response_headers = http_response.headers
+        tracked["status"] = str(http_response.status_code)
+        tracked["size"] = get_size(query) + get_size(http_response.content)
+        if http_response.status_code != 200:
+            self._record(key, http_response.status_code, None, start_time)
+            raise GraphQLRequestFailed(
+                http_response.status_code, self._response_headers
+            )
+        result = self._get_data(json_codec.loads(http_response.content))
+        self._record(key, 200, result, start_time)
+        return result
+
+    def _execute(self, query: str, endpoint: str = "graphql") -> Dict[str, Any]:
+        key = self._cassette.get_key("graphql", "POST", "", query)
+        self._response_headers = None
+        with track_request("graphql", endpoint) as response:
+            if self._cassette.replaying:
+                return self._play(key, query, response)
+            start_time = time.monotonic()
+            http_response = self._post(query)
+            return self._read(key, query, http_response, start_time, response)
+
+    def _execute_stream(
+        self, query: str, endpoint: str, path: Sequence[str]
+    ) -> JSONArrayStream:
+        """
+        Streamed variant of _execute: the response is decoded while it is
+        read, one item of the array at path at a time. Cassettes keep
+        whole documents, so recorded and replayed runs go through _execute.
+        """
+        if self._cassette.recording or self._cassette.replaying:
+            return JSONArrayStream.from_value(
+                {"data": self._execute(query, endpoint)}, path
+            )
+        self._response_headers = None
+        # Timed until the headers: the body is read by the caller
+        with track_request("graphql", endpoint) as response:
+            http_response = self._post(query, stream=True)
+            self._response_headers = http_response.headers
+            response["status"] = str(http_response.status_code)
+            response["size"] = get_size(query) + self._get_response_size()
+        if http_response.status_code != 200:
+            http_response.close()
+            raise GraphQLRequestFailed(
+                http_response.status_code, self._response_headers
+            )
+        return JSONArrayStream(http_response.iter_content(STREAM_CHUNK_SIZE), path)
+
+    def _get_response_size(self) -> int:
+        # Streamed and replayed bodies are not at hand
+        for header, value in (self._response_headers or {}).items():
+            if header.lower() == "content-length":
+                return int(value)
+        return 0
+
+    def _record(
+        self,
+        key: str,
+        status_code: int,
+        result: Any,
+        start_time: float,
+    ) -> None:
+        self._cassette.record(
+            key,
+            status_code,
+            self._response_headers,
+            result,
+            time.monotonic() - start_time,
+        )
+
+    def _query(
+        self,
+        name: str,
+        query: str,
+        endpoint: str = "graphql",
+        stream_path: Optional[Sequence[str]] = None,
+    ) -> Any:
+        with tracer.start_span(
+            endpoint, SPAN_KIND_CLIENT, {"graphql.operation.name": name}
+        ) as span:
+            return self._query_with_retries(name, query, endpoint, span, stream_path)
+
+    def _query_with_retries(
+        self,
+        name: str,
+        query: str,
+        endpoint: str,
+        span: Span,
+        stream_path: Optional[Sequence[str]] = None,
+    ) -> Any:
+        attempt = 0
+        while True:
+            span.set_attribute("g2s.retries", attempt)
+            try:
+                self._retry_policy.throttle()
+                start_time = time.time()
+                result = (
+                    self._execute_stream(query, endpoint, stream_path)
+                    if stream_path
+                    else self._execute(query, endpoint)
+                )
+                self._retry_policy.observe(self._response_headers)
+                logging.info(
+                    "{}: Query {} execution_time: {}s".format(  # noqa
+                        self.__str__(), name, round(time.time() - start_time, 2)
+                    )
                 )
+                span.set_attribute("http.status_code", 200)
+                return result
+            except GraphQLRequestFailed as request_err:
+                status_code = request_err.status_code
+                headers = request_err.headers
+
+            self._check_failure(name, status_code, span)
+            if not self._retry_policy.wait(
+                "Query {}".format(name), status_code, headers, attempt
+            ):
+                self._give_up(name, status_code, span)
+                return {}
+            attempt += 1
+
+    def _check_failure(self, name: str, status_code: Optional[int], span: Span) -> None:
+        span.set_attribute("http.status_code", status_code)
+        # The token is checked by the first query, not by a call of its own
+        if status_code == 401:
+            span.set_error("Returned 401")
+            raise GitlabAuthenticationFailed(
+                "{}: Query {} - Invalid Gitlab token".format(self.__str__(), name)
             )
-            return result
-        except aiohttp.client_exceptions.ClientResponseError:
-            logging.warning("{}: Query {} - Returned 404".format(self.__str__(), name))
-            return {}
 
-    def project_fetch_query(self, query_dict: Dict[str, str]) -> Dict[str, Any]:
-        project_full_path = f"{query_dict['full_path']}"
+    def _give_up(self, name: str, status_code: Optional[int], span: Span) -> None:
+        logging.warning(
+            "{}: Query {} - Returned {}".format(self.__str__(), name, status_code)
+        )
+        span.set_error("Returned {}".format(status_code))
+
+    def _get_mr_statement(self, branch_name: str) -> str:
+        # Only the latest MR of the branch tells where the project stands
+        return '(sourceBranches: ["{}"] sort: CREATED_DESC first: 1)'.format(
+            branch_name
+        )
+
+    def _format_query(self, query_dict: Dict[str, str], statement: str) -> str:
         blobsPaths = '(paths: "{}")'.format(settings.sentryclirc_filepath)
-        titlesListMRs = '(sourceBranches: ["{}","{}"])'.format(
-            settings.sentryclirc_branch_name, settings.dsn_branch_name
+        return query_dict["body"] % (
+            statement,
+            blobsPaths,
+            self._get_mr_statement(settings.sentryclirc_branch_name),
+            self._get_mr_statement(settings.dsn_branch_name),
         )
-        query = query_dict["body"] % (project_full_path, blobsPaths, titlesListMRs)
-        return self._query(query_dict["name"], query)
 
-    def project_list_query(
+    def project_fetch_query(self, query_dict: Dict[str, str]) -> Dict[str, Any]:
+        project_full_path = f"{query_dict['full_path']}"
+        query = self._format_query(query_dict, project_full_path)
+        return self._query(query_dict["name"], query, "graphql fetch_project")
+
+    def _get_project_list_query(
         self, query_dict: Dict[str, str], endCursor: str
-    ) -> Dict[str, Any]:
-        whereStatement = ' searchNamespaces: true sort: "createdAt_desc"'
+    ) -> str:
+        whereStatement = ' searchNamespaces: true sort: "createdAt_desc"{}'.format(
+            self._get_prefilter_statement(self.prefilters)
+        )
         edgesStatement = "(first: {}{}{})".format(
             settings.gitlab_graphql_page_length,
             f' after: "{endCursor}"' if endCursor else "",
             whereStatement,
         )
-        blobsPaths = '(paths: "{}")'.format(settings.sentryclirc_filepath)
-        titlesListMRs = '(sourceBranches: ["{}","{}"])'.format(
-            settings.sentryclirc_branch_name, settings.dsn_branch_name
+        return self._format_query(query_dict, edgesStatement)
+
+    def _get_project_ids_query(
+        self, query_dict: Dict[str, str], pids: Sequence[int]
+    ) -> str:
+        edgesStatement = "(first: {} ids: [{}]{})".format(
+            len(pids),
+            ",".join('"gid://gitlab/Project/{}"'.format(pid) for pid in pids),
+            self._get_prefilter_statement(self.prefilters),
         )
-        query = query_dict["body"] % (edgesStatement, blobsPaths, titlesListMRs)
-        return self._query(query_dict["name"], query)
+        return self._format_query(query_dict, edgesStatement)
+
+    def project_ids_query(
+        self, query_dict: Dict[str, str], pids: Sequence[int]
+    ) -> Dict[str, Any]:
+        return self._query(
+            query_dict["name"],
+            self._get_project_ids_query(query_dict, pids),
+            "graphql list_projects_by_id",
+        )
+
+    def project_list_query(
+        self, query_dict: Dict[str, str], endCursor: str
+    ) -> Dict[str, Any]:
+        return self._query(
+            query_dict["name"],
+            self._get_project_list_query(query_dict, endCursor),
+            "graphql list_projects",
+        )
+
+    def _get_prefilter_counts_query(self) -> str:
+        countStatement = "    %s: projects(searchNamespaces: true%s) { count }"
+        fields = [
+            countStatement % ("total", self._get_prefilter_statement(self.prefilters))
+        ]
+        # Without each prefilter in turn: the difference is what it saves
+        for name in self.prefilters:
+            fields.append(
+                countStatement
+                % (
+                    name,
+                    self._get_prefilter_statement(
+                        other for other in self.prefilters if other != name
+                    ),
+                )
+            )
+        return "{\n%s\n}" % "\n".join(fields)
+
+    def project_prefilter_counts_query(self) -> Dict[str, Any]:
+        return self._query(
+            "PREFILTER_COUNTS_QUERY",
+            self._get_prefilter_counts_query(),
+            "graphql count_projects",
+        )
+
+    def project_list_stream(
+        self, query_dict: Dict[str, str], endCursor: str
+    ) -> JSONArrayStream:
+        path = ("data", query_dict["instance"], "edges")
+        result = self._query(
+            query_dict["name"],
+            self._get_project_list_query(query_dict, endCursor),
+            "graphql list_projects",
+            path,
+        )
+        # A query failing after its retries gives an empty page
+        return (
+            result
+            if isinstance(result, JSONArrayStream)
+            else JSONArrayStream.from_value(dict(), path)
+        )
+
+
+class AsyncGraphQLClient(GraphQLClient):
+    """
+    GraphQLClient of the asyncio engine: same queries, retries and
+    cassette entries, sent with an AsyncHTTPClient. Pages are decoded
+    whole, GITLAB_GRAPHQL_STREAMING only applies to the synchronous
+    engine.
+    """
+
+    def __init__(
+        self,
+        url: Optional[str] = settings.gitlab_url,
+        token: Optional[str] = settings.gitlab_token,
+        cassette: Cassette = run_cassette,
+    ):
+        super().__init__(url, token, cassette)
+        self._http = AsyncHTTPClient(
+            "graphql",
+            {"PRIVATE-TOKEN": token or ""},
+            self._retry_policy,
+            cassette,
+            timeout=settings.gitlab_graphql_timeout,
+        )
+
+    def __str__(self) -> str:
+        return "<AsyncGraphQLClient>"
+
+    async def _play(  # type: ignore[override]
+        self, key: str, query: str, tracked: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        # The recorded duration is awaited, the other queries go on
+        return self._read_interaction(
+            await self._cassette.async_play(key), query, tracked
+        )
+
+    async def _execute(  # type: ignore[override]
+        self, query: str, endpoint: str = "graphql"
+    ) -> Dict[str, Any]:
+        key = self._cassette.get_key("graphql", "POST", "", query)
+        self._response_headers = None
+        with track_request("graphql", endpoint) as response:
+            if self._cassette.replaying:
+                return await self._play(key, query, response)
+            start_time = time.monotonic()
+            http_response = await self._http.fetch(
+                "POST", self._url, json_codec.dumps({"query": query})
+            )
+            return self._read(key, query, http_response, start_time, response)
+
+    async def _query(  # type: ignore[override]
+        self, name: str, query: str, endpoint: str = "graphql"
+    ) -> Any:
+        with tracer.start_span(
+            endpoint, SPAN_KIND_CLIENT, {"graphql.operation.name": name}
+        ) as span:
+            attempt = 0
+            while True:
+                span.set_attribute("g2s.retries", attempt)
+                try:
+                    await self._retry_policy.async_throttle()
+                    start_time = time.time()
+                    result = await self._execute(query, endpoint)
+                    self._retry_policy.observe(self._response_headers)
+                    logging.info(
+                        "{}: Query {} execution_time: {}s".format(
+                            self.__str__(), name, round(time.time() - start_time, 2)
+                        )
+                    )
+                    span.set_attribute("http.status_code", 200)
+                    return result
+                except GraphQLRequestFailed as request_err:
+                    status_code = request_err.status_code
+                    headers = request_err.headers
+
+                self._check_failure(name, status_code, span)
+                if not await self._retry_policy.async_wait(
+                    "Query {}".format(name), status_code, headers, attempt
+                ):
+                    self._give_up(name, status_code, span)
+                    return {}
+                attempt += 1
+
+    async def project_fetch_query(  # type: ignore[override]
+        self, query_dict: Dict[str, str]
+    ) -> Dict[str, Any]:
+        query = self._format_query(query_dict, f"{query_dict['full_path']}")
+        return await self._query(query_dict["name"], query, "graphql fetch_project")
+
+    async def project_ids_query(  # type: ignore[override]
+        self, query_dict: Dict[str, str], pids: Sequence[int]
+    ) -> Dict[str, Any]:
+        return await self._query(
+            query_dict["name"],
+            self._get_project_ids_query(query_dict, pids),
+            "graphql list_projects_by_id",
+        )
+
+    async def project_list_query(  # type: ignore[override]
+        self, query_dict: Dict[str, str], endCursor: str
+    ) -> Dict[str, Any]:
+        return await self._query(
+            query_dict["name"],
+            self._get_project_list_query(query_dict, endCursor),
+            "graphql list_projects",
+        )
+
+    async def project_prefilter_counts_query(  # type: ignore[override]
+        self,
+    ) -> Dict[str, Any]:
+        return await self._query(
+            "PREFILTER_COUNTS_QUERY",
+            self._get_prefilter_counts_query(),
+            "graphql count_projects",
+        )
+
+    async def close(self) -> None:
+        await self._http.close()
 
 
 class GitlabProvider:
@@ -86,19 +491,38 @@ class GitlabProvider:
         self,
         url: Optional[str] = settings.gitlab_url,
         token: Optional[str] = settings.gitlab_token,
+        journal: Optional[RunJournal] = None,
     ) -> None:
-        self.gitlab = self._get_gitlab(url, token)
-        self._gql_client = GraphQLClient(url, token)
+        self._url = url
+        self._token = token
+        self._gitlab: Optional["Gitlab"] = None
+        self._gql_client = self._get_graphql_client(url, token)
         self.update_limit = self._get_update_limit()
+        self.journal = journal if journal else RunJournal("")
+        self.end_cursor = ""
+        self.update_limit_reached = False
+        # Ids of the batches GitLab answered, deleted projects included
+        self.refreshed_pids: Set[int] = set()
 
     def __str__(self) -> str:
         return "<GitlabProvider>"
 
-    def _get_gitlab(self, url: Optional[str], token: Optional[str]) -> Gitlab:
-        gitlab = Gitlab(url, private_token=token)
-        if settings.env != "test":
-            gitlab.auth()
-        return gitlab
+    def _get_graphql_client(
+        self, url: Optional[str], token: Optional[str]
+    ) -> GraphQLClient:
+        return GraphQLClient(url, token)
+
+    @property
+    def gitlab(self) -> "Gitlab":
+        # Only MR creation goes through python-gitlab
+        if self._gitlab is None:
+            self._gitlab = self._get_gitlab(self._url, self._token)
+        return self._gitlab
+
+    def _get_gitlab(self, url: Optional[str], token: Optional[str]) -> "Gitlab":
+        from gitlab import Gitlab
+
+        return Gitlab(url, private_token=token, session=RetrySession(RetryPolicy()))
 
     def _get_update_limit(self) -> Optional[datetime]:
         if settings.gitlab_project_creation_limit:
@@ -115,45 +539,155 @@ class GitlabProvider:
         return self._gql_client.project_fetch_query(query)
 
     def get_all_projects(self, query: Dict[str, Any], endCursor: str = "") -> Generator:
+        if settings.gitlab_graphql_streaming:
+            yield from self._get_streamed_projects(query, endCursor)
+            return
+        self.end_cursor = endCursor
         while True:
-            result = self._gql_client.project_list_query(query, endCursor)
-            if (
-                result
-                and result.get(query["instance"], None)
-                and result[query["instance"]].get("edges", None)
-                and len(result[query["instance"]]["edges"])
+            result = self._gql_client.project_list_query(query, self.end_cursor)
+            result_nodes, has_next_page = self._read_page(query, result)
+            if result_nodes is not None:
+                yield result_nodes
+            if not has_next_page:
+                break
+
+    def _read_page(
+        self, query: Dict[str, Any], result: Optional[Dict[str, Any]]
+    ) -> Tuple[Optional[List[Dict[str, Any]]], bool]:
+        """
+        Nodes of a page of the projects listing created within the limit
+        (None for a page without nodes) and whether the scan goes on.
+        """
+        instance = (result or dict()).get(query["instance"]) or dict()
+        page_info = instance.get("pageInfo") or dict()
+        result_nodes = instance.get("edges")
+        if not result_nodes:
+            return None, bool(page_info.get("hasNextPage"))
+        if page_info.get("endCursor"):
+            # Cursor to resume the scan from once this page is handled
+            self.end_cursor = page_info["endCursor"]
+        # Check the last item of the ordered list to se its creation
+        createdAt = self._from_iso_to_datetime(result_nodes[-1]["node"]["createdAt"])
+        if self.update_limit and createdAt < self.update_limit:
+            return [
+                node
+                for node in result_nodes
+                if self._from_iso_to_datetime(node["node"]["createdAt"])
+                >= self.update_limit
+            ], False
+        return result_nodes, bool(page_info.get("hasNextPage"))
+
+    def get_prefilter_savings(self) -> Dict[str, int]:
+        """
+        Projects of the whole instance, whatever their creation date, kept
+        out of the projects queries by each prefilter alone, from a single
+        query counting the listing with every prefilter and without each
+        one of them. Only counted with GITLAB_PREFILTER_COUNTS, by the
+        first shard.
+        """
+        if not self._counts_prefilters():
+            return dict()
+        return self._get_prefilter_savings(
+            self._gql_client.project_prefilter_counts_query()
+        )
+
+    def _counts_prefilters(self) -> bool:
+        # GitLab has no creation date argument: the count is instance-wide
+        return bool(
+            settings.gitlab_prefilter_counts
+            and settings.shard_index == 0
+            and self._gql_client.prefilters
+        )
+
+    def _get_prefilter_savings(self, result: Dict[str, Any]) -> Dict[str, int]:
+        if not (result and result.get("total")):
+            return dict()
+        return {
+            name: result[name]["count"] - result["total"]["count"]
+            for name in self._gql_client.prefilters
+            if result.get(name)
+        }
+
+    def get_projects_by_ids(
+        self, query: Dict[str, Any], pids: Sequence[int]
+    ) -> Generator:
+        """
+        Pages of the given projects, PENDING_BATCH_SIZE ids per query (at
+        most the GitLab page length), whatever their creation date. Deleted
+        projects are left out. The ids of the answered batches are kept in
+        refreshed_pids, a failed batch is skipped.
+        """
+        batch_size = self._get_batch_size()
+        for start in range(0, len(pids), batch_size):
+            end = start + batch_size
+            result = self._gql_client.project_ids_query(query, pids[start:end])
+            page = self._read_ids_page(query, result, pids[start:end])
+            if page is not None:
+                yield page
+
+    def _read_ids_page(
+        self, query: Dict[str, Any], result: Dict[str, Any], pids: Sequence[int]
+    ) -> Optional[List[Dict[str, Any]]]:
+        if not (result and result.get(query["instance"], None)):
+            return None
+        self.refreshed_pids.update(pids)
+        return result[query["instance"]].get("edges", None) or list()
+
+    def _get_batch_size(self) -> int:
+        # Past the page length, GitLab would drop the ids without an error
+        return max(min(settings.pending_batch_size, GRAPHQL_MAX_PAGE_LENGTH), 1)
+
+    def _iter_recent_nodes(self, nodes: Iterator[Dict[str, Any]]) -> Generator:
+        # Nodes come newest first: the first one past the limit ends the scan
+        for node in nodes:
+            if self.update_limit and (
+                self._from_iso_to_datetime(node["node"]["createdAt"])
+                < self.update_limit
             ):
-                result_nodes = result[query["instance"]]["edges"]
-                # Check the last item of the ordered list to se its creation
-                createdAt = self._from_iso_to_datetime(
-                    result_nodes[len(result_nodes) - 1]["node"]["createdAt"]
+                self.update_limit_reached = True
+                return
+            yield node
+
+    def _get_streamed_projects(
+        self, query: Dict[str, Any], endCursor: str = ""
+    ) -> Generator:
+        """
+        get_all_projects yielding pages as iterators: the nodes of a page
+        are decoded from the response while the caller handles them, so
+        neither the body nor the decoded page are kept in memory.
+        pageInfo comes before the edges in the query, the cursor of a
+        page is then known before its first node.
+        """
+        self.end_cursor = endCursor
+        self.update_limit_reached = False
+        while True:
+            stream = self._gql_client.project_list_stream(query, endCursor)
+            nodes = iter(stream)
+            first_node = next(nodes, None)
+            page_info = stream.get("data", query["instance"], "pageInfo") or dict()
+            if page_info.get("endCursor"):
+                endCursor = page_info["endCursor"]
+                self.end_cursor = endCursor
+            if first_node is None:
+                break
+            page = self._iter_recent_nodes(itertools.chain([first_node], nodes))
+            yield page
+            # Reads what the caller left, down to the end of the response
+            for _ in itertools.chain(page, nodes):
+                pass
+            page_info = stream.get("data", query["instance"], "pageInfo") or dict()
+            if stream.get("errors"):
+                logging.warning(
+                    "{}: Query {} - Returned errors: {}".format(
+                        self.__str__(), query["name"], stream.get("errors")
+                    )
                 )
-                if self.update_limit and createdAt < self.update_limit:
-                    yield [
-                        node
-                        for node in result_nodes
-                        if self._from_iso_to_datetime(node["node"]["createdAt"])
-                        >= self.update_limit
-                    ]
-                    break
-                else:
-                    yield result_nodes
-                if (
-                    result
-                    and result.get(query["instance"], None)
-                    and result[query["instance"]].get("pageInfo", None)
-                    and result[query["instance"]]["pageInfo"].get("endCursor", None)
-                    and result[query["instance"]]["pageInfo"]["endCursor"]
-                ):
-                    endCursor = result[query["instance"]]["pageInfo"]["endCursor"]
-            if not (
-                result
-                and result[query["instance"]].get("pageInfo")
-                and result[query["instance"]]["pageInfo"].get("hasNextPage")
-            ):
+            if self.update_limit_reached or not page_info.get("hasNextPage"):
                 break
 
-    def _get_or_create_branch(self, branch_name: str, project: Project) -> None:
+    def _get_or_create_branch(self, branch_name: str, project: "Project") -> None:
+        from gitlab.exceptions import GitlabGetError
+
         try:
             project.branches.get(branch_name)
             logging.warning(
@@ -169,12 +703,14 @@ class GitlabProvider:
 
     def _get_or_create_sentryclirc(
         self,
-        project: Project,
+        project: "Project",
         full_path: str,
         branch_name: str,
         file_path: str,
         content: str,
     ) -> None:
+        from gitlab.exceptions import GitlabGetError
+
         try:
             f = project.files.get(file_path=file_path, ref=project.default_branch)
             f.content = content
@@ -187,23 +723,30 @@ class GitlabProvider:
                     full_path,
                 )
             )
-            data = {
-                "author_email": settings.gitlab_author_email,
-                "author_name": settings.gitlab_author_name,
-                "branch": branch_name,
-                "commit_message": settings.sentryclirc_com_msg,
-                "content": content,
-                "file_path": file_path,
-            }
-            # When commit signing is enabled in GitLab (e.g. via pre-hook),
-            # commit requires that the author information matches the signer identity
-            # https://gitlab.com/gitlab-org/gitlab/-/merge_requests/150855
-            if settings.gitlab_signed_commit:
-                data.pop("author_email")
-                data.pop("author_name")
-            f = project.files.create(data=data)
-
-    def _get_default_mentions(self, project: Project) -> str:
+            f = project.files.create(
+                data=self._get_new_file_data(branch_name, file_path, content)
+            )
+
+    def _get_new_file_data(
+        self, branch_name: str, file_path: str, content: str
+    ) -> Dict[str, str]:
+        data = {
+            "author_email": settings.gitlab_author_email,
+            "author_name": settings.gitlab_author_name,
+            "branch": branch_name,
+            "commit_message": settings.sentryclirc_com_msg,
+            "content": content,
+            "file_path": file_path,
+        }
+        # When commit signing is enabled in GitLab (e.g. via pre-hook),
+        # commit requires that the author information matches the signer identity
+        # https://gitlab.com/gitlab-org/gitlab/-/merge_requests/150855
+        if settings.gitlab_signed_commit:
+            data.pop("author_email")
+            data.pop("author_name")
+        return data
+
+    def _get_default_mentions(self, project: "Project") -> str:
         return ", ".join(
             [
                 f"@{member.username}"
@@ -216,13 +759,18 @@ class GitlabProvider:
         )
 
     def _get_mr_description(
-        self, project: Project, msg: str, name_with_namespace: str
+        self, project: "Project", msg: str, name_with_namespace: str
     ) -> str:
         mentions = (
             self._get_default_mentions(project)
             if not settings.gitlab_mentions
             else ", ".join(settings.gitlab_mentions)
         )
+        return self._format_mr_description(mentions, msg, name_with_namespace)
+
+    def _format_mr_description(
+        self, mentions: str, msg: str, name_with_namespace: str
+    ) -> str:
         return "\n".join(
             [
                 line.format(
@@ -241,62 +789,109 @@ class GitlabProvider:
         content: str,
         title: str,
     ) -> bool:
-        try:
-            project = self.gitlab.projects.get(g2s_project.pid)
-            self._get_or_create_branch(branch_name, project)
-            self._get_or_create_sentryclirc(
-                project, g2s_project.full_path, branch_name, file_path, content
-            )
-            project.mergerequests.create(
-                {
-                    "description": self._get_mr_description(
-                        project,
-                        settings.sentryclirc_mr_description,
-                        g2s_project.name_with_namespace,
-                    ),
-                    "remove_source_branch": settings.gitlab_rmv_src_branch,
-                    "source_branch": branch_name,
-                    "target_branch": project.default_branch,
-                    "title": title,
-                    "labels": settings.gitlab_mr_label_list,
-                }
+        with tracer.start_span(
+            "create_mr",
+            attributes={
+                "g2s.project": g2s_project.full_path,
+                "g2s.branch": branch_name,
+            },
+        ) as span:
+            try:
+                project = self.gitlab.projects.get(g2s_project.pid)
+                # Steps already done by an interrupted run are not repeated
+                # (e.g. an already pushed branch would be deleted otherwise)
+                if not self.journal.is_step_done(
+                    g2s_project.pid, branch_name, "branch"
+                ):
+                    self._get_or_create_branch(branch_name, project)
+                    self.journal.record_step(g2s_project.pid, branch_name, "branch")
+                if not self.journal.is_step_done(g2s_project.pid, branch_name, "file"):
+                    self._get_or_create_sentryclirc(
+                        project, g2s_project.full_path, branch_name, file_path, content
+                    )
+                    self.journal.record_step(g2s_project.pid, branch_name, "file")
+                if self.journal.is_step_done(g2s_project.pid, branch_name, "mr"):
+                    self._log_mr_done(g2s_project, branch_name)
+                    return False
+                project.mergerequests.create(
+                    self._get_mr_data(
+                        self._get_mr_description(
+                            project,
+                            settings.sentryclirc_mr_description,
+                            g2s_project.name_with_namespace,
+                        ),
+                        branch_name,
+                        project.default_branch,
+                        title,
+                    )
+                )
+                self.journal.record_step(g2s_project.pid, branch_name, "mr")
+                return True
+            except Exception as err:
+                self._log_mr_failure(g2s_project, branch_name, err, span)
+                return False
+
+    def _get_mr_data(
+        self, description: str, branch_name: str, target_branch: str, title: str
+    ) -> Dict[str, Any]:
+        return {
+            "description": description,
+            "remove_source_branch": settings.gitlab_rmv_src_branch,
+            "source_branch": branch_name,
+            "target_branch": target_branch,
+            "title": title,
+            "labels": settings.gitlab_mr_label_list,
+        }
+
+    def _log_mr_failure(
+        self, g2s_project: G2SProject, branch_name: str, err: Exception, span: Span
+    ) -> None:
+        if isinstance(err, RetryLimitExceeded):
+            logging.warning(
+                "{}: Project {} - Throttled while creating MR ({}), "
+                "deferred to next run: {}".format(
+                    self.__str__(), g2s_project.full_path, branch_name, str(err)
+                )
             )
-            return True
-        except Exception as err:
+        else:
             logging.warning(
                 "{}: Project {} - Failed to create MR ({}): {}".format(
-                    self.__str__(),
-                    g2s_project.full_path,
-                    branch_name,
-                    str(err),
+                    self.__str__(), g2s_project.full_path, branch_name, str(err)
                 )
             )
-            return False
+        span.set_error(str(err))
 
-    def create_sentryclirc_mr(self, g2s_project: G2SProject) -> bool:
+    def _log_mr_done(self, g2s_project: G2SProject, branch_name: str) -> None:
+        logging.info(
+            "{}: [Skipping] Project {} - MR ({}) created by a previous "
+            "run.".format(self.__str__(), g2s_project.full_path, branch_name)
+        )
+
+    def _get_sentryclirc_mr(self, g2s_project: G2SProject) -> Tuple[str, ...]:
         logging.info(
             "{}: [Creating] Project {} - Needs sentry .sentryclirc MR.".format(
                 self.__str__(), g2s_project.full_path
             )
         )
-        return self._create_mr(
-            g2s_project,
+        return (
             settings.sentryclirc_branch_name,
             settings.sentryclirc_filepath,
             settings.sentryclirc_mr_content.format(sentry_url=settings.sentry_url),
             settings.sentryclirc_mr_title.format(project_name=g2s_project.name),
         )
 
-    def create_dsn_mr(
+    def create_sentryclirc_mr(self, g2s_project: G2SProject) -> bool:
+        return self._create_mr(g2s_project, *self._get_sentryclirc_mr(g2s_project))
+
+    def _get_dsn_mr(
         self, g2s_project: G2SProject, dsn: str, project_slug: str
-    ) -> bool:
+    ) -> Tuple[str, ...]:
         logging.info(
             "{}: [Creating] Project {} - Sentry dsn: {}. Needs dsn MR.".format(
                 self.__str__(), g2s_project.full_path, dsn
             )
         )
-        return self._create_mr(
-            g2s_project,
+        return (
             settings.dsn_branch_name,
             settings.sentryclirc_filepath,
             settings.dsn_mr_content.format(
@@ -304,3 +899,265 @@ class GitlabProvider:
             ),
             settings.dsn_mr_title.format(project_name=g2s_project.name),
         )
+
+    def create_dsn_mr(
+        self, g2s_project: G2SProject, dsn: str, project_slug: str
+    ) -> bool:
+        return self._create_mr(
+            g2s_project, *self._get_dsn_mr(g2s_project, dsn, project_slug)
+        )
+
+
+class AsyncGitlabProvider(GitlabProvider):
+    """
+    GitlabProvider of the asyncio engine. Projects are queried with an
+    AsyncGraphQLClient and MRs are created with the REST API calls of
+    python-gitlab, sent with an AsyncHTTPClient. The journal steps are
+    the ones of the synchronous provider.
+    """
+
+    _gql_client: AsyncGraphQLClient
+
+    def __init__(
+        self,
+        url: Optional[str] = settings.gitlab_url,
+        token: Optional[str] = settings.gitlab_token,
+        journal: Optional[RunJournal] = None,
+    ) -> None:
+        super().__init__(url, token, journal)
+        self._rest = AsyncHTTPClient("gitlab", {"PRIVATE-TOKEN": token or ""})
+
+    def __str__(self) -> str:
+        return "<AsyncGitlabProvider>"
+
+    def _get_graphql_client(
+        self, url: Optional[str], token: Optional[str]
+    ) -> AsyncGraphQLClient:
+        return AsyncGraphQLClient(url, token)
+
+    async def get_project(self, query: Dict[str, Any]):  # type: ignore[override]
+        return await self._gql_client.project_fetch_query(query)
+
+    async def get_all_projects(  # type: ignore[override]
+        self, query: Dict[str, Any], endCursor: str = ""
+    ) -> AsyncGenerator:
+        self.end_cursor = endCursor
+        while True:
+            result = await self._gql_client.project_list_query(query, self.end_cursor)
+            result_nodes, has_next_page = self._read_page(query, result)
+            if result_nodes is not None:
+                yield result_nodes
+            if not has_next_page:
+                break
+
+    async def get_prefilter_savings(self) -> Dict[str, int]:  # type: ignore[override]
+        if not self._counts_prefilters():
+            return dict()
+        return self._get_prefilter_savings(
+            await self._gql_client.project_prefilter_counts_query()
+        )
+
+    async def get_projects_by_ids(  # type: ignore[override]
+        self, query: Dict[str, Any], pids: Sequence[int]
+    ) -> AsyncGenerator:
+        # The batches are queried at once
+        batch_size = self._get_batch_size()
+        batches = list()
+        for start in range(0, len(pids), batch_size):
+            end = start + batch_size
+            batches.append(pids[start:end])
+        results = await asyncio.gather(
+            *(self._gql_client.project_ids_query(query, batch) for batch in batches)
+        )
+        for batch, result in zip(batches, results):
+            page = self._read_ids_page(query, result, batch)
+            if page is not None:
+                yield page
+
+    async def _call(
+        self, method: str, path: str, data: Optional[Dict[str, Any]] = None
+    ) -> Tuple[int, Any]:
+        response = await self._rest.request(
+            method, "{}/api/v4/{}".format(self._url, path), data
+        )
+        # Same outcome as a throttled call of the RetrySession
+        if is_retryable(method, response.status_code):
+            raise RetryLimitExceeded(response.status_code, path)
+        return (
+            response.status_code,
+            json_codec.loads(response.content) if response.content else None,
+        )
+
+    async def _write(
+        self, method: str, path: str, data: Optional[Dict[str, Any]] = None
+    ) -> Any:
+        status_code, result = await self._call(method, path, data)
+        if status_code >= 400:
+            raise GitlabRequestFailed(
+                "{} {} - Returned {}".format(method, path, status_code)
+            )
+        return result
+
+    async def _exists(self, path: str) -> bool:
+        # Only a 404 means absent: a failed read must not lead to a write
+        status_code, _ = await self._call("GET", path)
+        if status_code == 404:
+            return False
+        if status_code != 200:
+            raise GitlabRequestFailed("GET {} - Returned {}".format(path, status_code))
+        return True
+
+    async def _recreate_branch(
+        self, pid: int, branch_name: str, default_branch: str
+    ) -> None:
+        branch_path = "projects/{}/repository/branches/{}".format(
+            pid, quote(branch_name, safe="")
+        )
+        if await self._exists(branch_path):
+            logging.warning(
+                "{}: Branch {} already exists, deleting".format(
+                    self.__str__(), branch_name
+                )
+            )
+            await self._write("DELETE", branch_path)
+        await self._write(
+            "POST",
+            "projects/{}/repository/branches".format(pid),
+            {"branch": branch_name, "ref": default_branch},
+        )
+
+    async def _commit_sentryclirc(
+        self,
+        pid: int,
+        full_path: str,
+        default_branch: str,
+        branch_name: str,
+        file_path: str,
+        content: str,
+    ) -> None:
+        path = "projects/{}/repository/files/{}".format(pid, quote(file_path, safe=""))
+        if await self._exists("{}?ref={}".format(path, quote(default_branch, safe=""))):
+            await self._write(
+                "PUT",
+                path,
+                {
+                    "branch": branch_name,
+                    "commit_message": settings.sentryclirc_com_msg,
+                    "content": content,
+                },
+            )
+            return
+        logging.info(
+            "{}: [Creating] Project {} - File not found for project {}.".format(
+                self.__str__(), settings.sentryclirc_filepath, full_path
+            )
+        )
+        await self._write(
+            "POST", path, self._get_new_file_data(branch_name, file_path, content)
+        )
+
+    async def _get_member_mentions(self, pid: int) -> str:
+        mentions: List[str] = list()
+        page = "1"
+        while page:
+            response = await self._rest.request(
+                "GET",
+                "{}/api/v4/projects/{}/members/all?per_page=100&page={}".format(
+                    self._url, pid, page
+                ),
+            )
+            if response.status_code != 200:
+                raise GitlabRequestFailed(
+                    "GET members - Returned {}".format(response.status_code)
+                )
+            mentions.extend(
+                "@{}".format(member["username"])
+                for member in json_codec.loads(response.content)
+                if (
+                    member["access_level"] >= settings.gitlab_mentions_access_level
+                    and member["state"] != "blocked"
+                )
+            )
+            page = {k.lower(): v for k, v in response.headers.items()}.get(
+                "x-next-page", ""
+            )
+        return ", ".join(mentions)
+
+    async def _create_mr(  # type: ignore[override]
+        self,
+        g2s_project: G2SProject,
+        branch_name: str,
+        file_path: str,
+        content: str,
+        title: str,
+    ) -> bool:
+        pid = g2s_project.pid
+        with tracer.start_span(
+            "create_mr",
+            attributes={
+                "g2s.project": g2s_project.full_path,
+                "g2s.branch": branch_name,
+            },
+        ) as span:
+            try:
+                project = await self._write("GET", "projects/{}".format(pid))
+                default_branch = project["default_branch"]
+                # Steps already done by an interrupted run are not repeated
+                if not self.journal.is_step_done(pid, branch_name, "branch"):
+                    await self._recreate_branch(pid, branch_name, default_branch)
+                    self.journal.record_step(pid, branch_name, "branch")
+                if not self.journal.is_step_done(pid, branch_name, "file"):
+                    await self._commit_sentryclirc(
+                        pid,
+                        g2s_project.full_path,
+                        default_branch,
+                        branch_name,
+                        file_path,
+                        content,
+                    )
+                    self.journal.record_step(pid, branch_name, "file")
+                if self.journal.is_step_done(pid, branch_name, "mr"):
+                    self._log_mr_done(g2s_project, branch_name)
+                    return False
+                mentions = (
+                    await self._get_member_mentions(pid)
+                    if not settings.gitlab_mentions
+                    else ", ".join(settings.gitlab_mentions)
+                )
+                await self._write(
+                    "POST",
+                    "projects/{}/merge_requests".format(pid),
+                    self._get_mr_data(
+                        self._format_mr_description(
+                            mentions,
+                            settings.sentryclirc_mr_description,
+                            g2s_project.name_with_namespace,
+                        ),
+                        branch_name,
+                        default_branch,
+                        title,
+                    ),
+                )
+                self.journal.record_step(pid, branch_name, "mr")
+                return True
+            except Exception as err:
+                self._log_mr_failure(g2s_project, branch_name, err, span)
+                return False
+
+    async def create_sentryclirc_mr(  # type: ignore[override]
+        self, g2s_project: G2SProject
+    ) -> bool:
+        return await self._create_mr(
+            g2s_project, *self._get_sentryclirc_mr(g2s_project)
+        )
+
+    async def create_dsn_mr(  # type: ignore[override]
+        self, g2s_project: G2SProject, dsn: str, project_slug: str
+    ) -> bool:
+        return await self._create_mr(
+            g2s_project, *self._get_dsn_mr(g2s_project, dsn, project_slug)
+        )
+
+    async def close(self) -> None:
+        await self._gql_client.close()
+        await self._rest.close()
@@ -0,0 +1,238 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from gitlab2sentry.resources import settings
+
+CACHE_HEADER = "X-G2S-Cache"
+CACHE_HIT = "hit"
+CACHE_REVALIDATED = "revalidated"
+
+# Probed by every run to decide on a project: always revalidated, even
+# within the ttl
+VOLATILE_PATHS = ("/repository/branches", "/repository/files")
+
+# Never written to disk: the Sentry project keys carry the DSN secrets
+SECRET_SEGMENTS = ("keys",)
+
+# The body is kept decoded: its transfer headers do not apply anymore
+SKIPPED_HEADERS = (
+    "connection",
+    "content-encoding",
+    "content-length",
+    "keep-alive",
+    "transfer-encoding",
+)
+
+
+class HTTPCache:
+    """
+    On-disk cache of the successful GET responses of the GitLab and
+    Sentry clients (members, branches, files, Sentry teams), but for the
+    Sentry project keys and their DSN secrets. A response younger than
+    ttl seconds is answered locally (but for the branches and files of
+    a repository), an older one is revalidated with
+    If-None-Match/If-Modified-Since so that an unchanged resource costs
+    a bodyless 304. Writes drop the cached responses they may change: a
+    POST the ones below its URL, a PUT or a DELETE the ones below the
+    parent of its URL (e.g. a new branch drops the cached branches of
+    the project). The max_entries least recently used responses
+    are kept between runs; an empty path disables the cache.
+    """
+
+    def __init__(
+        self,
+        path: str = settings.http_cache_path,
+        ttl: int = settings.http_cache_ttl,
+        max_entries: int = settings.http_cache_max_entries,
+    ) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.entries: "OrderedDict[str, Dict[str, Any]]" = self._load()
+
+    def __str__(self) -> str:
+        return "<HTTPCache>"
+
+    def _load(self) -> "OrderedDict[str, Dict[str, Any]]":
+        if not (self.path and os.path.exists(self.path)):
+            return OrderedDict()
+        try:
+            with open(self.path) as cache_file:
+                # Left by an older version, the secrets go
+                return OrderedDict(
+                    (url, entry)
+                    for url, entry in json.load(cache_file).items()
+                    if not self._is_secret(url)
+                )
+        except (AttributeError, ValueError, TypeError) as load_err:
+            logging.warning(
+                "{}: Ignoring unreadable cache: {}".format(
+                    self.__str__(), str(load_err)
+                )
+            )
+            return OrderedDict()
+
+    def _get_scope(self, method: str, url: str) -> str:
+        scheme, netloc, path, _, _ = urlsplit(url)
+        path = path.rstrip("/")
+        # A POST adds to its collection, other writes change their item
+        # (and the collection listing it)
+        if method != "POST":
+            path = path.rsplit("/", 1)[0]
+        return urlunsplit((scheme, netloc, path, "", ""))
+
+    def _in_scope(self, url: str, scope: str) -> bool:
+        return url.startswith(scope) and (
+            len(url) == len(scope) or url[len(scope)] in "/?"
+        )
+
+    def _is_query(self, url: str) -> bool:
+        # GraphQL queries are POSTed but change nothing
+        return urlsplit(url).path.rstrip("/").endswith(settings.gitlab_graphql_suffix)
+
+    def _is_secret(self, url: str) -> bool:
+        segments = urlsplit(url).path.strip("/").split("/")
+        return any(segment in SECRET_SEGMENTS for segment in segments)
+
+    def _is_volatile(self, url: str) -> bool:
+        return any(path in urlsplit(url).path for path in VOLATILE_PATHS)
+
+    def _get_response(
+        self, request: requests.PreparedRequest, entry: Dict[str, Any], source: str
+    ) -> requests.Response:
+        response = requests.Response()
+        response.status_code = entry["status_code"]
+        response.reason = "OK"
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response.headers[CACHE_HEADER] = source
+        response._content = entry["body"].encode()
+        response.encoding = "utf-8"
+        response.url = str(request.url)
+        response.request = request
+        return response
+
+    def is_enabled(self) -> bool:
+        return bool(self.path)
+
+    def get(self, request: requests.PreparedRequest) -> Optional[requests.Response]:
+        """
+        Cached response of a GET that is still fresh, otherwise None
+        after adding the validators of a stale one to the request.
+        """
+        if request.method != "GET":
+            return None
+        with self._lock:
+            entry = self.entries.get(str(request.url))
+            if not entry:
+                return None
+            self.entries.move_to_end(str(request.url))
+            fresh = time.time() - entry["validated_at"] < self.ttl
+            if fresh and not self._is_volatile(str(request.url)):
+                self.hits += 1
+                return self._get_response(request, entry, CACHE_HIT)
+        headers = CaseInsensitiveDict(entry["headers"])
+        if headers.get("ETag"):
+            request.headers["If-None-Match"] = headers["ETag"]
+        if headers.get("Last-Modified"):
+            request.headers["If-Modified-Since"] = headers["Last-Modified"]
+        return None
+
+    def update(
+        self, request: requests.PreparedRequest, response: requests.Response
+    ) -> requests.Response:
+        """
+        Stores a cacheable response, answers a 304 with the cached one
+        and drops the responses a write may change.
+        """
+        if request.method != "GET":
+            if not self._is_query(str(request.url)):
+                self.invalidate(str(request.method), str(request.url))
+            return response
+        key = str(request.url)
+        with self._lock:
+            entry = self.entries.get(key)
+            if response.status_code == 304 and entry:
+                # Reading the empty body gives the connection back to the pool
+                response.content
+                entry["validated_at"] = time.time()
+                self.revalidated += 1
+                return self._get_response(request, entry, CACHE_REVALIDATED)
+            self.misses += 1
+        if (
+            response.status_code == 200
+            and not self._is_secret(key)
+            and self._is_cacheable(response)
+        ):
+            self._store(key, response)
+        return response
+
+    def _is_cacheable(self, response: requests.Response) -> bool:
+        if "no-store" in response.headers.get("Cache-Control", ""):
+            return False
+        # Without validators a response is only worth keeping for its ttl
+        return bool(
+            self.ttl
+            or response.headers.get("ETag")
+            or response.headers.get("Last-Modified")
+        )
+
+    def _store(self, key: str, response: requests.Response) -> None:
+        try:
+            body = response.content.decode("utf-8")
+        except UnicodeDecodeError:
+            return
+        with self._lock:
+            self.entries[key] = {
+                "status_code": response.status_code,
+                "headers": {
+                    header: value
+                    for header, value in response.headers.items()
+                    if header.lower() not in SKIPPED_HEADERS
+                },
+                "body": body,
+                "validated_at": time.time(),
+            }
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, method: str, url: str) -> None:
+        scope = self._get_scope(method, url)
+        with self._lock:
+            for key in [key for key in self.entries if self._in_scope(key, scope)]:
+                del self.entries[key]
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        tmp_path = "{}.tmp".format(self.path)
+        with self._lock:
+            with open(tmp_path, "w") as cache_file:
+                json.dump(self.entries, cache_file)
+        os.replace(tmp_path, self.path)
+
+    def report(self) -> None:
+        if not self.path:
+            return
+        logging.info(
+            "{}: {} local hits, {} revalidated (304), {} misses, {} entries".format(
+                self.__str__(),
+                self.hits,
+                self.revalidated,
+                self.misses,
+                len(self.entries),
+            )
+        )
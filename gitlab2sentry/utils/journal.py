@@ -0,0 +1,129 @@
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional, Set
+
+from gitlab2sentry.resources import settings
+
+JOURNAL_PAGE = "page"
+JOURNAL_SCAN_DONE = "scan_done"
+JOURNAL_STARTED = "started"
+JOURNAL_STEP = "step"
+
+
+class RunJournal:
+    """
+    Append-only journal (one json event per line) of a run. It keeps
+    the scanned pages with the cursor to continue the scan from and the
+    write steps already done per project, so that a run killed by the
+    cron deadline is resumed by the next one without repeating a write.
+    An empty path disables the journal.
+    """
+
+    def __init__(
+        self,
+        path: str = settings.journal_path,
+        max_age: int = settings.journal_max_age,
+    ) -> None:
+        self.path = path
+        self.max_age = max_age
+        self.cursor = ""
+        self.pages: List[List[Dict[str, Any]]] = list()
+        self.scan_done = False
+        self.steps: Set[str] = set()
+        self._load()
+
+    def __str__(self) -> str:
+        return "<RunJournal>"
+
+    def _get_step_key(self, pid: int, branch_name: str, step: str) -> str:
+        return "{}:{}:{}".format(pid, branch_name, step)
+
+    def _read_events(self) -> List[Dict[str, Any]]:
+        events = list()
+        with open(self.path) as journal_file:
+            for line in journal_file:
+                try:
+                    events.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # Last line of a killed run may be truncated
+                    logging.warning(
+                        "{}: Skipping corrupted journal line".format(self.__str__())
+                    )
+        return events
+
+    def _apply(self, event: Dict[str, Any]) -> None:
+        if event["event"] == JOURNAL_PAGE:
+            self.pages.append(event["nodes"])
+            self.cursor = event["cursor"] or self.cursor
+        elif event["event"] == JOURNAL_SCAN_DONE:
+            self.scan_done = True
+        elif event["event"] == JOURNAL_STEP:
+            self.steps.add(event["key"])
+
+    def _load(self) -> None:
+        if not (self.path and os.path.exists(self.path)):
+            return
+        events = self._read_events()
+        if not events or events[0].get("event") != JOURNAL_STARTED:
+            self.clear()
+            return
+        if time.time() - events[0]["at"] > self.max_age * 3600:
+            logging.info(
+                "{}: Discarding journal older than {} hours".format(
+                    self.__str__(), self.max_age
+                )
+            )
+            self.clear()
+            return
+        for event in events[1:]:
+            self._apply(event)
+        logging.info(
+            "{}: Resuming interrupted run: {} pages scanned, "
+            "{} write steps done".format(
+                self.__str__(), len(self.pages), len(self.steps)
+            )
+        )
+
+    def _append(self, event: Dict[str, Any]) -> None:
+        if not self.path:
+            return
+        if not os.path.exists(self.path):
+            with open(self.path, "a") as journal_file:
+                journal_file.write(
+                    json.dumps({"event": JOURNAL_STARTED, "at": time.time()}) + "\n"
+                )
+        with open(self.path, "a") as journal_file:
+            journal_file.write(json.dumps(event) + "\n")
+            journal_file.flush()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def record_page(self, cursor: Optional[str], nodes: List[Dict[str, Any]]) -> None:
+        self._append({"event": JOURNAL_PAGE, "cursor": cursor, "nodes": nodes})
+
+    def record_scan_done(self) -> None:
+        self._append({"event": JOURNAL_SCAN_DONE})
+
+    def is_step_done(self, pid: int, branch_name: str, step: str) -> bool:
+        return self._get_step_key(pid, branch_name, step) in self.steps
+
+    def record_step(self, pid: int, branch_name: str, step: str) -> None:
+        key = self._get_step_key(pid, branch_name, step)
+        self.steps.add(key)
+        self._append({"event": JOURNAL_STEP, "key": key})
+
+    def clear(self) -> None:
+        """
+        Forgets the run. Called once a run went through all its
+        projects so that the next one starts a fresh scan.
+        """
+        self.cursor = ""
+        self.pages = list()
+        self.scan_done = False
+        self.steps = set()
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,142 @@
+import codecs
+import json
+from typing import Any, Dict, Generator, Iterable, Iterator, Sequence, Union
+
+STREAM_CHUNK_SIZE = 64 * 1024
+WHITESPACE = " \t\n\r"
+
+
+class JSONArrayStream:
+    """
+    Incremental decoder of a json document read by chunks. The items of
+    the array found at `path` (keys from the root object) are decoded and
+    yielded one at a time, as soon as the chunks holding them arrived;
+    every other value is kept in `rest`. Only the item being decoded and
+    the unread end of the last chunk are held in memory, whatever the
+    size of the array.
+    """
+
+    def __init__(
+        self, chunks: Iterable[Union[bytes, str]], path: Sequence[str]
+    ) -> None:
+        self.path = tuple(path)
+        self.rest: Dict[str, Any] = dict()
+        self._chunks = iter(chunks)
+        self._text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._started = False
+
+    def __str__(self) -> str:
+        return "<JSONArrayStream>"
+
+    @classmethod
+    def from_value(cls, value: Any, path: Sequence[str]) -> "JSONArrayStream":
+        # Documents already decoded (cassette, failed queries) stream the same way
+        return cls([json.dumps(value)], path)
+
+    def __iter__(self) -> Iterator[Any]:
+        if self._started:
+            raise RuntimeError("{}: Stream already consumed".format(self.__str__()))
+        self._started = True
+        return self._walk_object((), self.rest)
+
+    def get(self, *keys: str) -> Any:
+        """
+        Value kept at `keys` in `rest`, None when missing.
+        """
+        value: Any = self.rest
+        for key in keys:
+            if not isinstance(value, dict):
+                return None
+            value = value.get(key)
+        return value
+
+    def _fill(self) -> bool:
+        for chunk in self._chunks:
+            text = (
+                self._text_decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+            )
+            if not text:
+                continue
+            # Consumed text is dropped so that the buffer stays small
+            unread = len(self._buffer) - self._pos
+            self._buffer = self._buffer[-unread:] + text if unread else text
+            self._pos = 0
+            return True
+        return False
+
+    def _peek(self) -> str:
+        while True:
+            while self._pos < len(self._buffer):
+                if self._buffer[self._pos] not in WHITESPACE:
+                    return self._buffer[self._pos]
+                self._pos += 1
+            if not self._fill():
+                raise json.JSONDecodeError(
+                    "Unexpected end of document", self._buffer, self._pos
+                )
+
+    def _expect(self, char: str) -> None:
+        if self._peek() != char:
+            raise json.JSONDecodeError(
+                "Expecting '{}'".format(char), self._buffer, self._pos
+            )
+        self._pos += 1
+
+    def _decode_value(self) -> Any:
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                # Value cut by the end of the chunk
+                if not self._fill():
+                    raise
+                continue
+            # A number ending the buffer may go on in the next chunk
+            if end == len(self._buffer) and self._fill():
+                continue
+            self._pos = end
+            return value
+
+    def _is_next(self, char: str) -> bool:
+        if self._peek() == char:
+            self._pos += 1
+            return True
+        return False
+
+    def _end_item(self, closing: str) -> bool:
+        if self._is_next(closing):
+            return True
+        self._expect(",")
+        return False
+
+    def _walk_object(
+        self, path: Sequence[str], target: Dict[str, Any]
+    ) -> Generator[Any, None, None]:
+        self._expect("{")
+        if self._is_next("}"):
+            return
+        while True:
+            key = self._decode_value()
+            self._expect(":")
+            key_path = tuple(path) + (key,)
+            if key_path == self.path and self._peek() == "[":
+                yield from self._walk_array()
+            elif self.path[: len(key_path)] == key_path and self._peek() == "{":
+                yield from self._walk_object(key_path, target.setdefault(key, dict()))
+            else:
+                target[key] = self._decode_value()
+            if self._end_item("}"):
+                return
+
+    def _walk_array(self) -> Generator[Any, None, None]:
+        self._expect("[")
+        if self._is_next("]"):
+            return
+        while True:
+            yield self._decode_value()
+            if self._end_item("]"):
+                return
@@ -0,0 +1,174 @@
+import logging
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Generator
+
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    push_to_gateway,
+    start_http_server,
+    write_to_textfile,
+)
+
+from gitlab2sentry.resources import settings
+from gitlab2sentry.utils.accounting import call_accounting, phase_scope
+
+# Up to the minute: a throttled call can wait for long
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Path segments kept as is in endpoint labels, any other segment
+# (ids, slugs, branch or file names) becomes ":param"
+ENDPOINT_SEGMENTS = {
+    "0",
+    "all",
+    "api",
+    "branches",
+    "files",
+    "keys",
+    "members",
+    "merge_requests",
+    "organizations",
+    "projects",
+    "repository",
+    "teams",
+    "user",
+    "v4",
+}
+
+# Metrics of the process only, without the default process collectors
+registry = CollectorRegistry()
+
+API_REQUEST_DURATION = Histogram(
+    "g2s_api_request_duration_seconds",
+    "Duration of the GitLab and Sentry API calls.",
+    ("client", "endpoint"),
+    buckets=DEFAULT_BUCKETS,
+    registry=registry,
+)
+API_RESPONSES = Counter(
+    "g2s_api_responses",
+    "GitLab and Sentry API responses by status code.",
+    ("client", "endpoint", "status"),
+    registry=registry,
+)
+API_IN_FLIGHT = Gauge(
+    "g2s_api_requests_in_flight",
+    "GitLab and Sentry API calls waiting for their response.",
+    ("client",),
+    registry=registry,
+)
+PHASE_DURATION = Gauge(
+    "g2s_phase_duration_seconds",
+    "Duration of each phase of the last run.",
+    ("phase",),
+    registry=registry,
+)
+PIPELINE_QUEUE_DEPTH = Gauge(
+    "g2s_pipeline_queue_depth",
+    "Items waiting in the queue of each pipeline stage.",
+    ("stage",),
+    registry=registry,
+)
+PIPELINE_QUEUE_WAIT = Histogram(
+    "g2s_pipeline_queue_wait_seconds",
+    "Time spent by the items in the queue of each pipeline stage.",
+    ("stage",),
+    buckets=DEFAULT_BUCKETS,
+    registry=registry,
+)
+PIPELINE_STAGE_DURATION = Histogram(
+    "g2s_pipeline_stage_duration_seconds",
+    "Handling time of the items of each pipeline stage.",
+    ("stage",),
+    buckets=DEFAULT_BUCKETS,
+    registry=registry,
+)
+RUN_STATS = Gauge(
+    "g2s_run_stats", "Results of the last run.", ("stat",), registry=registry
+)
+LAST_RUN = Gauge(
+    "g2s_last_run_timestamp_seconds", "End time of the last run.", registry=registry
+)
+
+
+def get_endpoint(method: str, path: str) -> str:
+    segments = [
+        segment if segment in ENDPOINT_SEGMENTS else ":param"
+        for segment in path.split("?")[0].strip("/").split("/")
+    ]
+    return "{} /{}".format(method.upper(), "/".join(segments))
+
+
+@contextmanager
+def track_request(client: str, endpoint: str) -> Generator[Dict, None, None]:
+    """
+    Times an API call, counts its response and accounts it to the
+    current phase and project. The caller sets the "status" and the
+    "size" (bytes transferred) of the yielded dict, calls raising an
+    exception are counted with the "error" status.
+    """
+    response: Dict[str, Any] = {"status": "error", "size": 0}
+    API_IN_FLIGHT.labels(client=client).inc()
+    start_time = time.monotonic()
+    try:
+        yield response
+    finally:
+        API_IN_FLIGHT.labels(client=client).dec()
+        API_REQUEST_DURATION.labels(client=client, endpoint=endpoint).observe(
+            time.monotonic() - start_time
+        )
+        API_RESPONSES.labels(
+            client=client, endpoint=endpoint, status=response["status"]
+        ).inc()
+        call_accounting.record(client, endpoint, response["size"])
+
+
+@contextmanager
+def track_phase(phase: str) -> Generator[None, None, None]:
+    start_time = time.monotonic()
+    try:
+        with phase_scope(phase):
+            yield
+    finally:
+        PHASE_DURATION.labels(phase=phase).set(time.monotonic() - start_time)
+
+
+def export_metrics(
+    textfile_path: str = settings.metrics_textfile_path,
+    pushgateway_url: str = settings.metrics_pushgateway_url,
+) -> None:
+    LAST_RUN.set_to_current_time()
+    try:
+        if textfile_path:
+            # Atomic write: the node_exporter textfile collector may read it
+            write_to_textfile(textfile_path, registry)
+        if pushgateway_url:
+            push_to_gateway(
+                pushgateway_url,
+                "gitlab2sentry",
+                registry,
+                # Every shard keeps its own metrics on the Pushgateway
+                grouping_key=(
+                    {"shard": settings.shard_index}
+                    if settings.shard_count > 1
+                    else None
+                ),
+                timeout=10,
+            )
+    except OSError as export_err:
+        # Metrics must never fail a run
+        logging.warning(
+            "<Metrics>: Could not export metrics: {}".format(str(export_err))
+        )
+
+
+def start_metrics_server(
+    port: int = settings.metrics_port, host: str = "0.0.0.0"
+) -> None:
+    if not port:
+        return
+    start_http_server(port, host, registry)
+    logging.info("<Metrics>: Serving /metrics on port {}".format(port))
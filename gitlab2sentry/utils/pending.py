@@ -0,0 +1,60 @@
+import json
+import logging
+import os
+from typing import Iterable, List, Set
+
+from gitlab2sentry.resources import settings
+
+
+class PendingSet:
+    """
+    Projects whose gitlab2sentry integration is under way: a .sentryclirc
+    MR waiting to be merged, or a merged one without its DSN yet. Their
+    ids are refreshed by every run whatever the creation date of the
+    project, so that the scan window can stay short while the teams take
+    their time to merge. An empty path keeps it in memory only.
+    """
+
+    def __init__(self, path: str = settings.pending_path) -> None:
+        self.path = path
+        self.pids: Set[int] = self._load()
+
+    def __str__(self) -> str:
+        return "<PendingSet>"
+
+    def _load(self) -> Set[int]:
+        if not (self.path and os.path.exists(self.path)):
+            return set()
+        try:
+            with open(self.path) as pending_file:
+                return {int(pid) for pid in json.load(pending_file)}
+        except (ValueError, TypeError) as load_err:
+            logging.warning(
+                "{}: Ignoring unreadable pending set: {}".format(
+                    self.__str__(), str(load_err)
+                )
+            )
+            return set()
+
+    def __contains__(self, pid: int) -> bool:
+        return pid in self.pids
+
+    def __len__(self) -> int:
+        return len(self.pids)
+
+    def get_missing(self, seen_pids: Set[int]) -> List[int]:
+        return sorted(self.pids - seen_pids)
+
+    def save(self, pids: Iterable[int], done_pids: Iterable[int]) -> None:
+        """
+        Adds the projects found pending by this run and drops the ones it
+        read back finished, declined or deleted. The projects the run could
+        not read back (e.g. their query failed) are kept for the next one.
+        """
+        self.pids = (self.pids - set(done_pids)) | set(pids)
+        if not self.path:
+            return
+        tmp_path = "{}.tmp".format(self.path)
+        with open(tmp_path, "w") as pending_file:
+            json.dump(sorted(self.pids), pending_file)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,129 @@
+import asyncio
+import itertools
+import logging
+import time
+from typing import Any, Awaitable, Callable, List, Tuple
+
+from gitlab2sentry.resources import settings
+from gitlab2sentry.utils.metrics import (
+    PIPELINE_QUEUE_DEPTH,
+    PIPELINE_QUEUE_WAIT,
+    PIPELINE_STAGE_DURATION,
+    track_phase,
+)
+from gitlab2sentry.utils.tracing import tracer
+
+# Ranked after any item: the workers stop once the queue is drained
+CLOSED_RANK: Tuple[float, ...] = (float("inf"),)
+
+
+class PipelineStage:
+    """
+    Stage of the asyncio pipeline: workers handling the items of a
+    bounded queue. A full queue blocks the stage feeding it, so that a
+    slow stage slows down the ones before it instead of buffering their
+    work. Queued items are handled by rank (lowest first), then in their
+    queueing order. The queue depth, the time spent in the queue and the
+    handling time of the items are exported by stage.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        handler: Callable[[Any], Awaitable[Any]],
+        workers: int,
+        maxsize: int = settings.pipeline_queue_size,
+    ) -> None:
+        self.name = name
+        self.handler = handler
+        self.workers = max(workers, 1)
+        self.maxsize = maxsize
+        self.queue: "asyncio.PriorityQueue[Tuple[Tuple, int, float, Any]]" = (
+            asyncio.PriorityQueue(maxsize)
+        )
+        self.handled = 0
+        self.max_depth = 0
+        self.wait_time = 0.0
+        self.busy_time = 0.0
+        self._order = itertools.count()
+
+    def __str__(self) -> str:
+        return "<PipelineStage>"
+
+    def _set_depth(self) -> None:
+        depth = self.queue.qsize()
+        self.max_depth = max(self.max_depth, depth)
+        PIPELINE_QUEUE_DEPTH.labels(stage=self.name).set(depth)
+
+    async def put(self, item: Any, rank: Tuple = ()) -> None:
+        await self.queue.put((rank, next(self._order), time.monotonic(), item))
+        self._set_depth()
+
+    async def close(self) -> None:
+        # Called once nothing is put anymore, one marker per worker
+        for _ in range(self.workers):
+            await self.put(None, CLOSED_RANK)
+
+    async def _work(self) -> None:
+        while True:
+            rank, _, queued_at, item = await self.queue.get()
+            self._set_depth()
+            if rank == CLOSED_RANK:
+                return
+            start_time = time.monotonic()
+            self.wait_time += start_time - queued_at
+            PIPELINE_QUEUE_WAIT.labels(stage=self.name).observe(start_time - queued_at)
+            try:
+                await self.handler(item)
+            finally:
+                duration = time.monotonic() - start_time
+                self.busy_time += duration
+                self.handled += 1
+                PIPELINE_STAGE_DURATION.labels(stage=self.name).observe(duration)
+
+    async def run(self) -> None:
+        with tracer.start_span(self.name), track_phase(self.name):
+            await asyncio.gather(*(self._work() for _ in range(self.workers)))
+
+    def report(self) -> None:
+        logging.info(
+            "{}: {} - {} items by {} workers, max queue depth {}/{}, "
+            "mean wait {}s, mean handling {}s".format(
+                self.__str__(),
+                self.name,
+                self.handled,
+                self.workers,
+                self.max_depth,
+                self.maxsize,
+                round(self.wait_time / max(self.handled, 1), 3),
+                round(self.busy_time / max(self.handled, 1), 3),
+            )
+        )
+
+
+async def run_pipeline(
+    source: Callable[[], Awaitable[Any]], stages: List[PipelineStage]
+) -> None:
+    """
+    Runs source, which feeds the first stage, and the stages, each one
+    feeding the next. A stage is closed once the one before it is done.
+    On the first failure the other stages are cancelled and it is raised.
+    """
+
+    async def feed(producer: Callable[[], Awaitable[Any]], stage: PipelineStage):
+        await producer()
+        await stage.close()
+
+    producers = [source] + [stage.run for stage in stages[:-1]]
+    futures = [
+        asyncio.ensure_future(feed(producer, stage))
+        for producer, stage in zip(producers, stages)
+    ]
+    futures.append(asyncio.ensure_future(stages[-1].run()))
+    try:
+        await asyncio.gather(*futures)
+    finally:
+        for future in futures:
+            future.cancel()
+    for stage in stages:
+        stage.report()
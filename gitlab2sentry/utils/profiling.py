@@ -0,0 +1,107 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Generator, Optional
+
+from gitlab2sentry.resources import settings
+
+
+class RunProfiler:
+    """
+    Profiles a run when a profiling directory is set: cProfile stats
+    (g2s-<time>.prof, readable with pstats or snakeviz) and a summary
+    of the slowest functions and of the top allocations with the
+    tracemalloc peak (g2s-<time>-summary.txt). The memory part of the
+    summary is rewritten every interval so that a run killed for using
+    too much memory still leaves its last picture behind.
+    """
+
+    def __init__(
+        self,
+        path: str = settings.profiling_path,
+        top: int = settings.profiling_top,
+        interval: int = settings.profiling_interval,
+    ) -> None:
+        self.path = path
+        self.top = top
+        self.interval = interval
+        self._stop = threading.Event()
+
+    def __str__(self) -> str:
+        return "<RunProfiler>"
+
+    def _get_memory_summary(self) -> str:
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [
+            "Memory: current {:.1f} MiB, peak {:.1f} MiB".format(
+                current / 1024 / 1024, peak / 1024 / 1024
+            ),
+            "",
+            "Top {} allocations:".format(self.top),
+        ]
+        for stat in tracemalloc.take_snapshot().statistics("lineno")[: self.top]:
+            lines.append(str(stat))
+        return "\n".join(lines) + "\n"
+
+    def _get_cpu_summary(self, profiler: cProfile.Profile) -> str:
+        stream = io.StringIO()
+        stats = pstats.Stats(profiler, stream=stream)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.top)
+        return stream.getvalue()
+
+    def _write(self, path: str, content: str) -> None:
+        tmp_path = "{}.tmp".format(path)
+        with open(tmp_path, "w") as summary_file:
+            summary_file.write(content)
+        os.replace(tmp_path, path)
+
+    def _watch_memory(self, summary_path: str) -> None:
+        while not self._stop.wait(self.interval):
+            self._write(summary_path, self._get_memory_summary())
+
+    @contextmanager
+    def profile(self) -> Generator[None, None, None]:
+        if not self.path:
+            yield
+            return
+        os.makedirs(self.path, exist_ok=True)
+        prefix = os.path.join(
+            self.path, "g2s-{}".format(time.strftime("%Y%m%d-%H%M%S"))
+        )
+        summary_path = "{}-summary.txt".format(prefix)
+        watcher: Optional[threading.Thread] = None
+        profiler = cProfile.Profile()
+
+        tracemalloc.start()
+        if self.interval:
+            self._stop.clear()
+            watcher = threading.Thread(
+                target=self._watch_memory, args=(summary_path,), daemon=True
+            )
+            watcher.start()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            if watcher:
+                self._stop.set()
+                watcher.join()
+            summary = self._get_memory_summary()
+            tracemalloc.stop()
+            profiler.dump_stats("{}.prof".format(prefix))
+            self._write(summary_path, summary + "\n" + self._get_cpu_summary(profiler))
+            logging.info(
+                "{}: Profile written to {}.prof and {}".format(
+                    self.__str__(), prefix, summary_path
+                )
+            )
+
+
+run_profiler = RunProfiler()
@@ -0,0 +1,123 @@
+import zlib
+from typing import Any, Dict, List, Optional
+
+from gitlab2sentry.resources import MR_STATES, G2SProject, MRState, settings
+
+
+class ProjectReader:
+    """
+    Reads the compact G2SProject records of the GraphQL project nodes.
+    It needs no provider nor state file: the PIPELINE_CLASSIFY_PROCESSES
+    workers read the scanned pages with their own reader.
+    """
+
+    def __init__(self) -> None:
+        # Thousands of projects share a handful of group name strings
+        self.group_names: Dict[str, str] = dict()
+
+    def _get_mr_states(self, mr_list: Optional[List[Dict[str, Any]]]) -> tuple:
+        # MRs come newest first: the first one of a branch is its latest
+        mr_states: Dict[str, Optional[MRState]] = dict()
+        for mr in mr_list or ():
+            mr_states.setdefault(mr["sourceBranch"], MR_STATES.get(mr["state"]))
+        return (
+            mr_states.get(settings.sentryclirc_branch_name),
+            mr_states.get(settings.dsn_branch_name),
+        )
+
+    def _is_group_project(self, group: Optional[Dict[str, Any]]) -> bool:
+        if group and group.get("name"):
+            return True
+        else:
+            return False
+
+    def _is_shard_group(self, group_name: str) -> bool:
+        """
+        Top-level groups are partitioned between SHARD_COUNT workers with
+        a hash that is stable between runs and processes, so a group is
+        always handled (Sentry team, projects and MRs) by the same shard.
+        """
+        if settings.shard_count <= 1:
+            return True
+        return (
+            zlib.crc32(group_name.encode()) % settings.shard_count
+            == settings.shard_index
+        )
+
+    def _get_sentryclirc_file(self, blob: List[Dict[str, Any]]) -> tuple:
+        has_sentryclirc_file, has_dsn = False, False
+        if blob and blob[0]["name"] == settings.sentryclirc_filepath:
+            has_sentryclirc_file = True
+            if blob[0].get("rawTextBlob"):
+                for line in blob[0]["rawTextBlob"].split("\n"):
+                    if line.startswith("dsn"):
+                        has_dsn = True
+
+        return has_sentryclirc_file, has_dsn
+
+    def _get_pid(self, result: Dict[str, Any]) -> int:
+        # Global ids look like gid://gitlab/Project/<id>
+        return int(result["id"].split("/")[-1])
+
+    def _get_g2s_project(self, result: Dict[str, Any]) -> Optional[G2SProject]:
+        if result.get("repository"):
+            full_path = result["fullPath"]
+            group_name = full_path.split("/")[0]
+            group_name = self.group_names.setdefault(group_name, group_name)
+            project_name = result["name"]
+            created_at = result["createdAt"]
+            mrs_enabled = result["mergeRequestsEnabled"]
+            sentryclirc_mr_state, dsn_mr_state = self._get_mr_states(
+                result["sentryclircMergeRequests"]["nodes"]
+                + result["dsnMergeRequests"]["nodes"]
+            )
+            has_sentryclirc_file, has_dsn = self._get_sentryclirc_file(
+                result["repository"]["blobs"]["nodes"]
+            )
+            pid = self._get_pid(result)
+            return G2SProject(
+                pid,
+                full_path,
+                project_name,
+                group_name,
+                mrs_enabled,
+                created_at,
+                has_sentryclirc_file,
+                has_dsn,
+                sentryclirc_mr_state,
+                dsn_mr_state,
+            )
+        return None
+
+    def read_result(self, result: Dict[str, Any]) -> Optional[G2SProject]:
+        """
+        Project of a node when it is a project of a group of this shard
+        under GITLAB_GROUP_IDENTIFIER, None otherwise.
+        """
+        if self._is_group_project(result["group"]):
+            group_name = result["fullPath"].split("/")[0]
+            if group_name.startswith(
+                settings.gitlab_group_identifier
+            ) and self._is_shard_group(group_name):
+                return self._get_g2s_project(result)
+        return None
+
+    def read_page(self, page_result: List[Dict[str, Any]]) -> List[G2SProject]:
+        g2s_projects: List[G2SProject] = list()
+        for result_node in page_result:
+            g2s_project = self.read_result(result_node["node"])
+            if g2s_project:
+                g2s_projects.append(g2s_project)
+        return g2s_projects
+
+
+# Reader of the process running read_worker_page
+project_reader = ProjectReader()
+
+
+def read_worker_page(page_result: List[Dict[str, Any]]) -> List[G2SProject]:
+    """
+    ProjectReader.read_page run by a process pool worker: the page is
+    sent to it and only the projects of the page come back.
+    """
+    return project_reader.read_page(page_result)
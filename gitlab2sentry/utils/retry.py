@@ -0,0 +1,305 @@
+import asyncio
+import logging
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Mapping, Optional
+
+import requests
+
+from gitlab2sentry.exceptions import RetryLimitExceeded
+from gitlab2sentry.resources import settings
+from gitlab2sentry.utils.accounting import get_size
+from gitlab2sentry.utils.cassette import (
+    Cassette,
+    get_request_path,
+    get_response,
+    run_cassette,
+)
+from gitlab2sentry.utils.metrics import get_endpoint, track_request
+from gitlab2sentry.utils.tracing import SPAN_KIND_CLIENT, tracer
+from gitlab2sentry.utils.transport import HTTPTransport, http_transport
+
+RETRYABLE_STATUS_CODES = (429, 502, 503, 504)
+# A gateway error may come after the write was applied: only the
+# idempotent methods are sent again after one, the writes only after
+# a 429 (refused before being handled)
+IDEMPOTENT_METHODS = ("GET", "HEAD", "DELETE")
+THROTTLED_STATUS_CODES = (429,)
+
+# Headers read to know how long a throttled client has to wait.
+# GitLab sends RateLimit-*, Sentry sends X-Sentry-Rate-Limit-*, both
+# may send Retry-After.
+RETRY_AFTER_HEADER = "retry-after"
+RATE_LIMIT_HEADERS = (
+    ("ratelimit-remaining", "ratelimit-reset"),
+    ("x-sentry-rate-limit-remaining", "x-sentry-rate-limit-reset"),
+)
+
+
+def is_retryable(method: Optional[str], status_code: Optional[int]) -> bool:
+    # No method: a GraphQL query, POSTed but changing nothing
+    if method is None or method.upper() in IDEMPOTENT_METHODS:
+        return status_code in RETRYABLE_STATUS_CODES
+    return status_code in THROTTLED_STATUS_CODES
+
+
+class RunDeadline:
+    """
+    Wall clock budget of a run. A budget of 0 seconds means
+    that the run has no deadline.
+    """
+
+    def __init__(self, seconds: int = settings.run_deadline) -> None:
+        self.seconds = seconds
+        self.start()
+
+    def __str__(self) -> str:
+        return "<RunDeadline>"
+
+    def start(self) -> None:
+        self.started_at = time.monotonic()
+
+    def remaining(self) -> Optional[float]:
+        if not self.seconds:
+            return None
+        return self.seconds - (time.monotonic() - self.started_at)
+
+    def expired(self) -> bool:
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+
+run_deadline = RunDeadline()
+
+
+class RetryPolicy:
+    def __init__(
+        self,
+        max_attempts: int = settings.retry_max_attempts,
+        max_wait: int = settings.retry_max_wait,
+        deadline: RunDeadline = run_deadline,
+    ) -> None:
+        self.max_attempts = max_attempts
+        self.max_wait = max_wait
+        self.deadline = deadline
+        self.blocked_until = 0.0
+
+    def __str__(self) -> str:
+        return "<RetryPolicy>"
+
+    def _get_headers(self, headers: Optional[Mapping[str, Any]]) -> Dict:
+        return {str(k).lower(): v for k, v in (headers or {}).items()}
+
+    def _get_reset_wait_time(self, reset: Any) -> Optional[float]:
+        try:
+            return float(reset) - time.time()
+        except (TypeError, ValueError):
+            return None
+
+    def _get_retry_after_wait_time(self, retry_after: Any) -> Optional[float]:
+        try:
+            return float(retry_after)
+        except (TypeError, ValueError):
+            pass
+        try:
+            return parsedate_to_datetime(retry_after).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+
+    def get_wait_time(
+        self, headers: Optional[Mapping[str, Any]], attempt: int
+    ) -> float:
+        """
+        Returns the seconds to wait before retrying. Retry-After is
+        preferred, then the rate limit reset timestamps and finally
+        an exponential backoff when the server gave no hint.
+        """
+        lower_headers = self._get_headers(headers)
+        wait_time = None
+        if lower_headers.get(RETRY_AFTER_HEADER):
+            wait_time = self._get_retry_after_wait_time(
+                lower_headers[RETRY_AFTER_HEADER]
+            )
+        if wait_time is None:
+            for _, reset_header in RATE_LIMIT_HEADERS:
+                if lower_headers.get(reset_header):
+                    wait_time = self._get_reset_wait_time(lower_headers[reset_header])
+                    break
+        if wait_time is None:
+            wait_time = 2**attempt
+        return min(max(wait_time, 0.0), float(self.max_wait))
+
+    def can_retry(self, attempt: int, wait_time: float) -> bool:
+        if attempt >= self.max_attempts:
+            return False
+        remaining = self.deadline.remaining()
+        return remaining is None or wait_time < remaining
+
+    def get_retry_wait(
+        self,
+        name: str,
+        status_code: Optional[int],
+        headers: Optional[Mapping[str, Any]],
+        attempt: int,
+        method: Optional[str] = None,
+    ) -> Optional[float]:
+        """
+        Seconds to wait before the next attempt of a throttled or failed
+        call, None when the call must not be retried anymore.
+        """
+        if not is_retryable(method, status_code):
+            return None
+        wait_time = self.get_wait_time(headers, attempt)
+        if not self.can_retry(attempt, wait_time):
+            logging.warning(
+                "{}: {} - Giving up after {} attempts (status {})".format(
+                    self.__str__(), name, attempt + 1, status_code
+                )
+            )
+            return None
+        logging.warning(
+            "{}: {} - Status {}, retrying in {}s ({}/{})".format(
+                self.__str__(),
+                name,
+                status_code,
+                round(wait_time, 2),
+                attempt + 1,
+                self.max_attempts,
+            )
+        )
+        return wait_time
+
+    def wait(
+        self,
+        name: str,
+        status_code: Optional[int],
+        headers: Optional[Mapping[str, Any]],
+        attempt: int,
+        method: Optional[str] = None,
+    ) -> bool:
+        """
+        Sleeps before the next attempt of a throttled or failed call.
+        Returns False when the call must not be retried anymore.
+        """
+        wait_time = self.get_retry_wait(name, status_code, headers, attempt, method)
+        if wait_time is None:
+            return False
+        time.sleep(wait_time)
+        return True
+
+    async def async_wait(
+        self,
+        name: str,
+        status_code: Optional[int],
+        headers: Optional[Mapping[str, Any]],
+        attempt: int,
+        method: Optional[str] = None,
+    ) -> bool:
+        # wait for the asyncio engine: other coroutines run meanwhile
+        wait_time = self.get_retry_wait(name, status_code, headers, attempt, method)
+        if wait_time is None:
+            return False
+        await asyncio.sleep(wait_time)
+        return True
+
+    def observe(self, headers: Optional[Mapping[str, Any]]) -> None:
+        """
+        Remembers an exhausted rate limit window announced by a
+        successful response so that the next call waits for its reset.
+        """
+        lower_headers = self._get_headers(headers)
+        for remaining_header, reset_header in RATE_LIMIT_HEADERS:
+            if lower_headers.get(remaining_header) in ("0", 0):
+                reset = self._get_reset_wait_time(lower_headers.get(reset_header))
+                if reset and reset > 0:
+                    self.blocked_until = max(
+                        self.blocked_until,
+                        time.monotonic() + min(reset, float(self.max_wait)),
+                    )
+
+    def get_throttle_wait(self) -> float:
+        wait_time = self.blocked_until - time.monotonic()
+        if wait_time > 0 and self.can_retry(0, wait_time):
+            logging.info(
+                "{}: Rate limit exhausted, waiting {}s".format(
+                    self.__str__(), round(wait_time, 2)
+                )
+            )
+            return wait_time
+        return 0.0
+
+    def throttle(self) -> None:
+        wait_time = self.get_throttle_wait()
+        if wait_time:
+            time.sleep(wait_time)
+
+    async def async_throttle(self) -> None:
+        wait_time = self.get_throttle_wait()
+        if wait_time:
+            await asyncio.sleep(wait_time)
+
+
+class RetrySession(requests.Session):
+    """
+    requests session retrying throttled and transient errors with
+    a RetryPolicy. It raises RetryLimitExceeded instead of returning
+    the last throttled response so that callers (python-gitlab) do
+    not start their own retry loop on top of it. Responses go through
+    the cassette when recording or replaying. Connections come from
+    the shared HTTPTransport.
+    """
+
+    def __init__(
+        self,
+        policy: Optional[RetryPolicy] = None,
+        cassette: Cassette = run_cassette,
+        transport: HTTPTransport = http_transport,
+    ) -> None:
+        super().__init__()
+        self.policy = policy if policy else RetryPolicy()
+        self.cassette = cassette
+        transport.mount(self)
+
+    def _send(self, request, **kwargs) -> requests.Response:
+        path = get_request_path(request.url)
+        key = self.cassette.get_key("gitlab", request.method, path, request.body)
+        with track_request("gitlab", get_endpoint(request.method, path)) as tracked:
+            if self.cassette.replaying:
+                response = get_response(self.cassette.play(key), request)
+            else:
+                start_time = time.monotonic()
+                response = super().send(request, **kwargs)
+                self.cassette.record(
+                    key,
+                    response.status_code,
+                    response.headers,
+                    response.content.decode("utf-8", "replace"),
+                    time.monotonic() - start_time,
+                )
+            tracked["status"] = str(response.status_code)
+            tracked["size"] = get_size(request.body) + get_size(response.content)
+        return response
+
+    def send(self, request, **kwargs) -> requests.Response:  # type: ignore
+        endpoint = get_endpoint(request.method, get_request_path(request.url))
+        with tracer.start_span(
+            "gitlab {}".format(endpoint), SPAN_KIND_CLIENT, {"http.route": endpoint}
+        ) as span:
+            attempt = 0
+            while True:
+                span.set_attribute("g2s.retries", attempt)
+                self.policy.throttle()
+                response = self._send(request, **kwargs)
+                span.set_attribute("http.status_code", response.status_code)
+                self.policy.observe(response.headers)
+                if not is_retryable(request.method, response.status_code):
+                    return response
+                if not self.policy.wait(
+                    "{} {}".format(request.method, request.path_url),
+                    response.status_code,
+                    response.headers,
+                    attempt,
+                    request.method,
+                ):
+                    raise RetryLimitExceeded(response.status_code, request.path_url)
+                attempt += 1
@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import time
+from collections import namedtuple
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from gitlab2sentry.resources import settings
+from gitlab2sentry.utils.budget import Backlog, WriteBudget
+from gitlab2sentry.utils.retry import RunDeadline, run_deadline
+
+G2S_ACTION_DSN = "dsn"
+G2S_ACTION_SENTRYCLIRC = "sentryclirc"
+G2S_ACTION_NONE = "none"
+
+# Lower runs first: finishing the integration of teams who already
+# merged the .sentryclirc MR is worth more than a new proposal MR.
+G2S_ACTION_PRIORITIES: Dict[str, int] = {
+    G2S_ACTION_DSN: 0,
+    G2S_ACTION_SENTRYCLIRC: 1,
+    G2S_ACTION_NONE: 2,
+}
+
+G2STask = namedtuple("G2STask", ["action", "g2s_project", "sentry_group_name"])
+
+
+class Scheduler:
+    """
+    Ranks the projects of a run by the action they are pending for and
+    only starts an action if its estimated duration fits in what is
+    left of the run deadline and in the write budget. Deferred projects
+    go to the backlog, which is handled first by the next run. Skipped
+    projects (no action) cost no API call and are always handled.
+    """
+
+    def __init__(
+        self,
+        deadline: RunDeadline = run_deadline,
+        action_estimate: int = settings.scheduler_action_estimate,
+        budget: Optional[WriteBudget] = None,
+        backlog: Optional[Backlog] = None,
+    ) -> None:
+        self.deadline = deadline
+        self.budget = budget if budget is not None else WriteBudget(0, 0, 0, deadline)
+        self.backlog = backlog if backlog is not None else Backlog("")
+        self.tasks: List[G2STask] = list()
+        self.deferred_pids: List[int] = list()
+        self.deferred = 0
+        self.budget_deferred = 0
+        self._estimates: Dict[str, float] = {
+            G2S_ACTION_DSN: float(action_estimate),
+            G2S_ACTION_SENTRYCLIRC: float(action_estimate),
+            G2S_ACTION_NONE: 0.0,
+        }
+        # Concurrent admissions would all see room in the per minute rate
+        self._admission = asyncio.Lock()
+
+    def __str__(self) -> str:
+        return "<Scheduler>"
+
+    def add(self, task: G2STask) -> None:
+        self.tasks.append(task)
+
+    def get_rank(self, task: G2STask) -> Tuple[int, bool, float]:
+        # By action, then the backlog by deferral date
+        return (
+            G2S_ACTION_PRIORITIES[task.action],
+            task.g2s_project.pid not in self.backlog,
+            self.backlog.deferred_at.get(task.g2s_project.pid, 0.0),
+        )
+
+    def get_ranked_tasks(self) -> List[G2STask]:
+        # Newest projects (createdAt is an ISO date) first within a rank
+        tasks = sorted(
+            self.tasks, key=lambda task: task.g2s_project.created_at, reverse=True
+        )
+        return sorted(tasks, key=self.get_rank)
+
+    def estimate(self, action: str) -> float:
+        return self._estimates[action]
+
+    def record(self, action: str, duration: float) -> None:
+        # Exponential moving average of the observed action durations
+        self._estimates[action] = 0.7 * self._estimates[action] + 0.3 * duration
+
+    def _fits_deadline(self, action: str) -> bool:
+        remaining = self.deadline.remaining()
+        return remaining is None or self.estimate(action) <= remaining
+
+    def _defer(self, task: G2STask, reason: str) -> None:
+        logging.info(
+            "{}: [Deferring] Project {} - {} MR {}.".format(
+                self.__str__(), task.g2s_project.full_path, task.action, reason
+            )
+        )
+
+    def _admit(self, task: G2STask) -> bool:
+        # Checks of admit and async_admit, the per minute rate excepted
+        if not self._fits_deadline(task.action):
+            self._defer(task, "would not finish before the run deadline")
+            self.deferred += 1
+            self.deferred_pids.append(task.g2s_project.pid)
+            return False
+        if not self.budget.allows(task.sentry_group_name):
+            self._defer_over_budget(task)
+            return False
+        return True
+
+    def _defer_over_budget(self, task: G2STask) -> None:
+        self._defer(task, "is over the write budget")
+        self.budget_deferred += 1
+        self.deferred_pids.append(task.g2s_project.pid)
+
+    def admit(self, task: G2STask) -> bool:
+        """
+        Whether the action of a task can start now, counting it in the
+        write budget. A task that cannot is deferred to the backlog.
+        """
+        if task.action == G2S_ACTION_NONE:
+            return True
+        if not self._admit(task):
+            return False
+        if not self.budget.wait_for_rate():
+            self._defer_over_budget(task)
+            return False
+        self.budget.consume(task.sentry_group_name)
+        return True
+
+    async def async_admit(self, task: G2STask) -> bool:
+        """
+        admit waiting for the per minute rate on the event loop.
+        """
+        if task.action == G2S_ACTION_NONE:
+            return True
+        async with self._admission:
+            if not self._admit(task):
+                return False
+            if not await self.budget.async_wait_for_rate():
+                self._defer_over_budget(task)
+                return False
+            self.budget.consume(task.sentry_group_name)
+            return True
+
+    def done(self, task: G2STask, start_time: float) -> None:
+        if task.action != G2S_ACTION_NONE:
+            self.record(task.action, time.monotonic() - start_time)
+
+    def finish(self) -> None:
+        # Saves the backlog, even an empty one
+        self.backlog.save(self.deferred_pids)
+        self.deferred_pids = list()
+        self.tasks = list()
+
+    def run(self, handler: Callable[[G2STask], Any]) -> None:
+        for task in self.get_ranked_tasks():
+            if not self.admit(task):
+                continue
+            start_time = time.monotonic()
+            handler(task)
+            self.done(task, start_time)
+        self.finish()
+
+    async def run_async(
+        self, handler: Callable[[G2STask], Awaitable[Any]], concurrency: int
+    ) -> None:
+        """
+        run for the asyncio engine: tasks are admitted one at a time in
+        their rank order and up to concurrency of them are handled at
+        once, the next one starting as soon as one is done.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        running: Set["asyncio.Future[None]"] = set()
+
+        async def handle(task: G2STask) -> None:
+            try:
+                start_time = time.monotonic()
+                await handler(task)
+                self.done(task, start_time)
+            finally:
+                semaphore.release()
+
+        for task in self.get_ranked_tasks():
+            await semaphore.acquire()
+            if not await self.async_admit(task):
+                semaphore.release()
+                continue
+            future = asyncio.ensure_future(handle(task))
+            running.add(future)
+            future.add_done_callback(running.discard)
+        await asyncio.gather(*running)
+        self.finish()
@@ -1,16 +1,38 @@
 import json
 import logging
-from typing import Any, Dict, Optional, Tuple
+import time
+from typing import Any, Dict, Optional, Tuple, Union
 
-import requests
 from requests import Response
-from slugify import slugify
 
 from gitlab2sentry.exceptions import (
     SentryProjectCreationFailed,
     SentryProjectKeyIDNotFound,
 )
 from gitlab2sentry.resources import settings
+from gitlab2sentry.utils.accounting import get_size
+from gitlab2sentry.utils.async_http import AsyncHTTPClient, AsyncResponse
+from gitlab2sentry.utils.cassette import (
+    Cassette,
+    get_request_path,
+    get_response,
+    run_cassette,
+)
+from gitlab2sentry.utils.codec import json_codec
+from gitlab2sentry.utils.dsn_cache import DSNCache
+from gitlab2sentry.utils.metrics import get_endpoint, track_request
+from gitlab2sentry.utils.retry import RetryPolicy
+from gitlab2sentry.utils.tracing import SPAN_KIND_CLIENT, tracer
+from gitlab2sentry.utils.transport import http_transport
+
+SENTRY_KEY_RATE_LIMIT = {"window": 60, "count": 300}
+
+
+def get_slug(name: str) -> str:
+    # slugify loads its transliteration tables: only done for a slug to build
+    from slugify import slugify
+
+    return slugify(name)
 
 
 class SentryAPIClient:
@@ -18,24 +40,72 @@ class SentryAPIClient:
         self,
         base_url: Optional[str] = settings.sentry_url,
         token: Optional[str] = settings.sentry_token,
+        cassette: Cassette = run_cassette,
     ):
         self.base_url = base_url
         self.url = "{}/api/0/{}"
         self.headers = {"Authorization": f"Bearer {token}"}
+        self._session = http_transport.get_session(self.headers)
+        self._retry_policy = RetryPolicy()
+        self._cassette = cassette
 
     def __str__(self) -> str:
         return "<SentryAPIClient>"
 
-    def _get_json(self, response: Response) -> Tuple[int, Any]:
+    def _get_json(self, response: Union[Response, AsyncResponse]) -> Tuple[int, Any]:
         try:
-            return response.status_code, response.json()
+            return response.status_code, json_codec.loads(response.content)
         except json.JSONDecodeError as json_error:
             logging.warning(
                 "{}: Error on request suffix: {}".format(
                     self.__str__(), str(json_error)
                 )
             )
-            return 400, None
+            # Keep throttling and server errors visible to the caller
+            return (response.status_code if response.status_code >= 400 else 400), None
+
+    def _send(
+        self,
+        method: str,
+        url: str,
+        data: Optional[Dict[str, Any]],
+        json_format: bool,
+    ) -> Response:
+        path = get_request_path(url)
+        body = json.dumps(data, sort_keys=True)
+        key = self._cassette.get_key("sentry", method, path, body)
+        with track_request("sentry", get_endpoint(method, path)) as tracked:
+            if self._cassette.replaying:
+                response = get_response(self._cassette.play(key))
+            else:
+                start_time = time.monotonic()
+                response = self._request(method, url, data, json_format)
+                self._cassette.record(
+                    key,
+                    response.status_code,
+                    response.headers,
+                    response.text,
+                    time.monotonic() - start_time,
+                )
+            tracked["status"] = str(response.status_code)
+            tracked["size"] = get_size(body) + get_size(response.content)
+        return response
+
+    def _request(
+        self,
+        method: str,
+        url: str,
+        data: Optional[Dict[str, Any]],
+        json_format: bool,
+    ) -> Response:
+        if method == "post":
+            return self._session.post(url, data=data)
+        elif method == "put":
+            if json_format:
+                return self._session.put(url, json=data)
+            return self._session.put(url, data=data)
+        else:
+            return self._session.get(url)
 
     def simple_request(
         self,
@@ -46,16 +116,28 @@ class SentryAPIClient:
     ) -> Tuple[int, Any]:
         url = self.url.format(self.base_url, suffix)
         logging.debug("{} simple {} request to {}".format(self.__str__(), method, url))
-        if method == "post":
-            return self._get_json(requests.post(url, data=data, headers=self.headers))
-        elif method == "put":
-            if json_format:
-                return self._get_json(
-                    requests.put(url, json=data, headers=self.headers)
-                )
-            return self._get_json(requests.put(url, data=data, headers=self.headers))
-        else:
-            return self._get_json(requests.get(url, headers=self.headers))
+        endpoint = get_endpoint(method, get_request_path(url))
+        with tracer.start_span(
+            "sentry {}".format(endpoint), SPAN_KIND_CLIENT, {"http.route": endpoint}
+        ) as span:
+            attempt = 0
+            while True:
+                span.set_attribute("g2s.retries", attempt)
+                self._retry_policy.throttle()
+                response = self._send(method, url, data, json_format)
+                span.set_attribute("http.status_code", response.status_code)
+                self._retry_policy.observe(response.headers)
+                if not self._retry_policy.wait(
+                    "{} {}".format(method, suffix),
+                    response.status_code,
+                    response.headers,
+                    attempt,
+                    method,
+                ):
+                    if response.status_code >= 400:
+                        span.set_error("Returned {}".format(response.status_code))
+                    return self._get_json(response)
+                attempt += 1
 
 
 class SentryProvider:
@@ -64,16 +146,21 @@ class SentryProvider:
         url: Optional[str] = settings.sentry_url,
         token: Optional[str] = settings.sentry_token,
         org_slug: Optional[str] = settings.sentry_org_slug,
+        dsn_cache: Optional[DSNCache] = None,
     ):
         self.url = url
         self.org_slug = org_slug
-        self._client = SentryAPIClient(url, token)
+        self.dsn_cache = dsn_cache if dsn_cache else DSNCache("")
+        self._client = self._get_client(url, token)
 
     def __str__(self) -> str:
         return "<SentryProvider>"
 
+    def _get_client(self, url: Optional[str], token: Optional[str]) -> SentryAPIClient:
+        return SentryAPIClient(url, token)
+
     def _get_or_create_team(self, team_name: str) -> Optional[Dict[str, Any]]:
-        team_slug = slugify(team_name)
+        team_slug = get_slug(team_name)
         status_code, result = self._client.simple_request(
             "get", "teams/{}/{}/".format(self.org_slug, team_slug)
         )
@@ -111,7 +198,11 @@ class SentryProvider:
                     "slug": project_slug,
                 },
             )
+        return self._check_project(project_name, status_code, result)
 
+    def _check_project(
+        self, project_name: str, status_code: int, result: Any
+    ) -> Optional[Dict[str, Any]]:
         if status_code == 201:
             logging.info(
                 "{}: [Creating] Sentry project {}".format(self.__str__(), project_name)
@@ -132,7 +223,9 @@ class SentryProvider:
             "get",
             "projects/{}/{}/keys/".format(self.org_slug, project_slug),
         )
+        return self._read_dsn_and_key_id(status_code, result)
 
+    def _read_dsn_and_key_id(self, status_code: int, result: Any) -> tuple:
         if status_code != 200:
             return None, None
         if (
@@ -146,27 +239,41 @@ class SentryProvider:
         else:
             raise SentryProjectKeyIDNotFound(result)
 
+    def get_cached_dsn(self, project_slug: str) -> Optional[str]:
+        return self.dsn_cache.get(project_slug, SENTRY_KEY_RATE_LIMIT)
+
     def set_rate_limit_for_key(self, project_slug: str) -> Optional[str]:
+        cached_dsn = self.get_cached_dsn(project_slug)
+        if cached_dsn:
+            return cached_dsn
         try:
             dsn, key = self._get_dsn_and_key_id(project_slug)
             status_code, result = self._client.simple_request(
                 "put",
                 "projects/{}/{}/keys/{}/".format(self.org_slug, project_slug, key),
-                {"rateLimit": {"window": 60, "count": 300}},
+                {"rateLimit": SENTRY_KEY_RATE_LIMIT},
                 json_format=True,
             )
         except SentryProjectKeyIDNotFound as key_id_err:
-            logging.warning(
-                "{}: Project {} - Sentry key id not found: {}".format(
-                    self.__str__(),
-                    project_slug,
-                    key_id_err,
-                )
-            )
+            self._log_key_id_not_found(project_slug, key_id_err)
             return None
+        return self._cache_dsn(project_slug, status_code, key, dsn)
+
+    def _log_key_id_not_found(self, project_slug: str, err: Exception) -> None:
+        logging.warning(
+            "{}: Project {} - Sentry key id not found: {}".format(
+                self.__str__(),
+                project_slug,
+                err,
+            )
+        )
 
+    def _cache_dsn(
+        self, project_slug: str, status_code: int, key: str, dsn: str
+    ) -> Optional[str]:
         if status_code != 200:
             return None
+        self.dsn_cache.set(project_slug, key, dsn, SENTRY_KEY_RATE_LIMIT)
         return dsn
 
     def ensure_sentry_team(self, team_name: str) -> bool:
@@ -177,3 +284,132 @@ class SentryProvider:
             return True
         else:
             return False
+
+
+class AsyncSentryAPIClient(SentryAPIClient):
+    """
+    SentryAPIClient of the asyncio engine, its requests are sent with
+    an AsyncHTTPClient. Bodies are always sent as json.
+    """
+
+    def __init__(
+        self,
+        base_url: Optional[str] = settings.sentry_url,
+        token: Optional[str] = settings.sentry_token,
+        cassette: Cassette = run_cassette,
+    ):
+        super().__init__(base_url, token, cassette)
+        self._http = AsyncHTTPClient(
+            "sentry", self.headers, self._retry_policy, cassette
+        )
+
+    def __str__(self) -> str:
+        return "<AsyncSentryAPIClient>"
+
+    async def simple_request(  # type: ignore[override]
+        self,
+        method: str,
+        suffix: Optional[str] = None,
+        data: Optional[Dict[str, Any]] = None,
+        json_format: bool = False,
+    ) -> Tuple[int, Any]:
+        url = self.url.format(self.base_url, suffix)
+        logging.debug("{} simple {} request to {}".format(self.__str__(), method, url))
+        return self._get_json(await self._http.request(method.upper(), url, data))
+
+    async def close(self) -> None:
+        await self._http.close()
+
+
+class AsyncSentryProvider(SentryProvider):
+    """
+    SentryProvider of the asyncio engine, sharing the DSN cache and the
+    handling of the Sentry answers with the synchronous provider.
+    """
+
+    _client: AsyncSentryAPIClient
+
+    def __str__(self) -> str:
+        return "<AsyncSentryProvider>"
+
+    def _get_client(
+        self, url: Optional[str], token: Optional[str]
+    ) -> AsyncSentryAPIClient:
+        return AsyncSentryAPIClient(url, token)
+
+    async def _get_or_create_team(  # type: ignore[override]
+        self, team_name: str
+    ) -> Optional[Dict[str, Any]]:
+        team_slug = get_slug(team_name)
+        status_code, result = await self._client.simple_request(
+            "get", "teams/{}/{}/".format(self.org_slug, team_slug)
+        )
+        if status_code != 200:
+            return (
+                await self._client.simple_request(
+                    "post",
+                    "organizations/{}/teams/".format(self.org_slug),
+                    {
+                        "name": team_name,
+                        "slug": team_slug,
+                    },
+                )
+            )[1]
+        return None
+
+    async def get_or_create_project(  # type: ignore[override]
+        self, group_name: str, project_name: str, project_slug: str
+    ) -> Optional[Dict[str, Any]]:
+        status_code, result = await self._client.simple_request(
+            "get", "projects/{}/{}/".format(self.org_slug, project_slug)
+        )
+        # Create if project not found
+        if status_code == 404:
+            status_code, result = await self._client.simple_request(
+                "post",
+                "teams/{}/{}/projects/".format(self.org_slug, group_name),
+                {
+                    "name": project_name,
+                    "slug": project_slug,
+                },
+            )
+        return self._check_project(project_name, status_code, result)
+
+    async def _get_dsn_and_key_id(  # type: ignore[override]
+        self, project_slug: str
+    ) -> tuple:
+        status_code, result = await self._client.simple_request(
+            "get",
+            "projects/{}/{}/keys/".format(self.org_slug, project_slug),
+        )
+        return self._read_dsn_and_key_id(status_code, result)
+
+    async def set_rate_limit_for_key(  # type: ignore[override]
+        self, project_slug: str
+    ) -> Optional[str]:
+        cached_dsn = self.get_cached_dsn(project_slug)
+        if cached_dsn:
+            return cached_dsn
+        try:
+            dsn, key = await self._get_dsn_and_key_id(project_slug)
+            status_code, result = await self._client.simple_request(
+                "put",
+                "projects/{}/{}/keys/{}/".format(self.org_slug, project_slug, key),
+                {"rateLimit": SENTRY_KEY_RATE_LIMIT},
+                json_format=True,
+            )
+        except SentryProjectKeyIDNotFound as key_id_err:
+            self._log_key_id_not_found(project_slug, key_id_err)
+            return None
+        return self._cache_dsn(project_slug, status_code, key, dsn)
+
+    async def ensure_sentry_team(  # type: ignore[override]
+        self, team_name: str
+    ) -> bool:
+        logging.info(
+            "{}: Ensuring team {} exists on sentry".format(self.__str__(), team_name)
+        )
+        return bool(await self._get_or_create_team(team_name))
+
+    async def close(self) -> None:
+        await self._client.close()
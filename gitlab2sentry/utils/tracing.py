@@ -0,0 +1,153 @@
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Generator, Optional
+
+from gitlab2sentry.resources import settings
+
+# Names of the OpenTelemetry SpanKind members
+SPAN_KIND_INTERNAL = "internal"
+SPAN_KIND_CLIENT = "client"
+
+
+def _format_span(span: Any) -> str:
+    # One span per line
+    return span.to_json(indent=None) + os.linesep
+
+
+class Span:
+    """
+    Span handed to the traced code: an OpenTelemetry span, or nothing
+    when tracing is disabled.
+    """
+
+    def __init__(self, otel_span: Any = None) -> None:
+        self._otel_span = otel_span
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        if self._otel_span is not None and value is not None:
+            self._otel_span.set_attribute(key, value)
+
+    def set_error(self, message: str) -> None:
+        if self._otel_span is not None:
+            from opentelemetry.trace import Status, StatusCode
+
+            self._otel_span.set_status(Status(StatusCode.ERROR, message))
+
+
+NON_RECORDING_SPAN = Span()
+
+
+class Tracer:
+    """
+    Spans of a run recorded with the OpenTelemetry SDK, exported by batch
+    to an OTLP/HTTP endpoint and/or appended to a file (one JSON span per
+    line). Tracing is an optional extra (tracing-requirements.txt): without
+    it, or without file nor endpoint, spans are not recorded. The SDK is
+    only imported once the first span is started.
+    """
+
+    def __init__(
+        self,
+        file_path: str = settings.tracing_file_path,
+        otlp_endpoint: str = settings.tracing_otlp_endpoint,
+    ) -> None:
+        self.file_path = file_path
+        self.otlp_endpoint = otlp_endpoint
+        self._provider: Any = None
+        self._tracer: Any = None
+        self._lock = threading.Lock()
+        self.enabled = bool(file_path or otlp_endpoint)
+
+    def __str__(self) -> str:
+        return "<Tracer>"
+
+    def _get_tracer(self) -> Any:
+        with self._lock:
+            if self._tracer is None and self.enabled:
+                self._tracer = self._build_tracer()
+            return self._tracer
+
+    def _build_tracer(self) -> Any:
+        try:
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import (
+                OTLPSpanExporter,
+            )
+            from opentelemetry.sdk.resources import Resource
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import (
+                BatchSpanProcessor,
+                ConsoleSpanExporter,
+            )
+        except ImportError:
+            logging.warning(
+                "{}: opentelemetry-sdk is not installed, tracing is disabled".format(
+                    self.__str__()
+                )
+            )
+            self.enabled = False
+            return None
+        self._provider = TracerProvider(
+            resource=Resource.create(
+                {
+                    "service.name": "gitlab2sentry",
+                    "g2s.shard_index": settings.shard_index,
+                }
+            )
+        )
+        if self.file_path:
+            self._provider.add_span_processor(
+                BatchSpanProcessor(
+                    ConsoleSpanExporter(
+                        out=open(self.file_path, "a"),
+                        formatter=_format_span,
+                    )
+                )
+            )
+        if self.otlp_endpoint:
+            self._provider.add_span_processor(
+                BatchSpanProcessor(
+                    OTLPSpanExporter(
+                        endpoint="{}/v1/traces".format(self.otlp_endpoint.rstrip("/")),
+                        timeout=10,
+                    )
+                )
+            )
+        return self._provider.get_tracer("gitlab2sentry")
+
+    @contextmanager
+    def start_span(
+        self,
+        name: str,
+        kind: str = SPAN_KIND_INTERNAL,
+        attributes: Optional[Dict[str, Any]] = None,
+    ) -> Generator[Span, None, None]:
+        """
+        Opens a span, child of the current one, around the block. A block
+        raising an exception gives an errored span.
+        """
+        tracer = self._get_tracer()
+        if tracer is None:
+            yield NON_RECORDING_SPAN
+            return
+        from opentelemetry.trace import SpanKind
+
+        with tracer.start_as_current_span(
+            name,
+            kind=SpanKind[kind.upper()],
+            attributes={
+                key: value
+                for key, value in (attributes or {}).items()
+                if value is not None
+            },
+        ) as otel_span:
+            yield Span(otel_span)
+
+    def flush(self) -> None:
+        # The exporters log their own failures: tracing never fails a run
+        if self._provider is not None:
+            self._provider.force_flush()
+
+
+tracer = Tracer()
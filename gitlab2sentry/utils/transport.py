@@ -0,0 +1,100 @@
+import logging
+from typing import Any, Callable, List, Mapping, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
+
+from gitlab2sentry.resources import settings
+from gitlab2sentry.utils.http_cache import HTTPCache
+
+ResponseHook = Callable[[requests.Response], None]
+
+
+class TransportAdapter(HTTPAdapter):
+    """
+    requests adapter of the HTTPTransport: one bounded pool of
+    connections per host, the transport timeout for calls that do
+    not give their own and the HTTP cache for GET requests.
+    """
+
+    def __init__(self, pool_size: int, timeout: int) -> None:
+        self.timeout = timeout
+        # Disabled until a run sets its own (see HTTPTransport.set_cache)
+        self.cache = HTTPCache("")
+        super().__init__(
+            pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True
+        )
+
+    def send(  # type: ignore[override]
+        self, request: requests.PreparedRequest, timeout: Any = None, **kwargs: Any
+    ) -> requests.Response:
+        if self.cache.is_enabled():
+            cached = self.cache.get(request)
+            if cached is not None:
+                return cached
+        response = super().send(
+            request, timeout=timeout if timeout else self.timeout, **kwargs
+        )
+        if self.cache.is_enabled():
+            return self.cache.update(request, response)
+        return response
+
+
+class HTTPTransport:
+    """
+    HTTP stack shared by the GitLab REST (python-gitlab), GitLab
+    GraphQL and Sentry clients. Their sessions keep their own headers
+    (tokens) but share one adapter, hence the connection pools and
+    their limit (HTTP_POOL_SIZE connections per host), the timeout
+    (HTTP_TIMEOUT), the HTTP cache and compressed
+    responses. Hooks added with add_hook are called with every response.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = settings.http_pool_size,
+        timeout: int = settings.http_timeout,
+    ) -> None:
+        self.adapter = TransportAdapter(pool_size, timeout)
+        self.hooks: List[ResponseHook] = list()
+
+    def __str__(self) -> str:
+        return "<HTTPTransport>"
+
+    def set_cache(self, cache: HTTPCache) -> None:
+        self.adapter.cache = cache
+
+    def add_hook(self, hook: ResponseHook) -> None:
+        self.hooks.append(hook)
+
+    def _call_hooks(
+        self, response: requests.Response, *args: Any, **kwargs: Any
+    ) -> None:
+        for hook in self.hooks:
+            try:
+                hook(response)
+            except Exception as err:
+                logging.warning(
+                    "{}: Response hook failed: {}".format(self.__str__(), err)
+                )
+
+    def mount(self, session: requests.Session) -> requests.Session:
+        session.mount("http://", self.adapter)
+        session.mount("https://", self.adapter)
+        session.headers["Accept-Encoding"] = ACCEPT_ENCODING
+        session.hooks["response"].append(self._call_hooks)
+        return session
+
+    def get_session(
+        self, headers: Optional[Mapping[str, str]] = None
+    ) -> requests.Session:
+        session = self.mount(requests.Session())
+        session.headers.update(headers or {})
+        return session
+
+    def close(self) -> None:
+        self.adapter.close()
+
+
+http_transport = HTTPTransport()
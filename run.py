@@ -1,13 +1,30 @@
+import time
+
 import sentry_sdk
 
-from gitlab2sentry import Gitlab2Sentry
-from gitlab2sentry.resources import SENTRY_DSN, SENTRY_ENV
+from gitlab2sentry import AsyncGitlab2Sentry, Gitlab2Sentry
+from gitlab2sentry.resources import settings
+from gitlab2sentry.utils import (
+    export_metrics,
+    run_deadline,
+    run_profiler,
+    start_metrics_server,
+)
 
 if __name__ == "__main__":
     sentry_sdk.init(  # type: ignore
         debug=False,
-        dsn=SENTRY_DSN,
-        environment=SENTRY_ENV,
+        dsn=settings.sentry_dsn,
+        environment=settings.sentry_env,
     )
-    runner = Gitlab2Sentry()
-    runner.update()
+    start_metrics_server()
+    while True:
+        run_deadline.start()
+        runner = AsyncGitlab2Sentry() if settings.async_concurrency else Gitlab2Sentry()
+        with run_profiler.profile():
+            runner.update()
+        export_metrics()
+        # Long-running mode (RUN_INTERVAL) keeps /metrics up between runs
+        if not settings.run_interval:
+            break
+        time.sleep(settings.run_interval)
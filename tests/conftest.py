@@ -76,7 +76,6 @@ def create_test_g2s_project(**kwargs):
         TEST_GROUP_NAME,
         kwargs["mrs_enabled"],
         CURRENT_TIME,
-        f"{TEST_GROUP_NAME} / {TEST_PROJECT_NAME}",
         kwargs["has_sentryclirc_file"],
         kwargs["has_dsn"],
         kwargs["sentryclirc_mr_state"],
@@ -92,7 +91,8 @@ def create_graphql_json_object(**kwargs):
             "name": TEST_PROJECT_NAME,
             "mergeRequestsEnabled": kwargs["mrs_enabled"],
             "group": {"name": kwargs.get("group", TEST_GROUP_NAME)},
-            "mergeRequests": {"nodes": []},
+            "sentryclircMergeRequests": {"nodes": []},
+            "dsnMergeRequests": {"nodes": []},
         }
     }
     response_dict["node"]["createdAt"] = kwargs.get("created_at", CURRENT_TIME)
@@ -120,23 +120,19 @@ def create_graphql_json_object(**kwargs):
 
     if kwargs["sentryclirc_mr_state"]:
         sentryclirc_mr = {
-            "id": "gid://gitlab/MergeRequest/0001",
-            "title": settings.sentryclirc_mr_title.format(
-                project_name=response_dict["node"]["name"]
-            ),
+            "sourceBranch": settings.sentryclirc_branch_name,
             "state": kwargs["sentryclirc_mr_state"],
         }
-        response_dict["node"]["mergeRequests"]["nodes"].append(sentryclirc_mr)
+        response_dict["node"]["sentryclircMergeRequests"]["nodes"].append(
+            sentryclirc_mr
+        )
 
     if kwargs["dsn_mr_state"]:
         dsn_mr = {
-            "id": "gid://gitlab/MergeRequest/0001",
-            "title": settings.dsn_mr_title.format(
-                project_name=response_dict["node"]["name"]
-            ),
+            "sourceBranch": settings.dsn_branch_name,
             "state": kwargs["dsn_mr_state"],
         }
-        response_dict["node"]["mergeRequests"]["nodes"].append(dsn_mr)
+        response_dict["node"]["dsnMergeRequests"]["nodes"].append(dsn_mr)
     return response_dict
 
 
@@ -373,10 +369,9 @@ GRAPHQL_TEST_QUERY = {
                 }
             }
         }
-        mergeRequests {
+        sentryclircMergeRequests: mergeRequests {
             nodes {
-                id
-                title
+                sourceBranch
                 state
             }
         }
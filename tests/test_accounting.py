@@ -0,0 +1,49 @@
+import json
+
+from gitlab2sentry.utils.accounting import (
+    CallAccounting,
+    current_phase,
+    get_size,
+    phase_scope,
+    project_scope,
+)
+from gitlab2sentry.utils.metrics import track_phase
+
+
+def test_call_accounting_report(tmp_path):
+    path = tmp_path / "calls.json"
+    accounting = CallAccounting(top_projects=1, report_path=str(path))
+    with phase_scope("scan"):
+        accounting.record("graphql", "graphql list_projects", 1000)
+    with phase_scope("write"):
+        accounting.record("sentry", "GET /api/0/teams/:param/:param", 10)
+        with project_scope("group/big"):
+            for _ in range(3):
+                accounting.record("gitlab", "GET /api/v4/projects/:param", 100)
+        with project_scope("group/small"):
+            accounting.record("gitlab", "GET /api/v4/projects/:param", 50)
+
+    report = accounting.report(mrs_created=2)
+    assert report["calls"] == 6 and report["bytes"] == 1360
+    assert report["calls_by_phase"] == {"scan": 1, "write": 5}
+    assert report["calls_by_endpoint"]["gitlab GET /api/v4/projects/:param"] == 4
+    assert report["calls_per_project"] == 2.0
+    assert report["calls_per_mr"] == 2.5
+    assert report["top_projects"] == [
+        {"project": "group/big", "calls": 3, "bytes": 300}
+    ]
+    assert json.loads(path.read_text()) == report
+
+    accounting.reset()
+    assert accounting.get_report(0)["calls"] == 0
+
+
+def test_track_phase_sets_phase():
+    with track_phase("provision"):
+        assert current_phase.get() == "provision"
+    assert current_phase.get() == "none"
+
+
+def test_get_size():
+    assert get_size(b"abc") == 3 and get_size("ab") == 2
+    assert get_size(None) == 0 and get_size(object()) == 0
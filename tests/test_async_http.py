@@ -0,0 +1,67 @@
+import asyncio
+import json
+
+from gitlab2sentry.utils.async_http import AsyncHTTPClient, AsyncResponse
+from gitlab2sentry.utils.cassette import Cassette
+from gitlab2sentry.utils.retry import RetryPolicy, RunDeadline
+
+URL = "http://sentry.test/api/0/teams/org/team/"
+
+
+def test_async_request_retries(mocker):
+    client = AsyncHTTPClient("sentry", {}, RetryPolicy(2, 0, RunDeadline(0)))
+    fetch = mocker.patch.object(
+        client,
+        "fetch",
+        side_effect=[AsyncResponse(503, {}, b""), AsyncResponse(200, {}, b"{}")],
+    )
+    response = asyncio.run(client.request("GET", URL))
+    assert response.status_code == 200
+    assert fetch.call_count == 2
+
+    # The last response is returned once the retries are over
+    fetch.side_effect = [AsyncResponse(503, {}, b"")] * 3
+    assert asyncio.run(client.request("GET", URL)).status_code == 503
+
+
+def test_async_request_body(mocker):
+    client = AsyncHTTPClient("sentry", {})
+    fetch = mocker.patch.object(
+        client, "fetch", return_value=AsyncResponse(201, {}, b"{}")
+    )
+    asyncio.run(client.request("POST", URL, {"slug": "team"}))
+    method, url, body = fetch.call_args[0]
+    assert (method, url, json.loads(body)) == ("POST", URL, {"slug": "team"})
+    asyncio.run(client.request("GET", URL))
+    assert fetch.call_args[0] == ("GET", URL, None)
+
+
+def test_async_request_cassette(tmp_path, mocker):
+    path = str(tmp_path / "cassette.jsonl.gz")
+    recording = Cassette(path, "record")
+    client = AsyncHTTPClient("sentry", {}, cassette=recording)
+    mocker.patch.object(
+        client, "fetch", return_value=AsyncResponse(200, {"ETag": "v1"}, b'{"a": 1}')
+    )
+    asyncio.run(client.request("GET", URL))
+    recording.close()
+
+    client = AsyncHTTPClient("sentry", {}, cassette=Cassette(path, "replay"))
+    fetch = mocker.patch.object(client, "fetch")
+    response = asyncio.run(client.request("GET", URL))
+    assert response == AsyncResponse(200, {"ETag": "v1"}, b'{"a": 1}')
+    fetch.assert_not_called()
+
+
+def test_async_session():
+    client = AsyncHTTPClient("gitlab", {"PRIVATE-TOKEN": "token"}, pool_size=3)
+
+    async def get_session():
+        session = client._get_session()
+        assert client._get_session() is session
+        assert session.connector.limit_per_host == 3
+        assert session.headers["PRIVATE-TOKEN"] == "token"
+        await client.close()
+
+    asyncio.run(get_session())
+    assert client._session is None
@@ -0,0 +1,52 @@
+from gitlab2sentry.utils.budget import Backlog, WriteBudget
+from gitlab2sentry.utils.retry import RunDeadline
+from tests.conftest import TEST_GROUP_NAME
+
+
+def test_write_budget_allows():
+    budget = WriteBudget(per_run=3, per_group=2, per_minute=0)
+    assert budget.allows(TEST_GROUP_NAME)
+    budget.consume(TEST_GROUP_NAME)
+    budget.consume(TEST_GROUP_NAME)
+    assert not budget.allows(TEST_GROUP_NAME)
+    assert budget.allows("other-group")
+    budget.consume("other-group")
+    assert not budget.allows("another-group")
+
+    assert WriteBudget(0, 0, 0).allows(TEST_GROUP_NAME)
+
+
+def test_write_budget_wait_for_rate(mocker):
+    sleep = mocker.patch("time.sleep")
+    budget = WriteBudget(0, 0, per_minute=2, deadline=RunDeadline(0))
+    budget.consume(TEST_GROUP_NAME)
+    assert budget.wait_for_rate() and not sleep.called
+    budget.consume(TEST_GROUP_NAME)
+    assert budget.wait_for_rate()
+    assert 0 < sleep.call_args[0][0] <= 60
+
+    budget = WriteBudget(0, 0, per_minute=1, deadline=RunDeadline(30))
+    budget.consume(TEST_GROUP_NAME)
+    assert not budget.wait_for_rate()
+
+
+def test_backlog(tmp_path):
+    path = str(tmp_path / "backlog.json")
+    backlog = Backlog(path)
+    assert not len(backlog)
+    backlog.save([1, 2])
+
+    backlog = Backlog(path)
+    assert 1 in backlog and 2 in backlog
+    first_deferred_at = backlog.get_deferred_at(1)
+    backlog.save([1, 3])
+
+    backlog = Backlog(path)
+    assert 2 not in backlog and 3 in backlog
+    assert backlog.get_deferred_at(1) == first_deferred_at
+
+
+def test_backlog_unreadable(tmp_path):
+    path = tmp_path / "backlog.json"
+    path.write_text("not json")
+    assert not len(Backlog(str(path)))
@@ -0,0 +1,124 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from gitlab2sentry.exceptions import CassetteInteractionNotFound
+from gitlab2sentry.utils.cassette import Cassette, get_request_path, get_response
+
+
+def test_cassette_disabled(tmp_path):
+    cassette = Cassette("", "record")
+    cassette.record("key", 200, {}, "body", 0.1)
+    cassette.close()
+    assert not cassette.recording and not cassette.replaying
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_cassette_record_replay(tmp_path, mocker):
+    path = str(tmp_path / "run.jsonl.gz")
+    recorder = Cassette(path, "record")
+    key = recorder.get_key("sentry", "get", "/api/0/teams/org/team/")
+    assert key == recorder.get_key("sentry", "GET", "/api/0/teams/org/team/", b"")
+    recorder.record(key, 429, {"Retry-After": "1"}, None, 0.5)
+    recorder.record(key, 200, {}, '{"slug": "team"}', 0.25)
+    recorder.close()
+
+    sleep = mocker.patch("time.sleep")
+    player = Cassette(path, "replay", realtime=True)
+    assert player.play(key)["status_code"] == 429
+    response = get_response(player.play(key))
+    assert response.status_code == 200 and response.json() == {"slug": "team"}
+    assert [call.args[0] for call in sleep.call_args_list] == [0.5, 0.25]
+    with pytest.raises(CassetteInteractionNotFound):
+        player.play(key)
+
+
+def test_cassette_per_run(tmp_path, mocker):
+    path = str(tmp_path / "run.jsonl.gz")
+    cassette = Cassette(path, "record", per_run=True)
+    key = cassette.get_key("gitlab", "GET", "/api/v4/user")
+    run_times = [time.gmtime(0), time.gmtime(60)]
+    gmtime = mocker.patch("time.gmtime")
+    for run_time in (0, 60):
+        gmtime.return_value = run_times.pop(0)
+        cassette.record(key, 200, {}, str(run_time), 0.1)
+        cassette.close()
+    # A run does not overwrite the recording of the previous one
+    paths = sorted(str(item) for item in tmp_path.iterdir())
+    assert paths == [
+        str(tmp_path / "run.jsonl-19700101T000000Z.gz"),
+        str(tmp_path / "run.jsonl-19700101T000100Z.gz"),
+    ]
+
+    player = Cassette(paths[1], "replay", per_run=True)
+    for _ in range(2):
+        assert player.play(key)["body"] == "60"
+        player.close()
+
+
+def test_cassette_replay_changed_body(tmp_path):
+    path = str(tmp_path / "run.jsonl.gz")
+    recorder = Cassette(path, "record")
+    first = recorder.get_key("gitlab", "PUT", "/api/v4/projects/1", "first")
+    second = recorder.get_key("gitlab", "PUT", "/api/v4/projects/1", "second")
+    recorder.record(first, 200, {}, "first", 0.1)
+    recorder.record(second, 200, {}, "second", 0.1)
+    recorder.close()
+
+    player = Cassette(path, "replay")
+    assert player.play(second)["body"] == "second"
+    changed = player.get_key("gitlab", "PUT", "/api/v4/projects/1", "changed")
+    assert player.play(changed)["body"] == "first"
+
+
+def test_get_key_is_canonical():
+    cassette = Cassette("", "")
+    data = {"branch": "b", "ref": "main", "content": "x"}
+    # The sync and async clients encode the same data differently
+    key = cassette.get_key("gitlab", "POST", "/api/v4/projects/1", json.dumps(data))
+    assert key == cassette.get_key(
+        "gitlab", "POST", "/api/v4/projects/1", json.dumps(data, sort_keys=True)
+    )
+    assert key == cassette.get_key(
+        "gitlab", "POST", "/api/v4/projects/1", json.dumps(data).encode()
+    )
+    assert cassette.get_key("sentry", "GET", "/", "null") == cassette.get_key(
+        "sentry", "GET", "/"
+    )
+    assert cassette.get_key("gitlab", "PUT", "/", "a=1") != cassette.get_key(
+        "gitlab", "PUT", "/", "a=2"
+    )
+
+
+def test_cassette_async_play(tmp_path, mocker):
+    path = str(tmp_path / "run.jsonl.gz")
+    recorder = Cassette(path, "record")
+    recorder.record("key", 200, {}, "body", 0.5)
+    recorder.close()
+
+    sleep = mocker.patch("time.sleep")
+    async_sleep = mocker.patch("asyncio.sleep")
+    player = Cassette(path, "replay", realtime=True)
+    assert asyncio.run(player.async_play("key"))["body"] == "body"
+    # The event loop is not blocked by the recorded duration
+    assert not sleep.called
+    async_sleep.assert_called_once_with(0.5)
+
+
+def test_cassette_truncated(tmp_path):
+    path = tmp_path / "run.jsonl.gz"
+    recorder = Cassette(str(path), "record")
+    recorder.record("key", 200, {}, "body", 0.1)
+    recorder.record("key", 200, {}, "body", 0.1)
+    recorder.close()
+    path.write_bytes(path.read_bytes()[:-12])
+
+    player = Cassette(str(path), "replay")
+    assert player.play("key")["body"] == "body"
+
+
+def test_get_request_path():
+    assert get_request_path("http://gitlab/api/v4/user") == "/api/v4/user"
+    assert get_request_path("http://gitlab/api/v4/p?ref=main") == "/api/v4/p?ref=main"
@@ -0,0 +1,33 @@
+import json
+
+import pytest
+
+from gitlab2sentry.utils import codec as codec_module
+from gitlab2sentry.utils.codec import (
+    JSON_BACKEND_ORJSON,
+    JSON_BACKEND_STDLIB,
+    JSONCodec,
+)
+
+DOCUMENT = {"b": [1, 2.5, None, True], "a": "é"}
+
+
+@pytest.mark.parametrize("backend", [JSON_BACKEND_ORJSON, JSON_BACKEND_STDLIB])
+def test_codec(backend):
+    codec = JSONCodec(backend)
+    encoded = codec.dumps(DOCUMENT, sort_keys=True)
+    assert isinstance(encoded, str)
+    assert list(json.loads(encoded)) == ["a", "b"]
+    assert codec.loads(encoded) == DOCUMENT
+    assert codec.loads(encoded.encode()) == DOCUMENT
+    with pytest.raises(json.JSONDecodeError):
+        codec.loads(b'{"a": ')
+
+
+def test_codec_backend(mocker):
+    assert JSONCodec("auto").backend == JSON_BACKEND_ORJSON
+    assert JSONCodec(JSON_BACKEND_STDLIB).backend == JSON_BACKEND_STDLIB
+    # orjson is optional
+    mocker.patch.object(codec_module, "orjson", None)
+    assert JSONCodec("auto").backend == JSON_BACKEND_STDLIB
+    assert JSONCodec(JSON_BACKEND_ORJSON).backend == JSON_BACKEND_STDLIB
@@ -0,0 +1,29 @@
+from gitlab2sentry.utils.dsn_cache import DSNCache
+from gitlab2sentry.utils.sentry_provider import SENTRY_KEY_RATE_LIMIT
+
+DSN = "http://key@sentry.test/1"
+
+
+def test_dsn_cache(tmp_path):
+    path = str(tmp_path / "dsn.json")
+    cache = DSNCache(path, max_age=1)
+    assert cache.get("test", SENTRY_KEY_RATE_LIMIT) is None
+    cache.set("test", "key", DSN, SENTRY_KEY_RATE_LIMIT)
+    assert cache.get("test", SENTRY_KEY_RATE_LIMIT) == DSN
+    # Keys set up with another rate limit are checked again
+    assert cache.get("test", {"window": 60, "count": 10}) is None
+
+    cache.save()
+    assert DSNCache(path, max_age=1).get("test", SENTRY_KEY_RATE_LIMIT) == DSN
+    assert DSNCache(path, max_age=0).get("test", SENTRY_KEY_RATE_LIMIT) is None
+
+
+def test_dsn_cache_unreadable(tmp_path):
+    path = tmp_path / "dsn.json"
+    path.write_text("{")
+    assert not DSNCache(str(path)).keys
+    # An empty path keeps the cache in memory only
+    cache = DSNCache("")
+    cache.set("test", "key", DSN, SENTRY_KEY_RATE_LIMIT)
+    cache.save()
+    assert cache.get("test", SENTRY_KEY_RATE_LIMIT) == DSN
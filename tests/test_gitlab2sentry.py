@@ -1,7 +1,24 @@
+from dataclasses import replace
+
+import pytest
+
+from gitlab2sentry import AsyncGitlab2Sentry, Gitlab2Sentry
 from gitlab2sentry.exceptions import SentryProjectCreationFailed
-from gitlab2sentry.resources import settings
-from gitlab2sentry.utils import GitlabProvider, SentryProvider
-from tests.conftest import TEST_GROUP_NAME
+from gitlab2sentry.resources import GRAPHQL_LIST_PROJECTS_QUERY, MRState, settings
+from gitlab2sentry.utils import (
+    G2S_ACTION_DSN,
+    G2S_ACTION_NONE,
+    G2S_ACTION_SENTRYCLIRC,
+    SENTRY_KEY_RATE_LIMIT,
+    AsyncGitlabProvider,
+    AsyncSentryProvider,
+    GitlabProvider,
+    HTTPCache,
+    RunJournal,
+    SentryProvider,
+    http_transport,
+)
+from tests.conftest import TEST_GROUP_NAME, create_graphql_json_object
 
 
 def test_get_gitlab_provider(g2s_fixture):
@@ -69,6 +86,13 @@ def test_closed_sentryclirc_mr_found(
     )
 
 
+def get_mr_nodes(payload):
+    return (
+        payload["node"]["sentryclircMergeRequests"]["nodes"]
+        + payload["node"]["dsnMergeRequests"]["nodes"]
+    )
+
+
 def test_get_mr_states(
     g2s_fixture,
     payload_new_project,
@@ -80,45 +104,48 @@ def test_get_mr_states(
     payload_dsn_mr_closed_project,
     payload_sentry_project,
 ):
-    assert g2s_fixture._get_mr_states(
-        payload_new_project["node"]["name"],
-        payload_new_project["node"]["mergeRequests"]["nodes"],
-    ) == (None, None)
+    assert g2s_fixture._get_mr_states(get_mr_nodes(payload_new_project)) == (None, None)
 
     assert g2s_fixture._get_mr_states(
-        payload_sentryclirc_mr_open_project["node"]["name"],
-        payload_sentryclirc_mr_open_project["node"]["mergeRequests"]["nodes"],
+        get_mr_nodes(payload_sentryclirc_mr_open_project)
     ) == ("opened", None)
 
-    assert g2s_fixture._get_mr_states(
-        payload_mrs_disabled_project["node"]["name"],
-        payload_mrs_disabled_project["node"]["mergeRequests"]["nodes"],
-    ) == (None, None)
+    assert g2s_fixture._get_mr_states(get_mr_nodes(payload_mrs_disabled_project)) == (
+        None,
+        None,
+    )
 
     assert g2s_fixture._get_mr_states(
-        payload_sentryclirc_mr_closed_project["node"]["name"],
-        payload_sentryclirc_mr_closed_project["node"]["mergeRequests"]["nodes"],
+        get_mr_nodes(payload_sentryclirc_mr_closed_project)
     ) == ("closed", None)
 
     assert g2s_fixture._get_mr_states(
-        payload_sentryclirc_mr_merged_project["node"]["name"],
-        payload_sentryclirc_mr_merged_project["node"]["mergeRequests"]["nodes"],
+        get_mr_nodes(payload_sentryclirc_mr_merged_project)
     ) == ("merged", None)
 
-    assert g2s_fixture._get_mr_states(
-        payload_dsn_mr_open_project["node"]["name"],
-        payload_dsn_mr_open_project["node"]["mergeRequests"]["nodes"],
-    ) == ("merged", "opened")
+    assert g2s_fixture._get_mr_states(get_mr_nodes(payload_dsn_mr_open_project)) == (
+        "merged",
+        "opened",
+    )
 
-    assert g2s_fixture._get_mr_states(
-        payload_dsn_mr_closed_project["node"]["name"],
-        payload_dsn_mr_closed_project["node"]["mergeRequests"]["nodes"],
-    ) == ("merged", "closed")
+    assert g2s_fixture._get_mr_states(get_mr_nodes(payload_dsn_mr_closed_project)) == (
+        "merged",
+        "closed",
+    )
 
+    assert g2s_fixture._get_mr_states(get_mr_nodes(payload_sentry_project)) == (
+        "merged",
+        "merged",
+    )
+
+    # Only the latest MR of each gitlab2sentry branch counts
     assert g2s_fixture._get_mr_states(
-        payload_sentry_project["node"]["name"],
-        payload_sentry_project["node"]["mergeRequests"]["nodes"],
-    ) == ("merged", "merged")
+        [
+            {"sourceBranch": settings.sentryclirc_branch_name, "state": "merged"},
+            {"sourceBranch": settings.sentryclirc_branch_name, "state": "opened"},
+            {"sourceBranch": "feature", "state": "opened"},
+        ]
+    ) == ("merged", None)
 
 
 def test_is_group_project(g2s_fixture, payload_no_group_project, payload_new_project):
@@ -175,13 +202,80 @@ def test_get_g2s_project(
     ) == g2s_sentry_project
 
 
-def test_get_paginated_projects(g2s_fixture, payload_new_project, mocker):
+def test_get_g2s_project_is_compact(g2s_fixture, payload_sentryclirc_mr_open_project):
+    g2s_project = g2s_fixture._get_g2s_project(
+        payload_sentryclirc_mr_open_project["node"]
+    )
+    other_project = g2s_fixture._get_g2s_project(
+        payload_sentryclirc_mr_open_project["node"]
+    )
+    assert not hasattr(g2s_project, "__dict__")
+    assert g2s_project.group is other_project.group
+    assert g2s_project.sentryclirc_mr_state is MRState.OPENED
+    assert g2s_project.name_with_namespace == "{} / {}".format(
+        g2s_project.group, g2s_project.name
+    )
+
+
+def test_iter_paginated_projects(g2s_fixture, payload_new_project, mocker):
     mocker.patch.object(
         g2s_fixture.gitlab_provider,
         attribute="get_all_projects",
         return_value=[payload_new_project],
     )
-    assert isinstance(g2s_fixture._get_paginated_projects(), list)
+    mocker.patch.object(
+        g2s_fixture.gitlab_provider,
+        attribute="get_prefilter_savings",
+        return_value={"archived": 3},
+    )
+    assert list(g2s_fixture._iter_paginated_projects()) == [payload_new_project]
+    # Reported once the scan is done
+    assert g2s_fixture.run_stats["prefiltered_archived"] == 3
+
+
+def test_iter_paginated_projects_resume(
+    g2s_fixture, payload_new_project, tmp_path, mocker
+):
+    path = str(tmp_path / "journal.jsonl")
+    RunJournal(path).record_page("first-cursor", [payload_new_project])
+    g2s_fixture.journal = RunJournal(path)
+    get_all_projects = mocker.patch.object(
+        g2s_fixture.gitlab_provider,
+        attribute="get_all_projects",
+        return_value=[[payload_new_project]],
+    )
+    mocker.patch.object(
+        g2s_fixture.gitlab_provider, attribute="get_prefilter_savings", return_value={}
+    )
+    assert len(list(g2s_fixture._iter_paginated_projects())) == 2
+    assert get_all_projects.call_args[0][1] == "first-cursor"
+    # Resumed pages are handed over, not kept by the journal
+    assert g2s_fixture.journal.pages == []
+    assert RunJournal(path).scan_done
+
+
+def test_update_resumed_after_mr_step(g2s_fixture, g2s_new_project, tmp_path, mocker):
+    journal = RunJournal(str(tmp_path / "journal.jsonl"))
+    for step in ("branch", "file", "mr"):
+        journal.record_step(g2s_new_project.pid, settings.sentryclirc_branch_name, step)
+    g2s_fixture.journal = g2s_fixture.gitlab_provider.journal = journal
+    project = mocker.MagicMock()
+    mocker.patch.object(
+        g2s_fixture.gitlab_provider.gitlab.projects,
+        attribute="get",
+        return_value=project,
+    )
+    mocker.patch.object(
+        g2s_fixture,
+        attribute="_get_gitlab_groups",
+        return_value={TEST_GROUP_NAME: [g2s_new_project]},
+    )
+    mocker.patch.object(g2s_fixture, attribute="_ensure_sentry_group")
+    g2s_fixture.update()
+    # The MR opened by the interrupted run is not opened again, but pending
+    assert not project.mergerequests.create.called
+    assert g2s_fixture.run_stats["mr_sentryclirc_created"] == 0
+    assert g2s_fixture.pending.pids == {g2s_new_project.pid}
 
 
 def test_get_gitlab_project(g2s_fixture, g2s_new_project, payload_new_project, mocker):
@@ -201,7 +295,7 @@ def test_get_gitlab_project(g2s_fixture, g2s_new_project, payload_new_project, m
 def test_get_gitlab_groups(g2s_fixture, g2s_new_project, payload_new_project, mocker):
     mocker.patch.object(
         g2s_fixture,
-        attribute="_get_paginated_projects",
+        attribute="_iter_paginated_projects",
         return_value=[[payload_new_project]],
     )
     assert g2s_new_project.group in g2s_fixture._get_gitlab_groups().keys()
@@ -248,6 +342,28 @@ def test_create_sentry_project(g2s_fixture, payload_new_project, mocker):
     )
 
 
+def test_get_g2s_action(
+    g2s_fixture,
+    g2s_new_project,
+    g2s_disabled_mr_project,
+    g2s_sentryclirc_mr_open_project,
+    g2s_sentryclirc_mr_merged_project,
+    g2s_dsn_mr_closed_project,
+    g2s_sentry_project,
+):
+    assert g2s_fixture._get_g2s_action(g2s_new_project) == G2S_ACTION_SENTRYCLIRC
+    assert (
+        g2s_fixture._get_g2s_action(g2s_sentryclirc_mr_merged_project) == G2S_ACTION_DSN
+    )
+    for g2s_project in [
+        g2s_disabled_mr_project,
+        g2s_sentryclirc_mr_open_project,
+        g2s_dsn_mr_closed_project,
+        g2s_sentry_project,
+    ]:
+        assert g2s_fixture._get_g2s_action(g2s_project) == G2S_ACTION_NONE
+
+
 def test_handle_g2s_project(
     g2s_fixture,
     g2s_new_project,
@@ -304,6 +420,34 @@ def test_handle_g2s_project(
     )
 
 
+def test_handle_g2s_project_cached_dsn(
+    g2s_fixture, g2s_sentryclirc_mr_merged_project, mocker
+):
+    g2s_fixture.sentry_provider.dsn_cache.set(
+        g2s_sentryclirc_mr_merged_project.name.lower(),
+        "key",
+        settings.sentry_dsn,
+        SENTRY_KEY_RATE_LIMIT,
+    )
+    create_project = mocker.patch.object(g2s_fixture, "_create_sentry_project")
+    create_dsn_mr = mocker.patch.object(
+        g2s_fixture.gitlab_provider, attribute="create_dsn_mr", return_value=True
+    )
+    assert g2s_fixture._handle_g2s_project(
+        g2s_sentryclirc_mr_merged_project, TEST_GROUP_NAME
+    )
+    # The DSN of a previous run needs no Sentry call
+    create_project.assert_not_called()
+    assert create_dsn_mr.call_args[0][1] == settings.sentry_dsn
+
+
+def test_get_sentry_provider_dsn_cache(g2s_fixture, tmp_path, mocker):
+    path = str(tmp_path / "dsn.json")
+    mocker.patch.object(settings, "sentry_dsn_cache_path", path)
+    sentry_provider = g2s_fixture._get_sentry_provider()
+    assert sentry_provider.dsn_cache.path == path
+
+
 def test_update(g2s_fixture, g2s_new_project, mocker):
     mocker.patch.object(
         g2s_fixture, attribute="_get_gitlab_project", return_value=g2s_new_project
@@ -314,10 +458,308 @@ def test_update(g2s_fixture, g2s_new_project, mocker):
     mocker.patch.object(
         g2s_fixture,
         attribute="_get_gitlab_groups",
-        return_value={TEST_GROUP_NAME: g2s_new_project},
+        return_value={TEST_GROUP_NAME: [g2s_new_project]},
     )
     mocker.patch.object(
         g2s_fixture, attribute="_ensure_sentry_group", return_value=None
     )
     mocker.patch.object(g2s_fixture, attribute="_handle_g2s_project", return_value=None)
     assert g2s_fixture.update() is None
+
+
+def test_update_runs_dsn_mrs_first(
+    g2s_fixture, g2s_new_project, g2s_sentryclirc_mr_merged_project, mocker
+):
+    mocker.patch.object(
+        g2s_fixture,
+        attribute="_get_gitlab_groups",
+        return_value={
+            TEST_GROUP_NAME: [g2s_new_project, g2s_sentryclirc_mr_merged_project]
+        },
+    )
+    mocker.patch.object(
+        g2s_fixture, attribute="_ensure_sentry_group", return_value=None
+    )
+    handle = mocker.patch.object(
+        g2s_fixture, attribute="_handle_g2s_project", return_value=True
+    )
+    g2s_fixture.update()
+    # Handled with the action they were ranked by
+    assert [call[1]["action"] for call in handle.call_args_list] == [
+        G2S_ACTION_DSN,
+        G2S_ACTION_SENTRYCLIRC,
+    ]
+    assert [call[0][0] for call in handle.call_args_list] == [
+        g2s_sentryclirc_mr_merged_project,
+        g2s_new_project,
+    ]
+
+
+def test_is_shard_group(g2s_fixture, mocker):
+    assert g2s_fixture._is_shard_group(TEST_GROUP_NAME)
+
+    mocker.patch.object(settings, "shard_count", 3)
+    group_names = ["{}{}".format(TEST_GROUP_NAME, index) for index in range(30)]
+    owners = list()
+    for group_name in group_names:
+        owner = list()
+        for shard_index in range(3):
+            mocker.patch.object(settings, "shard_index", shard_index)
+            if g2s_fixture._is_shard_group(group_name):
+                owner.append(shard_index)
+        owners.append(owner)
+    # Every group belongs to exactly one shard, and every shard has groups
+    assert all(len(owner) == 1 for owner in owners)
+    assert {owner[0] for owner in owners} == {0, 1, 2}
+
+
+def test_get_gitlab_groups_sharded(g2s_fixture, payload_new_project, mocker):
+    mocker.patch.object(
+        g2s_fixture,
+        attribute="_iter_paginated_projects",
+        return_value=[[payload_new_project]],
+    )
+    mocker.patch.object(settings, "shard_count", 2)
+    shard_groups = list()
+    for shard_index in range(2):
+        mocker.patch.object(settings, "shard_index", shard_index)
+        shard_groups.append(g2s_fixture._get_gitlab_groups())
+    # The group is scanned by a single shard
+    assert len([groups for groups in shard_groups if groups]) == 1
+
+
+def test_is_pending(
+    g2s_fixture,
+    g2s_new_project,
+    g2s_sentry_project,
+    g2s_sentryclirc_mr_open_project,
+    g2s_sentryclirc_mr_closed_project,
+    g2s_sentryclirc_mr_merged_project,
+    g2s_dsn_mr_open_project,
+    g2s_dsn_mr_closed_project,
+):
+    assert g2s_fixture._is_pending(g2s_sentryclirc_mr_open_project)
+    assert g2s_fixture._is_pending(g2s_sentryclirc_mr_merged_project)
+    assert g2s_fixture._is_pending(g2s_dsn_mr_open_project)
+    assert not g2s_fixture._is_pending(g2s_new_project)
+    assert not g2s_fixture._is_pending(g2s_sentry_project)
+    assert not g2s_fixture._is_pending(g2s_sentryclirc_mr_closed_project)
+    assert not g2s_fixture._is_pending(g2s_dsn_mr_closed_project)
+    # Until the next run finds the MR opened by this one
+    g2s_fixture.mr_created_pids.add(g2s_new_project.pid)
+    assert g2s_fixture._is_pending(g2s_new_project)
+
+
+def test_get_gitlab_groups_refreshes_pending(
+    g2s_fixture, payload_new_project, payload_old_project, mocker
+):
+    mocker.patch.object(
+        g2s_fixture,
+        attribute="_iter_paginated_projects",
+        return_value=[[payload_new_project]],
+    )
+    old_project = dict(payload_old_project)
+    old_project["node"] = dict(old_project["node"], id="gid://gitlab/Project/2")
+    get_projects_by_ids = mocker.patch.object(
+        g2s_fixture.gitlab_provider,
+        attribute="get_projects_by_ids",
+        return_value=[[old_project]],
+    )
+    g2s_fixture.pending.pids = {1, 2}
+    groups = g2s_fixture._get_gitlab_groups()
+    # Only the pending project the scan did not find is queried
+    assert get_projects_by_ids.call_args[0][1] == [2]
+    assert [g2s_project.pid for g2s_project in groups[TEST_GROUP_NAME]] == [1, 2]
+    assert g2s_fixture.run_stats["pending_refreshed"] == 1
+
+
+def test_update_saves_pending(
+    g2s_fixture, g2s_new_project, g2s_sentryclirc_mr_open_project, mocker
+):
+    mocker.patch.object(
+        g2s_fixture,
+        attribute="_get_gitlab_groups",
+        return_value={
+            TEST_GROUP_NAME: [
+                g2s_new_project,
+                replace(g2s_sentryclirc_mr_open_project, pid=2),
+            ]
+        },
+    )
+    mocker.patch.object(g2s_fixture, attribute="_ensure_sentry_group")
+    mocker.patch.object(g2s_fixture, attribute="_handle_g2s_project")
+    g2s_fixture.update()
+    assert g2s_fixture.pending.pids == {2}
+
+
+def test_update_keeps_unrefreshed_pending(g2s_fixture, payload_new_project, mocker):
+    mocker.patch.object(settings, "pending_batch_size", 1)
+    mocker.patch.object(
+        g2s_fixture,
+        attribute="_iter_paginated_projects",
+        return_value=[[payload_new_project]],
+    )
+    # The query of project 2 fails, project 3 was deleted
+    mocker.patch.object(
+        g2s_fixture.gitlab_provider._gql_client,
+        attribute="project_ids_query",
+        side_effect=[{}, {GRAPHQL_LIST_PROJECTS_QUERY["instance"]: {"edges": []}}],
+    )
+    mocker.patch.object(g2s_fixture, attribute="_ensure_sentry_group")
+    mocker.patch.object(g2s_fixture, attribute="_handle_g2s_project")
+    g2s_fixture.pending.pids = {1, 2, 3}
+    g2s_fixture.update()
+    assert g2s_fixture.pending.pids == {2}
+
+
+def test_get_http_cache(g2s_fixture, tmp_path, mocker):
+    mocker.patch.object(settings, "http_cache_path", str(tmp_path / "cache.json"))
+    http_cache = g2s_fixture._get_http_cache()
+    assert http_cache.is_enabled()
+    assert http_transport.adapter.cache is http_cache
+    http_transport.set_cache(HTTPCache(""))
+
+
+@pytest.mark.parametrize("classify_processes", [0, 1])
+def test_async_update(
+    payload_new_project,
+    payload_sentryclirc_mr_merged_project,
+    mocker,
+    classify_processes,
+):
+    mocker.patch.object(settings, "pipeline_classify_processes", classify_processes)
+    g2s = AsyncGitlab2Sentry()
+    assert isinstance(g2s.gitlab_provider, AsyncGitlabProvider)
+    assert isinstance(g2s.sentry_provider, AsyncSentryProvider)
+    merged_project = dict(payload_sentryclirc_mr_merged_project)
+    merged_project["node"] = dict(merged_project["node"], id="gid://gitlab/Project/2")
+
+    async def get_all_projects(query, endCursor=""):
+        yield [payload_new_project, merged_project]
+
+    mocker.patch.object(
+        g2s.gitlab_provider, attribute="get_all_projects", side_effect=get_all_projects
+    )
+    mocker.patch.object(
+        g2s.gitlab_provider, attribute="get_prefilter_savings", return_value={}
+    )
+    ensure_team = mocker.patch.object(
+        g2s.sentry_provider, attribute="ensure_sentry_team", return_value=True
+    )
+    mocker.patch.object(
+        g2s.sentry_provider,
+        attribute="get_or_create_project",
+        return_value={"slug": "test"},
+    )
+    mocker.patch.object(
+        g2s.sentry_provider, attribute="set_rate_limit_for_key", return_value="dsn"
+    )
+    create_dsn_mr = mocker.patch.object(
+        g2s.gitlab_provider, attribute="create_dsn_mr", return_value=True
+    )
+    create_sentryclirc_mr = mocker.patch.object(
+        g2s.gitlab_provider, attribute="create_sentryclirc_mr", return_value=True
+    )
+    g2s.update()
+    ensure_team.assert_called_once_with(TEST_GROUP_NAME)
+    assert create_dsn_mr.call_args[0][0].pid == 2
+    assert create_sentryclirc_mr.call_args[0][0].pid == 1
+    assert g2s.run_stats["mr_dsn_created"] == 1
+    assert g2s.run_stats["mr_sentryclirc_created"] == 1
+    assert g2s.pending.pids == {1, 2}
+
+
+def test_async_update_provision_failure(
+    payload_new_project, payload_sentryclirc_mr_merged_project, mocker
+):
+    g2s = AsyncGitlab2Sentry()
+    merged_project = dict(payload_sentryclirc_mr_merged_project)
+    merged_project["node"] = dict(merged_project["node"], id="gid://gitlab/Project/2")
+
+    async def get_all_projects(query, endCursor=""):
+        yield [payload_new_project, merged_project]
+
+    mocker.patch.object(
+        g2s.gitlab_provider, attribute="get_all_projects", side_effect=get_all_projects
+    )
+    mocker.patch.object(
+        g2s.gitlab_provider, attribute="get_prefilter_savings", return_value={}
+    )
+    mocker.patch.object(
+        g2s.sentry_provider,
+        attribute="ensure_sentry_team",
+        side_effect=SentryProjectCreationFailed("team"),
+    )
+    create_dsn_mr = mocker.patch.object(
+        g2s.gitlab_provider, attribute="create_dsn_mr", return_value=True
+    )
+    mocker.patch.object(
+        g2s.gitlab_provider, attribute="create_sentryclirc_mr", return_value=True
+    )
+    # The failed team only skips the DSN MR, the run goes on
+    g2s.update()
+    assert not create_dsn_mr.called
+    assert g2s.run_stats["mr_sentryclirc_created"] == 1
+    assert g2s.pending.pids == {1, 2}
+
+
+def run_engine(g2s, page, get_all_projects, mocker):
+    mocker.patch.object(
+        g2s.gitlab_provider, attribute="get_all_projects", side_effect=get_all_projects
+    )
+    mocker.patch.object(
+        g2s.gitlab_provider, attribute="get_prefilter_savings", return_value={}
+    )
+    ensure_team = mocker.patch.object(
+        g2s.sentry_provider, attribute="ensure_sentry_team", return_value=True
+    )
+    mocker.patch.object(
+        g2s.sentry_provider,
+        attribute="get_or_create_project",
+        return_value={"slug": "test"},
+    )
+    mocker.patch.object(
+        g2s.sentry_provider, attribute="set_rate_limit_for_key", return_value="dsn"
+    )
+    create_dsn_mr = mocker.patch.object(
+        g2s.gitlab_provider, attribute="create_dsn_mr", return_value=True
+    )
+    create_sentryclirc_mr = mocker.patch.object(
+        g2s.gitlab_provider, attribute="create_sentryclirc_mr", return_value=True
+    )
+    g2s.update()
+    return (
+        sorted(call.args for call in ensure_team.call_args_list),
+        sorted(call.args[0].pid for call in create_dsn_mr.call_args_list),
+        sorted(call.args[0].pid for call in create_sentryclirc_mr.call_args_list),
+    )
+
+
+def test_engines_same_writes(
+    payload_new_project, payload_sentryclirc_mr_merged_project, mocker
+):
+    merged_project = dict(payload_sentryclirc_mr_merged_project)
+    merged_project["node"] = dict(merged_project["node"], id="gid://gitlab/Project/2")
+    # Nothing to do for it, but its group still gets a team
+    done_project = create_graphql_json_object(
+        mrs_enabled=True,
+        has_sentryclirc_file=True,
+        has_dsn=True,
+        sentryclirc_mr_state="merged",
+        dsn_mr_state="merged",
+        group="other",
+    )
+    done_project["node"].update(id="gid://gitlab/Project/3", fullPath="other/p")
+    page = [payload_new_project, merged_project, done_project]
+
+    def get_all_projects(query, endCursor=""):
+        yield page
+
+    async def async_get_all_projects(query, endCursor=""):
+        yield page
+
+    writes = run_engine(Gitlab2Sentry(), page, get_all_projects, mocker)
+    assert writes == ([("other",), (TEST_GROUP_NAME,)], [2], [1])
+    assert (
+        run_engine(AsyncGitlab2Sentry(), page, async_get_all_projects, mocker) == writes
+    )
@@ -1,48 +1,122 @@
+import asyncio
+import json
+import subprocess
+import sys
+import time
 from datetime import datetime
 
-import aiohttp
+import pytest
 from gitlab import Gitlab
-from gql.transport.aiohttp import AIOHTTPTransport
+from requests import Response
 
+from gitlab2sentry.exceptions import GitlabAuthenticationFailed, GraphQLQueryFailed
 from gitlab2sentry.resources import (
     GRAPHQL_FETCH_PROJECT_QUERY,
     GRAPHQL_LIST_PROJECTS_QUERY,
     settings,
 )
+from gitlab2sentry.utils.async_http import AsyncResponse
+from gitlab2sentry.utils.cassette import Cassette
+from gitlab2sentry.utils.gitlab_provider import (
+    AsyncGitlabProvider,
+    AsyncGraphQLClient,
+    GraphQLClient,
+)
+from gitlab2sentry.utils.journal import RunJournal
+from gitlab2sentry.utils.json_stream import JSONArrayStream
 from tests.conftest import CURRENT_TIME, GRAPHQL_TEST_QUERY
 
 
-def test_get_transport(gql_client_fixture):
-    assert isinstance(
-        gql_client_fixture._get_transport(settings.gitlab_url, settings.gitlab_token),
-        AIOHTTPTransport,
-    )
+def graphql_response(status_code, data=None, headers=None, errors=None):
+    response = Response()
+    document = {"data": data}
+    if errors:
+        document["errors"] = errors
+    response._content = json.dumps(document).encode()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    return response
 
 
 def test_query(gql_client_fixture, payload_new_project, mocker):
-    mocker.patch.object(
-        gql_client_fixture._client,
-        attribute="execute",
-        return_value=[payload_new_project],
+    post = mocker.patch.object(
+        gql_client_fixture._session,
+        attribute="post",
+        return_value=graphql_response(200, [payload_new_project]),
     )
     assert gql_client_fixture._query(
         payload_new_project["node"]["name"], GRAPHQL_TEST_QUERY["body"]
     )
+    assert json.loads(post.call_args[1]["data"]) == {
+        "query": GRAPHQL_TEST_QUERY["body"]
+    }
+    post.return_value = graphql_response(404)
+    assert not gql_client_fixture._query(
+        payload_new_project["node"]["name"], GRAPHQL_TEST_QUERY["body"]
+    )
+
+
+def test_query_errors(gql_client_fixture, payload_new_project, mocker):
     mocker.patch.object(
-        gql_client_fixture._client,
-        attribute="execute",
-        side_effect=aiohttp.client_exceptions.ClientResponseError(None, None),
+        gql_client_fixture._session,
+        attribute="post",
+        return_value=graphql_response(200, errors=[{"message": "Field missing"}]),
     )
-    assert not gql_client_fixture._query(
+    with pytest.raises(GraphQLQueryFailed, match="Field missing"):
+        gql_client_fixture._query(
+            payload_new_project["node"]["name"], GRAPHQL_TEST_QUERY["body"]
+        )
+
+
+def test_query_retries_throttled(gql_client_fixture, payload_new_project, mocker):
+    sleep = mocker.patch("time.sleep")
+    mocker.patch.object(
+        gql_client_fixture._session,
+        attribute="post",
+        side_effect=[
+            graphql_response(429, headers={"Retry-After": "2"}),
+            graphql_response(200, [payload_new_project]),
+        ],
+    )
+    assert gql_client_fixture._query(
         payload_new_project["node"]["name"], GRAPHQL_TEST_QUERY["body"]
+    ) == [payload_new_project]
+    sleep.assert_called_once_with(2.0)
+
+
+def test_query_invalid_token(gql_client_fixture, payload_new_project, mocker):
+    mocker.patch.object(
+        gql_client_fixture._session,
+        attribute="post",
+        return_value=graphql_response(401),
     )
+    with pytest.raises(GitlabAuthenticationFailed):
+        gql_client_fixture._query(
+            payload_new_project["node"]["name"], GRAPHQL_TEST_QUERY["body"]
+        )
+
+
+def test_import_is_lazy():
+    # python-gitlab and slugify wait for the code paths needing them
+    modules = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, gitlab2sentry; print(' '.join(sys.modules))",
+        ],
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout.split()
+    for module in ("gitlab", "slugify"):
+        assert module not in modules
 
 
 def test_project_fetch_query(gql_client_fixture, payload_new_project, mocker):
     mocker.patch.object(
-        gql_client_fixture._client,
-        attribute="execute",
-        return_value=[payload_new_project],
+        gql_client_fixture._session,
+        attribute="post",
+        return_value=graphql_response(200, [payload_new_project]),
     )
     assert (
         gql_client_fixture.project_fetch_query(GRAPHQL_FETCH_PROJECT_QUERY)[0]
@@ -52,9 +126,9 @@ def test_project_fetch_query(gql_client_fixture, payload_new_project, mocker):
 
 def test_project_list_query(gql_client_fixture, payload_new_project, mocker):
     mocker.patch.object(
-        gql_client_fixture._client,
-        attribute="execute",
-        return_value=[payload_new_project],
+        gql_client_fixture._session,
+        attribute="post",
+        return_value=graphql_response(200, [payload_new_project]),
     )
     assert (
         gql_client_fixture.project_list_query(GRAPHQL_LIST_PROJECTS_QUERY, None)[0]
@@ -62,6 +136,68 @@ def test_project_list_query(gql_client_fixture, payload_new_project, mocker):
     )
 
 
+def test_project_ids_query(gql_client_fixture):
+    query = gql_client_fixture._get_project_ids_query(
+        GRAPHQL_LIST_PROJECTS_QUERY, [1, 2]
+    )
+    assert '(first: 2 ids: ["gid://gitlab/Project/1","gid://gitlab/Project/2"]' in (
+        query
+    )
+    assert "createdAt_desc" not in query
+    # Latest MR of each gitlab2sentry branch only
+    for branch_name in (settings.sentryclirc_branch_name, settings.dsn_branch_name):
+        assert (
+            '(sourceBranches: ["{}"] sort: CREATED_DESC first: 1)'.format(branch_name)
+            in query
+        )
+
+
+def test_project_list_query_prefilters(mocker):
+    mocker.patch.object(settings, "gitlab_project_prefilters", ["archived", "unknown"])
+    gql_client = GraphQLClient()
+    assert gql_client.prefilters == ["archived"]
+    assert "archived: EXCLUDE" in gql_client._get_project_list_query(
+        GRAPHQL_LIST_PROJECTS_QUERY, ""
+    )
+    assert "archived: EXCLUDE" in gql_client._get_project_ids_query(
+        GRAPHQL_LIST_PROJECTS_QUERY, [1]
+    )
+    # Counted with and without the prefilter
+    query = gql_client._get_prefilter_counts_query()
+    assert "total: projects(searchNamespaces: true archived: EXCLUDE)" in query
+    assert "archived: projects(searchNamespaces: true)" in query
+
+
+def test_get_prefilter_savings(gitlab_provider_fixture, mocker):
+    mocker.patch.object(settings, "gitlab_prefilter_counts", True)
+    gitlab_provider_fixture._gql_client.prefilters = ["archived", "pending_deletion"]
+    counts_query = mocker.patch.object(
+        gitlab_provider_fixture._gql_client,
+        attribute="project_prefilter_counts_query",
+        return_value={
+            "total": {"count": 90},
+            "archived": {"count": 100},
+            "pending_deletion": {"count": 91},
+        },
+    )
+    assert gitlab_provider_fixture.get_prefilter_savings() == {
+        "archived": 10,
+        "pending_deletion": 1,
+    }
+
+    # The instance-wide count is made by the first shard only, if enabled
+    mocker.patch.object(settings, "shard_index", 1)
+    assert gitlab_provider_fixture.get_prefilter_savings() == {}
+    mocker.patch.object(settings, "shard_index", 0)
+    mocker.patch.object(settings, "gitlab_prefilter_counts", False)
+    assert gitlab_provider_fixture.get_prefilter_savings() == {}
+    assert counts_query.call_count == 1
+
+    mocker.patch.object(settings, "gitlab_prefilter_counts", True)
+    gitlab_provider_fixture._gql_client.prefilters = []
+    assert gitlab_provider_fixture.get_prefilter_savings() == {}
+
+
 def test_get_gitlab(gitlab_provider_fixture):
     assert isinstance(
         gitlab_provider_fixture._get_gitlab(settings.gitlab_url, settings.gitlab_token),
@@ -69,6 +205,13 @@ def test_get_gitlab(gitlab_provider_fixture):
     )
 
 
+def test_clients_are_built_lazily(gitlab_provider_fixture):
+    assert gitlab_provider_fixture._gitlab is None
+    gitlab = gitlab_provider_fixture.gitlab
+    assert isinstance(gitlab, Gitlab)
+    assert gitlab_provider_fixture.gitlab is gitlab
+
+
 def test_get_update_limit(gitlab_provider_fixture):
     if settings.gitlab_project_creation_limit:
         assert (
@@ -167,3 +310,229 @@ def test_get_all_projects(
         )
         == 1
     )
+
+
+def test_get_projects_by_ids(gitlab_provider_fixture, payload_old_project, mocker):
+    mocker.patch.object(settings, "pending_batch_size", 2)
+    query = mocker.patch.object(
+        gitlab_provider_fixture._gql_client,
+        attribute="project_ids_query",
+        side_effect=[
+            {GRAPHQL_LIST_PROJECTS_QUERY["instance"]: {"edges": [payload_old_project]}},
+            {},
+        ],
+    )
+    pages = list(
+        gitlab_provider_fixture.get_projects_by_ids(
+            GRAPHQL_LIST_PROJECTS_QUERY, [1, 2, 3]
+        )
+    )
+    # Projects out of the creation limit are kept, failed batches skipped
+    assert pages == [[payload_old_project]]
+    assert [call[0][1] for call in query.call_args_list] == [[1, 2], [3]]
+
+    # A batch never goes past the nodes GitLab returns per page
+    mocker.patch.object(settings, "pending_batch_size", 500)
+    query.reset_mock(side_effect=True)
+    query.return_value = {}
+    list(
+        gitlab_provider_fixture.get_projects_by_ids(
+            GRAPHQL_LIST_PROJECTS_QUERY, list(range(250))
+        )
+    )
+    assert [len(call[0][1]) for call in query.call_args_list] == [100, 100, 50]
+
+
+def test_project_list_stream(gql_client_fixture, payload_new_project, mocker):
+    body = json.dumps({"data": {"projects": {"edges": [payload_new_project]}}}).encode()
+    post = mocker.patch.object(gql_client_fixture._session, attribute="post")
+    post.return_value.status_code = 200
+    post.return_value.headers = {"Content-Length": str(len(body))}
+    post.return_value.iter_content.return_value = [body[:10], body[10:]]
+    stream = gql_client_fixture.project_list_stream(GRAPHQL_LIST_PROJECTS_QUERY, "")
+    assert list(stream) == [payload_new_project]
+    assert post.call_args[1]["stream"]
+
+    # Failed after its retries: an empty page
+    mocker.patch("time.sleep")
+    post.return_value.status_code = 503
+    stream = gql_client_fixture.project_list_stream(GRAPHQL_LIST_PROJECTS_QUERY, "")
+    assert list(stream) == []
+
+
+def test_get_streamed_projects(
+    gitlab_provider_fixture, payload_new_project, payload_old_project, mocker
+):
+    mocker.patch.object(settings, "gitlab_graphql_streaming", True)
+
+    def get_stream(edges, end_cursor, has_next_page):
+        return JSONArrayStream.from_value(
+            {
+                "data": {
+                    GRAPHQL_LIST_PROJECTS_QUERY["instance"]: {
+                        "pageInfo": {
+                            "endCursor": end_cursor,
+                            "hasNextPage": has_next_page,
+                        },
+                        "edges": edges,
+                    }
+                }
+            },
+            ("data", GRAPHQL_LIST_PROJECTS_QUERY["instance"], "edges"),
+        )
+
+    project_list_stream = mocker.patch.object(
+        gitlab_provider_fixture._gql_client,
+        attribute="project_list_stream",
+        side_effect=[
+            get_stream([payload_new_project], "first-cursor", True),
+            get_stream([payload_new_project, payload_old_project], None, True),
+        ],
+    )
+    pages = list()
+    for page in gitlab_provider_fixture.get_all_projects(GRAPHQL_LIST_PROJECTS_QUERY):
+        # The cursor of a page is known before its nodes are read
+        pages.append((gitlab_provider_fixture.end_cursor, list(page)))
+    # The old project ends the scan, without asking for a third page
+    assert pages == [
+        ("first-cursor", [payload_new_project]),
+        ("first-cursor", [payload_new_project]),
+    ]
+    assert project_list_stream.call_args[0][1] == "first-cursor"
+
+
+def test_create_mr_skips_journaled_steps(
+    gitlab_provider_fixture, g2s_new_project, tmp_path, mocker
+):
+    gitlab_provider_fixture.journal = RunJournal(str(tmp_path / "journal.jsonl"))
+    project = mocker.MagicMock()
+    mocker.patch.object(
+        gitlab_provider_fixture.gitlab.projects, attribute="get", return_value=project
+    )
+    create_branch = mocker.patch.object(
+        gitlab_provider_fixture, attribute="_get_or_create_branch"
+    )
+    create_file = mocker.patch.object(
+        gitlab_provider_fixture, attribute="_get_or_create_sentryclirc"
+    )
+    mocker.patch.object(
+        gitlab_provider_fixture, attribute="_get_mr_description", return_value=""
+    )
+    gitlab_provider_fixture.journal.record_step(
+        g2s_new_project.pid, settings.sentryclirc_branch_name, "branch"
+    )
+    assert gitlab_provider_fixture.create_sentryclirc_mr(g2s_new_project)
+    assert not create_branch.called
+    assert create_file.called
+    assert gitlab_provider_fixture.journal.is_step_done(
+        g2s_new_project.pid, settings.sentryclirc_branch_name, "mr"
+    )
+
+    # A resumed run never opens the same MR twice
+    assert not gitlab_provider_fixture.create_sentryclirc_mr(g2s_new_project)
+    assert project.mergerequests.create.call_count == 1
+
+
+def test_async_query_replay(tmp_path):
+    path = str(tmp_path / "run.jsonl.gz")
+    recorder = Cassette(path, "record")
+    for query in ("{ a }", "{ b }"):
+        key = recorder.get_key("graphql", "POST", "", query)
+        recorder.record(key, 200, {}, {"name": query}, 0.2)
+    recorder.close()
+
+    async def replay():
+        client = AsyncGraphQLClient(cassette=Cassette(path, "replay", realtime=True))
+        start_time = time.monotonic()
+        results = await asyncio.gather(
+            client._query("A", "{ a }"), client._query("B", "{ b }")
+        )
+        return results, time.monotonic() - start_time
+
+    results, duration = asyncio.run(replay())
+    assert results == [{"name": "{ a }"}, {"name": "{ b }"}]
+    # The recorded durations overlap instead of blocking the event loop
+    assert duration < 0.35
+
+
+def test_async_get_all_projects(payload_new_project, payload_old_project, mocker):
+    provider = AsyncGitlabProvider()
+    mocker.patch.object(
+        provider._gql_client,
+        attribute="project_list_query",
+        side_effect=[
+            {
+                GRAPHQL_LIST_PROJECTS_QUERY["instance"]: {
+                    "edges": [payload_new_project],
+                    "pageInfo": {"endCursor": "first-cursor", "hasNextPage": True},
+                }
+            },
+            {
+                GRAPHQL_LIST_PROJECTS_QUERY["instance"]: {
+                    "edges": [payload_old_project],
+                    "pageInfo": {"endCursor": None, "hasNextPage": True},
+                }
+            },
+        ],
+    )
+
+    async def get_pages():
+        return [
+            page
+            async for page in provider.get_all_projects(GRAPHQL_LIST_PROJECTS_QUERY)
+        ]
+
+    # The scan ends with the first page past the creation limit
+    assert asyncio.run(get_pages()) == [[payload_new_project], []]
+    assert provider.end_cursor == "first-cursor"
+
+
+def test_async_create_mr(g2s_new_project, tmp_path, mocker):
+    provider = AsyncGitlabProvider(journal=RunJournal(str(tmp_path / "journal.jsonl")))
+    branch = settings.sentryclirc_branch_name
+    responses = {
+        ("GET", "projects/1"): (200, {"default_branch": "main"}),
+        ("GET", "projects/1/repository/branches/{}".format(branch)): (200, {}),
+        ("GET", "projects/1/repository/files/.sentryclirc?ref=main"): (404, {}),
+        ("GET", "projects/1/members/all?per_page=100&page=1"): (
+            200,
+            [
+                {"username": "active_user", "access_level": 40, "state": "active"},
+                {"username": "blocked_user", "access_level": 40, "state": "blocked"},
+            ],
+        ),
+    }
+    calls = list()
+
+    async def request(method, url, data=None):
+        path = url.split("/api/v4/")[1]
+        calls.append((method, path))
+        status_code, body = responses.get((method, path), (201, {}))
+        return AsyncResponse(status_code, {}, json.dumps(body).encode())
+
+    mocker.patch.object(provider._rest, attribute="request", side_effect=request)
+    assert asyncio.run(provider.create_sentryclirc_mr(g2s_new_project))
+    assert calls == [
+        ("GET", "projects/1"),
+        ("GET", "projects/1/repository/branches/{}".format(branch)),
+        ("DELETE", "projects/1/repository/branches/{}".format(branch)),
+        ("POST", "projects/1/repository/branches"),
+        ("GET", "projects/1/repository/files/.sentryclirc?ref=main"),
+        ("POST", "projects/1/repository/files/.sentryclirc"),
+        ("GET", "projects/1/members/all?per_page=100&page=1"),
+        ("POST", "projects/1/merge_requests"),
+    ]
+    assert provider.journal.is_step_done(1, branch, "mr")
+    # A resumed run never opens the same MR twice
+    assert not asyncio.run(provider.create_sentryclirc_mr(g2s_new_project))
+
+    # Failed writes are logged and the MR is left to the next run
+    responses[("POST", "projects/1/merge_requests")] = (403, {})
+    provider.journal = RunJournal("")
+    assert not asyncio.run(provider.create_sentryclirc_mr(g2s_new_project))
+
+    # A failed branch read is not taken for an absent branch
+    responses[("GET", "projects/1/repository/branches/{}".format(branch))] = (503, {})
+    calls.clear()
+    assert not asyncio.run(provider.create_sentryclirc_mr(g2s_new_project))
+    assert ("POST", "projects/1/repository/branches") not in calls
@@ -0,0 +1,148 @@
+import json
+
+from requests import PreparedRequest, Response
+
+from gitlab2sentry.resources import settings
+from gitlab2sentry.utils.http_cache import (
+    CACHE_HEADER,
+    CACHE_HIT,
+    CACHE_REVALIDATED,
+    HTTPCache,
+)
+
+URL = "http://gitlab.test/api/v4/projects/1/members/all"
+
+
+def mocked_request(method="GET", url=URL):
+    request = PreparedRequest()
+    request.prepare(method=method, url=url)
+    return request
+
+
+def mocked_response(status_code=200, headers=None, content=b'[{"id": 1}]'):
+    response = Response()
+    response._content = content
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    return response
+
+
+def test_http_cache_revalidates(tmp_path):
+    cache = HTTPCache(str(tmp_path / "cache.json"), ttl=0)
+    assert cache.get(mocked_request()) is None
+    cache.update(
+        mocked_request(),
+        mocked_response(headers={"ETag": '"v1"', "Content-Encoding": "gzip"}),
+    )
+    assert "Content-Encoding" not in cache.entries[URL]["headers"]
+
+    request = mocked_request()
+    assert cache.get(request) is None
+    assert request.headers["If-None-Match"] == '"v1"'
+    response = cache.update(request, mocked_response(304, content=b""))
+    assert response.status_code == 200
+    assert response.json() == [{"id": 1}]
+    assert response.headers[CACHE_HEADER] == CACHE_REVALIDATED
+    assert (cache.revalidated, cache.misses) == (1, 1)
+
+
+def test_http_cache_ttl(tmp_path):
+    cache = HTTPCache(str(tmp_path / "cache.json"), ttl=60)
+    # Kept for the ttl even without validators
+    cache.update(mocked_request(), mocked_response())
+    response = cache.get(mocked_request())
+    assert response.headers[CACHE_HEADER] == CACHE_HIT
+    assert response.json() == [{"id": 1}]
+    assert cache.hits == 1
+
+    cache.update(
+        mocked_request(url=URL + "?page=2"),
+        mocked_response(headers={"Cache-Control": "no-store"}),
+    )
+    cache.update(mocked_request(url=URL + "?page=3"), mocked_response(404))
+    assert list(cache.entries) == [URL]
+
+
+def test_http_cache_ttl_volatile(tmp_path):
+    cache = HTTPCache(str(tmp_path / "cache.json"), ttl=60)
+    url = "http://gitlab.test/api/v4/projects/1/repository/files/.sentryclirc"
+    cache.update(mocked_request(url=url), mocked_response(headers={"ETag": '"v1"'}))
+    # The repository probes are revalidated even within the ttl
+    request = mocked_request(url=url)
+    assert cache.get(request) is None
+    assert request.headers["If-None-Match"] == '"v1"'
+    assert cache.hits == 0
+
+
+def test_http_cache_uncacheable(tmp_path):
+    cache = HTTPCache(str(tmp_path / "cache.json"), ttl=0)
+    cache.update(mocked_request(), mocked_response())
+    assert not cache.entries
+
+
+def test_http_cache_invalidates(tmp_path):
+    cache = HTTPCache(str(tmp_path / "cache.json"), ttl=60)
+    project = "http://gitlab.test/api/v4/projects/1"
+    urls = [
+        project,
+        project + "/members/all",
+        project + "/repository/branches/auto_add_sentry",
+        project + "/repository/files/.sentryclirc?ref=main",
+        "http://gitlab.test/api/v4/projects/10/repository/branches/auto_add_sentry",
+        "http://sentry.test/api/0/projects/org/test/keys/",
+    ]
+    for url in urls:
+        cache.update(mocked_request(url=url), mocked_response())
+
+    cache.update(
+        mocked_request("POST", project + "/repository/branches"), mocked_response()
+    )
+    cache.update(
+        mocked_request("PUT", project + "/repository/files/.sentryclirc"),
+        mocked_response(),
+    )
+    cache.update(
+        mocked_request("PUT", "http://sentry.test/api/0/projects/org/test/keys/1/"),
+        mocked_response(),
+    )
+    cache.update(mocked_request("POST", project + "/merge_requests"), mocked_response())
+    # GraphQL queries are POSTed reads
+    cache.update(
+        mocked_request(
+            "POST", "http://gitlab.test/{}".format(settings.gitlab_graphql_suffix)
+        ),
+        mocked_response(),
+    )
+    assert list(cache.entries) == urls[:2] + urls[4:5]
+
+
+def test_http_cache_secrets(tmp_path):
+    path = tmp_path / "cache.json"
+    cache = HTTPCache(str(path), ttl=60)
+    url = "http://sentry.test/api/0/projects/org/my-project/keys/"
+    cache.update(mocked_request(url=url), mocked_response(headers={"ETag": '"v1"'}))
+    # The DSN secrets of the Sentry keys are never stored
+    assert not cache.entries
+    assert cache.get(mocked_request(url=url)) is None
+
+    # Nor kept from a cache file written before
+    path.write_text(json.dumps({url: {}, URL: {}}))
+    assert list(HTTPCache(str(path)).entries) == [URL]
+
+
+def test_http_cache_lru(tmp_path):
+    path = str(tmp_path / "cache.json")
+    cache = HTTPCache(path, ttl=60, max_entries=2)
+    for page in range(3):
+        if page == 2:
+            cache.get(mocked_request(url=URL + "?page=0"))
+        cache.update(
+            mocked_request(url=URL + "?page={}".format(page)), mocked_response()
+        )
+    assert list(cache.entries) == [URL + "?page=0", URL + "?page=2"]
+
+    cache.save()
+    assert list(HTTPCache(path).entries) == list(cache.entries)
+    (tmp_path / "cache.json").write_text("{")
+    assert not HTTPCache(path).entries
+    assert not HTTPCache("").is_enabled()
@@ -0,0 +1,56 @@
+import json
+import time
+
+from gitlab2sentry.utils.journal import RunJournal
+
+
+def test_journal_disabled(payload_new_project):
+    journal = RunJournal("")
+    journal.record_page("cursor", [payload_new_project])
+    journal.record_step(1, "branch", "mr")
+    assert not journal.enabled
+    assert journal.pages == [] and journal.cursor == ""
+    assert journal.is_step_done(1, "branch", "mr")
+
+
+def test_journal_resume(tmp_path, payload_new_project):
+    path = str(tmp_path / "journal.jsonl")
+    journal = RunJournal(path)
+    journal.record_page("first-cursor", [payload_new_project])
+    journal.record_page(None, [payload_new_project])
+    journal.record_step(1, "auto_add_sentry", "branch")
+
+    resumed = RunJournal(path)
+    assert resumed.cursor == "first-cursor"
+    assert resumed.pages == [[payload_new_project], [payload_new_project]]
+    assert not resumed.scan_done
+    assert resumed.is_step_done(1, "auto_add_sentry", "branch")
+    assert not resumed.is_step_done(1, "auto_add_sentry", "mr")
+
+    resumed.record_scan_done()
+    assert RunJournal(path).scan_done
+
+    resumed.clear()
+    assert not tmp_path.joinpath("journal.jsonl").exists()
+    assert RunJournal(path).pages == []
+
+
+def test_journal_truncated_line(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    journal = RunJournal(str(path))
+    journal.record_step(1, "auto_add_sentry", "branch")
+    with open(path, "a") as journal_file:
+        journal_file.write('{"event": "step", "ke')
+    assert RunJournal(str(path)).is_step_done(1, "auto_add_sentry", "branch")
+
+
+def test_journal_max_age(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    path.write_text(
+        json.dumps({"event": "started", "at": time.time() - 7200})
+        + "\n"
+        + json.dumps({"event": "step", "key": "1:auto_add_sentry:branch"})
+        + "\n"
+    )
+    assert not RunJournal(str(path), max_age=1).steps
+    assert not path.exists()
@@ -0,0 +1,59 @@
+import json
+
+import pytest
+
+from gitlab2sentry.utils.json_stream import JSONArrayStream
+
+EDGES_PATH = ("data", "projects", "edges")
+
+
+def get_chunks(document, size):
+    body = json.dumps(document, ensure_ascii=False, indent=1).encode()
+    chunks = list()
+    while body:
+        chunks.append(body[:size])
+        body = body[size:]
+    return chunks
+
+
+def test_stream_items(payload_new_project, payload_sentry_project):
+    document = {
+        "data": {
+            "projects": {
+                "pageInfo": {"endCursor": "cursor", "hasNextPage": True},
+                "edges": [payload_new_project, payload_sentry_project],
+                "count": 12345,
+            }
+        },
+        "errors": [{"message": "é"}],
+    }
+    # Items, strings and numbers cut anywhere by the chunks
+    for size in (1, 7, 4096):
+        stream = JSONArrayStream(get_chunks(document, size), EDGES_PATH)
+        assert list(stream) == [payload_new_project, payload_sentry_project]
+        assert stream.get("data", "projects", "pageInfo", "endCursor") == "cursor"
+        assert stream.get("data", "projects", "count") == 12345
+        assert stream.get("errors") == [{"message": "é"}]
+        assert stream.get("data", "projects", "edges") is None
+
+
+def test_stream_is_lazy():
+    chunks = iter(get_chunks({"data": {"projects": {"edges": [1, 2]}}}, 1))
+    stream = JSONArrayStream(chunks, EDGES_PATH)
+    items = iter(stream)
+    assert next(items) == 1
+    # The rest of the document is not read yet
+    assert next(chunks, None) is not None
+
+
+def test_stream_without_array():
+    stream = JSONArrayStream.from_value({"data": None, "errors": []}, EDGES_PATH)
+    assert list(stream) == []
+    assert stream.get("data", "projects", "pageInfo") is None
+    assert stream.get("errors") == []
+
+
+def test_stream_truncated():
+    stream = JSONArrayStream([b'{"data": {"projects": {"edges": [1, {"id"'], EDGES_PATH)
+    with pytest.raises(json.JSONDecodeError):
+        list(stream)
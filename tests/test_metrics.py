@@ -0,0 +1,64 @@
+import pytest
+
+from gitlab2sentry.resources import settings
+from gitlab2sentry.utils.metrics import (
+    export_metrics,
+    get_endpoint,
+    registry,
+    track_request,
+)
+
+
+def test_get_endpoint():
+    assert (
+        get_endpoint("get", "/api/v4/projects/12/repository/files/.sentryclirc?ref=a")
+        == "GET /api/v4/projects/:param/repository/files/:param"
+    )
+    assert (
+        get_endpoint("PUT", "/api/0/projects/org/my-project/keys/abc/")
+        == "PUT /api/0/projects/:param/:param/keys/:param"
+    )
+
+
+def get_api_sample(name, **labels):
+    return (
+        registry.get_sample_value(
+            name, dict({"client": "test", "endpoint": "GET /"}, **labels)
+        )
+        or 0
+    )
+
+
+def test_track_request():
+    count = get_api_sample("g2s_api_request_duration_seconds_count")
+    with track_request("test", "GET /") as response:
+        response["status"] = "429"
+    with pytest.raises(ValueError):
+        with track_request("test", "GET /"):
+            raise ValueError()
+    assert get_api_sample("g2s_api_request_duration_seconds_count") == count + 2
+    assert get_api_sample("g2s_api_responses_total", status="429") >= 1
+    assert get_api_sample("g2s_api_responses_total", status="error") >= 1
+
+
+def test_export_metrics(tmp_path, mocker):
+    push = mocker.patch("gitlab2sentry.utils.metrics.push_to_gateway")
+    path = tmp_path / "g2s.prom"
+    export_metrics(str(path), "http://pushgateway:9091/")
+    assert "g2s_last_run_timestamp_seconds" in path.read_text()
+    assert push.call_args.args == (
+        "http://pushgateway:9091/",
+        "gitlab2sentry",
+        registry,
+    )
+    assert push.call_args.kwargs["grouping_key"] is None
+
+    # Every shard pushes its own metrics
+    mocker.patch.object(settings, "shard_count", 2)
+    mocker.patch.object(settings, "shard_index", 1)
+    export_metrics("", "http://pushgateway:9091/")
+    assert push.call_args.kwargs["grouping_key"] == {"shard": 1}
+
+    # A failed export does not fail the run
+    push.side_effect = OSError("refused")
+    export_metrics(str(tmp_path / "missing" / "g2s.prom"), "http://pushgateway:9091/")
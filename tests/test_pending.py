@@ -0,0 +1,23 @@
+from gitlab2sentry.utils.pending import PendingSet
+
+
+def test_pending_set(tmp_path):
+    path = str(tmp_path / "pending.json")
+    pending = PendingSet(path)
+    assert not len(pending)
+    pending.save([3, 1, 2], [])
+    pending = PendingSet(path)
+    assert 1 in pending and len(pending) == 3
+    assert pending.get_missing({2}) == [1, 3]
+    # Projects read back not pending anymore leave the set, the others stay
+    pending.save([3, 4], [1])
+    assert PendingSet(path).pids == {2, 3, 4}
+
+
+def test_pending_set_unreadable(tmp_path):
+    path = tmp_path / "pending.json"
+    path.write_text("{")
+    assert not len(PendingSet(str(path)))
+    pending = PendingSet("")
+    pending.save([1], [])
+    assert 1 in pending
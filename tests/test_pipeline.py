@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from gitlab2sentry.utils.metrics import registry
+from gitlab2sentry.utils.pipeline import PipelineStage, run_pipeline
+
+
+def test_run_pipeline():
+    events = list()
+
+    async def double(item):
+        events.append(("double", item))
+        await last_stage.put(item * 2, (-item,))
+
+    async def collect(item):
+        events.append(("collect", item))
+        # Slow stage: its full queue holds the stages before it back
+        await asyncio.sleep(0.01)
+
+    first_stage = PipelineStage("test_double", double, 1, maxsize=1)
+    last_stage = PipelineStage("test_collect", collect, 1, maxsize=2)
+
+    async def source():
+        for item in range(1, 6):
+            await first_stage.put(item)
+            events.append(("put", item))
+
+    asyncio.run(run_pipeline(source, [first_stage, last_stage]))
+    assert [item for event, item in events if event == "double"] == [1, 2, 3, 4, 5]
+    collected = [item for event, item in events if event == "collect"]
+    assert sorted(collected) == [2, 4, 6, 8, 10]
+    # The queued items are handled by rank: higher items went first
+    assert collected != sorted(collected)
+    # The source waited for room in the queue instead of buffering
+    assert events.index(("put", 5)) > events.index(("collect", 2))
+    assert first_stage.handled == 5 and last_stage.handled == 5
+    assert first_stage.max_depth == 1 and last_stage.max_depth == 2
+    assert (
+        registry.get_sample_value(
+            "g2s_pipeline_queue_wait_seconds_count", {"stage": "test_collect"}
+        )
+        == 5
+    )
+
+
+def test_run_pipeline_failure():
+    async def fail(item):
+        raise ValueError(item)
+
+    async def never(item):
+        raise AssertionError(item)
+
+    first_stage = PipelineStage("test_fail", fail, 2, maxsize=1)
+    last_stage = PipelineStage("test_never", never, 1, maxsize=1)
+
+    async def source():
+        for item in range(10):
+            await first_stage.put(item)
+
+    # The stages waiting on each other are cancelled, the run does not hang
+    with pytest.raises(ValueError):
+        asyncio.run(run_pipeline(source, [first_stage, last_stage]))
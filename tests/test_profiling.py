@@ -0,0 +1,34 @@
+from gitlab2sentry.utils.profiling import RunProfiler
+
+
+def _allocate():
+    return [str(index) * 10 for index in range(10000)]
+
+
+def test_profiler_disabled(tmp_path):
+    with RunProfiler("", 10, 0).profile():
+        _allocate()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_profiler_writes_profile_and_summary(tmp_path):
+    path = tmp_path / "profiles"
+    with RunProfiler(str(path), 10, 0).profile():
+        _allocate()
+
+    profiles = list(path.glob("g2s-*.prof"))
+    summaries = list(path.glob("g2s-*-summary.txt"))
+    assert len(profiles) == 1 and len(summaries) == 1
+    summary = summaries[0].read_text()
+    assert "peak" in summary and "Top 10 allocations" in summary
+    assert "_allocate" in summary
+
+
+def test_profiler_memory_watcher(tmp_path, mocker):
+    profiler = RunProfiler(str(tmp_path), 5, 1)
+    write = mocker.spy(profiler, "_write")
+    mocker.patch.object(profiler._stop, "wait", side_effect=[False, True])
+    with profiler.profile():
+        _allocate()
+    # Once by the watcher, once at the end of the run
+    assert write.call_count == 2
@@ -0,0 +1,26 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from gitlab2sentry.utils.project_reader import ProjectReader, read_worker_page
+
+
+def test_read_page(
+    payload_new_project,
+    payload_no_group_project,
+    payload_no_repository_project,
+    payload_sentry_project,
+    g2s_new_project,
+    g2s_sentry_project,
+):
+    page = [
+        payload_new_project,
+        payload_no_group_project,
+        payload_no_repository_project,
+        payload_sentry_project,
+    ]
+    g2s_projects = ProjectReader().read_page(page)
+    assert g2s_projects == [g2s_new_project, g2s_sentry_project]
+    assert g2s_projects[0].group is g2s_projects[1].group
+
+    # A worker process sends back the same projects
+    with ProcessPoolExecutor(1) as process_pool:
+        assert process_pool.submit(read_worker_page, page).result() == g2s_projects
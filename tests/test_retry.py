@@ -0,0 +1,137 @@
+import time
+
+import pytest
+from requests import PreparedRequest, Response
+
+from gitlab2sentry.exceptions import RetryLimitExceeded
+from gitlab2sentry.utils.retry import (
+    RetryPolicy,
+    RetrySession,
+    RunDeadline,
+    is_retryable,
+)
+
+
+def mocked_response(status_code, headers=None):
+    response = Response()
+    response._content = b"{}"
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    return response
+
+
+def mocked_request(method="GET"):
+    request = PreparedRequest()
+    request.prepare(method=method, url="http://gitlab.test/api/v4/projects/1")
+    return request
+
+
+def test_run_deadline():
+    assert RunDeadline(0).remaining() is None
+    assert not RunDeadline(0).expired()
+    assert 0 < RunDeadline(60).remaining() <= 60
+    deadline = RunDeadline(1)
+    deadline.started_at -= 2
+    assert deadline.expired()
+
+
+def test_get_wait_time():
+    policy = RetryPolicy(max_attempts=3, max_wait=60, deadline=RunDeadline(0))
+    assert policy.get_wait_time({"Retry-After": "7"}, 0) == 7
+    assert (
+        9
+        < policy.get_wait_time({"RateLimit-Reset": str(int(time.time()) + 10)}, 0)
+        <= 10
+    )
+    assert (
+        4
+        < policy.get_wait_time({"X-Sentry-Rate-Limit-Reset": str(time.time() + 5)}, 0)
+        <= 5
+    )
+    assert policy.get_wait_time({}, 3) == 8
+    assert policy.get_wait_time({"Retry-After": "3600"}, 0) == 60
+    assert policy.get_wait_time({"RateLimit-Reset": "1"}, 0) == 0
+
+
+def test_can_retry():
+    policy = RetryPolicy(max_attempts=2, max_wait=60, deadline=RunDeadline(0))
+    assert policy.can_retry(1, 30)
+    assert not policy.can_retry(2, 0)
+
+    policy = RetryPolicy(max_attempts=2, max_wait=60, deadline=RunDeadline(10))
+    assert policy.can_retry(0, 5)
+    assert not policy.can_retry(0, 30)
+
+
+def test_wait(mocker):
+    sleep = mocker.patch("time.sleep")
+    policy = RetryPolicy(max_attempts=1, max_wait=60, deadline=RunDeadline(0))
+    assert not policy.wait("test", 404, {}, 0)
+    assert policy.wait("test", 429, {"Retry-After": "2"}, 0)
+    sleep.assert_called_once_with(2.0)
+    assert not policy.wait("test", 429, {"Retry-After": "2"}, 1)
+
+
+def test_observe_and_throttle(mocker):
+    sleep = mocker.patch("time.sleep")
+    policy = RetryPolicy(max_attempts=1, max_wait=60, deadline=RunDeadline(0))
+    policy.observe({"RateLimit-Remaining": "10"})
+    policy.throttle()
+    assert not sleep.called
+
+    policy.observe(
+        {
+            "X-Sentry-Rate-Limit-Remaining": "0",
+            "X-Sentry-Rate-Limit-Reset": str(time.time() + 5),
+        }
+    )
+    policy.throttle()
+    assert 0 < sleep.call_args[0][0] <= 5
+
+
+def test_retry_session(mocker):
+    mocker.patch("time.sleep")
+    send = mocker.patch(
+        "requests.Session.send",
+        side_effect=[
+            mocked_response(429, {"Retry-After": "1"}),
+            mocked_response(200),
+        ],
+    )
+    session = RetrySession(
+        RetryPolicy(max_attempts=2, max_wait=60, deadline=RunDeadline(0))
+    )
+    assert session.send(mocked_request()).status_code == 200
+    assert send.call_count == 2
+
+    mocker.patch("requests.Session.send", return_value=mocked_response(503))
+    with pytest.raises(RetryLimitExceeded):
+        session.send(mocked_request())
+
+
+def test_retry_session_writes(mocker):
+    mocker.patch("time.sleep")
+    session = RetrySession(
+        RetryPolicy(max_attempts=2, max_wait=60, deadline=RunDeadline(0))
+    )
+    # The write may have been applied before the gateway error
+    send = mocker.patch("requests.Session.send", return_value=mocked_response(503))
+    assert session.send(mocked_request("POST")).status_code == 503
+    assert send.call_count == 1
+
+    # A throttled write was refused before being handled
+    send = mocker.patch(
+        "requests.Session.send",
+        side_effect=[mocked_response(429), mocked_response(201)],
+    )
+    assert session.send(mocked_request("PUT")).status_code == 201
+    assert send.call_count == 2
+
+
+def test_is_retryable():
+    assert is_retryable("GET", 503) and is_retryable("delete", 502)
+    assert not is_retryable("POST", 503) and not is_retryable("PUT", 504)
+    assert is_retryable("POST", 429)
+    # GraphQL queries change nothing
+    assert is_retryable(None, 503)
+    assert not is_retryable("GET", 404)
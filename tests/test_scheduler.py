@@ -0,0 +1,138 @@
+import asyncio
+from dataclasses import replace
+
+from gitlab2sentry.utils.budget import Backlog, WriteBudget
+from gitlab2sentry.utils.retry import RunDeadline
+from gitlab2sentry.utils.scheduler import (
+    G2S_ACTION_DSN,
+    G2S_ACTION_NONE,
+    G2S_ACTION_SENTRYCLIRC,
+    G2STask,
+    Scheduler,
+)
+from tests.conftest import OLD_TIME, TEST_GROUP_NAME
+
+
+def get_task(g2s_project, action=G2S_ACTION_SENTRYCLIRC):
+    return G2STask(action, g2s_project, TEST_GROUP_NAME)
+
+
+def test_get_ranked_tasks(
+    g2s_new_project, g2s_sentryclirc_mr_merged_project, g2s_sentry_project
+):
+    old_project = replace(g2s_new_project, pid=2, created_at=OLD_TIME)
+    scheduler = Scheduler(RunDeadline(0))
+    for task in [
+        get_task(g2s_sentry_project, G2S_ACTION_NONE),
+        get_task(old_project),
+        get_task(g2s_new_project),
+        get_task(g2s_sentryclirc_mr_merged_project, G2S_ACTION_DSN),
+    ]:
+        scheduler.add(task)
+    assert [task.g2s_project for task in scheduler.get_ranked_tasks()] == [
+        g2s_sentryclirc_mr_merged_project,
+        g2s_new_project,
+        old_project,
+        g2s_sentry_project,
+    ]
+
+
+def test_record():
+    scheduler = Scheduler(RunDeadline(0), action_estimate=10)
+    scheduler.record(G2S_ACTION_DSN, 20)
+    assert scheduler.estimate(G2S_ACTION_DSN) == 13
+    assert scheduler.estimate(G2S_ACTION_SENTRYCLIRC) == 10
+
+
+def test_run_defers_actions_past_deadline(
+    g2s_new_project, g2s_sentryclirc_mr_merged_project, g2s_sentry_project
+):
+    scheduler = Scheduler(RunDeadline(30), action_estimate=20)
+    for task in [
+        get_task(g2s_new_project),
+        get_task(g2s_sentryclirc_mr_merged_project, G2S_ACTION_DSN),
+        get_task(g2s_sentry_project, G2S_ACTION_NONE),
+    ]:
+        scheduler.add(task)
+
+    handled = list()
+
+    def handler(task):
+        # Each action eats most of the remaining time
+        scheduler.deadline.started_at -= 15
+        handled.append(task.g2s_project)
+
+    scheduler.run(handler)
+    assert handled == [g2s_sentryclirc_mr_merged_project, g2s_sentry_project]
+    assert scheduler.deferred == 1
+
+
+def test_run_defers_actions_over_budget(g2s_new_project, tmp_path):
+    other_project = replace(g2s_new_project, pid=2)
+    backlog = Backlog(str(tmp_path / "backlog.json"))
+    scheduler = Scheduler(RunDeadline(0), budget=WriteBudget(1, 0, 0), backlog=backlog)
+    scheduler.add(get_task(g2s_new_project))
+    scheduler.add(get_task(other_project))
+
+    handled = list()
+    scheduler.run(lambda task: handled.append(task.g2s_project))
+    assert handled == [g2s_new_project]
+    assert scheduler.budget_deferred == 1
+    assert 2 in backlog
+
+    # The backlog goes first on the next run
+    scheduler = Scheduler(RunDeadline(0), budget=WriteBudget(1, 0, 0), backlog=backlog)
+    scheduler.add(get_task(g2s_new_project))
+    scheduler.add(get_task(other_project))
+    handled = list()
+    scheduler.run(lambda task: handled.append(task.g2s_project))
+    assert handled == [other_project]
+    assert 1 in backlog and 2 not in backlog
+
+
+def test_run_async(g2s_new_project, g2s_sentry_project):
+    other_project = replace(g2s_new_project, pid=2)
+    scheduler = Scheduler(RunDeadline(0), budget=WriteBudget(2, 0, 0))
+    for task in [
+        get_task(g2s_new_project),
+        get_task(other_project),
+        get_task(g2s_sentry_project, G2S_ACTION_NONE),
+        get_task(replace(g2s_new_project, pid=3)),
+    ]:
+        scheduler.add(task)
+
+    running, handled = list(), list()
+
+    async def handler(task):
+        running.append(task)
+        await asyncio.sleep(0.01)
+        assert len(running) <= 2
+        running.remove(task)
+        handled.append(task.g2s_project.pid)
+
+    asyncio.run(scheduler.run_async(handler, 2))
+    # Two MRs within the budget, the skipped project costs none of it
+    assert sorted(handled) == sorted([1, 2, g2s_sentry_project.pid])
+    assert scheduler.budget_deferred == 1
+    assert 3 in scheduler.backlog
+
+
+def test_async_admit(g2s_new_project, g2s_sentry_project):
+    # A second MR this minute would wait past the deadline of the budget
+    scheduler = Scheduler(RunDeadline(0), budget=WriteBudget(0, 0, 1, RunDeadline(10)))
+    tasks = [
+        G2STask(G2S_ACTION_SENTRYCLIRC, replace(g2s_new_project, pid=pid), "group")
+        for pid in (1, 2)
+    ]
+
+    async def admit_all():
+        return await asyncio.gather(
+            *(scheduler.async_admit(task) for task in tasks),
+            scheduler.async_admit(G2STask(G2S_ACTION_NONE, g2s_sentry_project, "")),
+        )
+
+    assert asyncio.run(admit_all()) == [True, False, True]
+    assert scheduler.budget.spent == 1
+    assert scheduler.deferred_pids == [2]
+    scheduler.finish()
+    assert 2 in scheduler.backlog and not scheduler.deferred_pids
@@ -1,3 +1,4 @@
+import asyncio
 import json
 
 import pytest
@@ -8,6 +9,7 @@ from gitlab2sentry.exceptions import (
     SentryProjectKeyIDNotFound,
 )
 from gitlab2sentry.resources import settings
+from gitlab2sentry.utils.sentry_provider import AsyncSentryProvider
 from tests.conftest import TEST_GROUP_NAME, TEST_PROJECT_NAME
 
 STATUS_CODE, DETAIL = 400, b'{"msg": "error_details"}'
@@ -28,45 +30,45 @@ def test_get_json(sentry_provider_fixture):
 
 
 def test_simple_request(sentry_provider_fixture, mocker):
-    mocker.patch("requests.post", return_value=mocked_response(200))
+    mocker.patch("requests.Session.post", return_value=mocked_response(200))
     assert sentry_provider_fixture._client.simple_request("post", "", None)
-    mocker.patch("requests.put", return_value=mocked_response(200))
+    mocker.patch("requests.Session.put", return_value=mocked_response(200))
     assert sentry_provider_fixture._client.simple_request("put", "", None)
 
-    mocker.patch("requests.get", return_value=mocked_response(200))
+    mocker.patch("requests.Session.get", return_value=mocked_response(200))
     assert sentry_provider_fixture._client.simple_request("get", "", None)
 
 
 def test_get_or_create_team(sentry_provider_fixture, mocker):
-    mocker.patch("requests.post", return_value=mocked_response(404))
-    mocker.patch("requests.get", return_value=mocked_response(201))
+    mocker.patch("requests.Session.post", return_value=mocked_response(404))
+    mocker.patch("requests.Session.get", return_value=mocked_response(201))
     assert sentry_provider_fixture._get_or_create_team(TEST_GROUP_NAME) == json.loads(
         DETAIL.decode()
     )
 
-    mocker.patch("requests.post", return_value=mocked_response(200))
+    mocker.patch("requests.Session.post", return_value=mocked_response(200))
     assert sentry_provider_fixture._get_or_create_team(TEST_GROUP_NAME) == json.loads(
         DETAIL.decode()
     )
 
-    mocker.patch("requests.post", return_value=mocked_response(404))
-    mocker.patch("requests.get", return_value=mocked_response(200))
+    mocker.patch("requests.Session.post", return_value=mocked_response(404))
+    mocker.patch("requests.Session.get", return_value=mocked_response(200))
     assert sentry_provider_fixture._get_or_create_team(TEST_GROUP_NAME) is None
 
 
 def test_get_or_create_project(sentry_provider_fixture, mocker):
-    mocker.patch("requests.post", return_value=mocked_response(404))
-    mocker.patch("requests.get", return_value=mocked_response(201))
+    mocker.patch("requests.Session.post", return_value=mocked_response(404))
+    mocker.patch("requests.Session.get", return_value=mocked_response(201))
     assert sentry_provider_fixture.get_or_create_project(
         TEST_GROUP_NAME, TEST_PROJECT_NAME, TEST_PROJECT_NAME
     ) == json.loads(DETAIL.decode())
 
-    mocker.patch("requests.get", return_value=mocked_response(200))
+    mocker.patch("requests.Session.get", return_value=mocked_response(200))
     assert sentry_provider_fixture.get_or_create_project(
         TEST_GROUP_NAME, TEST_PROJECT_NAME, TEST_PROJECT_NAME
     ) == json.loads(DETAIL.decode())
 
-    mocker.patch("requests.get", return_value=mocked_response(400))
+    mocker.patch("requests.Session.get", return_value=mocked_response(400))
     with pytest.raises(SentryProjectCreationFailed):
         assert sentry_provider_fixture.get_or_create_project(
             TEST_GROUP_NAME, TEST_PROJECT_NAME, TEST_PROJECT_NAME
@@ -80,7 +82,7 @@ def test_get_dsn_and_key_id(sentry_provider_fixture, mocker):
     response._content = detail
     response.status_code = 400
 
-    mocker.patch("requests.get", return_value=response)
+    mocker.patch("requests.Session.get", return_value=response)
     assert sentry_provider_fixture._get_dsn_and_key_id(TEST_PROJECT_NAME) == (
         None,
         None,
@@ -92,7 +94,7 @@ def test_get_dsn_and_key_id(sentry_provider_fixture, mocker):
     response._content = detail
     response.status_code = 200
 
-    mocker.patch("requests.get", return_value=response)
+    mocker.patch("requests.Session.get", return_value=response)
     with pytest.raises(SentryProjectKeyIDNotFound):
         assert sentry_provider_fixture._get_dsn_and_key_id(TEST_PROJECT_NAME)
 
@@ -102,7 +104,7 @@ def test_get_dsn_and_key_id(sentry_provider_fixture, mocker):
     response._content = detail
     response.status_code = 200
 
-    mocker.patch("requests.get", return_value=response)
+    mocker.patch("requests.Session.get", return_value=response)
     assert sentry_provider_fixture._get_dsn_and_key_id(TEST_PROJECT_NAME) == (
         decoded_detail[0]["dsn"]["public"],
         decoded_detail[0]["id"],
@@ -125,6 +127,7 @@ def test_set_rate_limit_for_key(sentry_provider_fixture, mocker):
         == settings.sentry_dsn
     )
 
+    sentry_provider_fixture.dsn_cache.keys.clear()
     mocker.patch.object(
         sentry_provider_fixture._client,
         attribute="simple_request",
@@ -140,6 +143,29 @@ def test_set_rate_limit_for_key(sentry_provider_fixture, mocker):
     assert sentry_provider_fixture.set_rate_limit_for_key(TEST_PROJECT_NAME) is None
 
 
+def test_set_rate_limit_for_key_cached(sentry_provider_fixture, mocker):
+    get_key = mocker.patch.object(
+        sentry_provider_fixture,
+        attribute="_get_dsn_and_key_id",
+        return_value=(settings.sentry_dsn, "result"),
+    )
+    mocker.patch.object(
+        sentry_provider_fixture._client,
+        attribute="simple_request",
+        return_value=(200, "result"),
+    )
+    assert sentry_provider_fixture.get_cached_dsn(TEST_PROJECT_NAME) is None
+    for _ in range(2):
+        assert (
+            sentry_provider_fixture.set_rate_limit_for_key(TEST_PROJECT_NAME)
+            == settings.sentry_dsn
+        )
+    assert get_key.call_count == 1
+    assert (
+        sentry_provider_fixture.get_cached_dsn(TEST_PROJECT_NAME) == settings.sentry_dsn
+    )
+
+
 def test_ensure_sentry_team(sentry_provider_fixture, mocker):
     mocker.patch.object(
         sentry_provider_fixture, attribute="_get_or_create_team", return_value=True
@@ -150,3 +176,64 @@ def test_ensure_sentry_team(sentry_provider_fixture, mocker):
         sentry_provider_fixture, attribute="_get_or_create_team", return_value=False
     )
     assert not sentry_provider_fixture.ensure_sentry_team(TEST_GROUP_NAME)
+
+
+def test_simple_request_retries_throttled(sentry_provider_fixture, mocker):
+    sleep = mocker.patch("time.sleep")
+    throttled = mocked_response(429)
+    throttled.headers["Retry-After"] = "3"
+    mocker.patch("requests.Session.get", side_effect=[throttled, mocked_response(200)])
+    assert sentry_provider_fixture._client.simple_request("get", "") == (
+        200,
+        json.loads(DETAIL.decode()),
+    )
+    sleep.assert_called_once_with(3.0)
+
+
+def test_async_set_rate_limit_for_key(mocker):
+    sentry_provider = AsyncSentryProvider()
+    simple_request = mocker.patch.object(
+        sentry_provider._client,
+        attribute="simple_request",
+        side_effect=[
+            (200, [{"id": "key", "dsn": {"public": settings.sentry_dsn}}]),
+            (200, "result"),
+        ],
+    )
+    assert (
+        asyncio.run(sentry_provider.set_rate_limit_for_key(TEST_PROJECT_NAME))
+        == settings.sentry_dsn
+    )
+    assert simple_request.call_args[0][0] == "put"
+    # Answered by the DSN cache
+    assert (
+        asyncio.run(sentry_provider.set_rate_limit_for_key(TEST_PROJECT_NAME))
+        == settings.sentry_dsn
+    )
+    assert simple_request.call_count == 2
+
+
+def test_async_get_or_create_project(mocker):
+    sentry_provider = AsyncSentryProvider()
+    mocker.patch.object(
+        sentry_provider._client,
+        attribute="simple_request",
+        side_effect=[(404, None), (201, {"slug": TEST_PROJECT_NAME})],
+    )
+    assert asyncio.run(
+        sentry_provider.get_or_create_project(
+            TEST_GROUP_NAME, TEST_PROJECT_NAME, TEST_PROJECT_NAME
+        )
+    ) == {"slug": TEST_PROJECT_NAME}
+
+    mocker.patch.object(
+        sentry_provider._client,
+        attribute="simple_request",
+        return_value=(STATUS_CODE, None),
+    )
+    with pytest.raises(SentryProjectCreationFailed):
+        asyncio.run(
+            sentry_provider.get_or_create_project(
+                TEST_GROUP_NAME, TEST_PROJECT_NAME, TEST_PROJECT_NAME
+            )
+        )
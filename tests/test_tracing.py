@@ -0,0 +1,78 @@
+import json
+import sys
+
+import pytest
+
+from gitlab2sentry.utils.tracing import NON_RECORDING_SPAN, SPAN_KIND_CLIENT, Tracer
+
+OTLP_EXPORTER = "opentelemetry.exporter.otlp.proto.http.trace_exporter"
+
+
+def test_tracer_disabled():
+    tracer = Tracer("", "")
+    with tracer.start_span("update") as span:
+        span.set_attribute("key", "value")
+        span.set_error("ignored")
+    assert span is NON_RECORDING_SPAN
+    tracer.flush()
+
+
+def test_tracer_without_sdk(tmp_path, mocker):
+    mocker.patch.dict(sys.modules, {OTLP_EXPORTER: None})
+    tracer = Tracer(str(tmp_path / "traces.jsonl"), "")
+    # The optional extra is missing: nothing is recorded
+    with tracer.start_span("update") as span:
+        pass
+    assert span is NON_RECORDING_SPAN
+    assert not tracer.enabled
+    tracer.flush()
+
+
+def test_tracer_nested_spans(tmp_path):
+    path = tmp_path / "traces.jsonl"
+    tracer = Tracer(str(path), "")
+    with tracer.start_span("update", attributes={"g2s.full_path": None}):
+        with tracer.start_span("handle_project", attributes={"g2s.project": "g/p"}):
+            with tracer.start_span("gitlab GET /api/v4/user", SPAN_KIND_CLIENT) as span:
+                span.set_attribute("http.status_code", 200)
+                span.set_attribute("g2s.retries", 1)
+        with pytest.raises(ValueError):
+            with tracer.start_span("scan"):
+                raise ValueError("boom")
+    tracer.flush()
+
+    spans = {
+        span["name"]: span for span in map(json.loads, path.read_text().splitlines())
+    }
+    update, handle = spans["update"], spans["handle_project"]
+    call, scan = spans["gitlab GET /api/v4/user"], spans["scan"]
+    assert update["resource"]["attributes"]["service.name"] == "gitlab2sentry"
+    assert update["parent_id"] is None
+    assert handle["parent_id"] == update["context"]["span_id"]
+    assert call["parent_id"] == handle["context"]["span_id"]
+    assert len({span["context"]["trace_id"] for span in spans.values()}) == 1
+    assert call["kind"] == "SpanKind.CLIENT"
+    assert call["attributes"] == {"http.status_code": 200, "g2s.retries": 1}
+    assert handle["attributes"] == {"g2s.project": "g/p"}
+    assert update["attributes"] == {}
+    assert scan["status"]["status_code"] == "ERROR"
+    assert scan["status"]["description"] == "ValueError: boom"
+
+
+def test_tracer_otlp_endpoint(mocker):
+    from opentelemetry.sdk.trace.export import SpanExportResult
+
+    exporter = mocker.patch("{}.OTLPSpanExporter".format(OTLP_EXPORTER))
+    exporter.return_value.export.return_value = SpanExportResult.SUCCESS
+    tracer = Tracer("", "http://collector:4318/")
+    with tracer.start_span("first"):
+        pass
+    with tracer.start_span("second"):
+        pass
+    tracer.flush()
+    assert exporter.call_args.kwargs["endpoint"] == "http://collector:4318/v1/traces"
+    assert [
+        span.name
+        for call in exporter.return_value.export.call_args_list
+        for span in call.args[0]
+    ] == ["first", "second"]
@@ -0,0 +1,69 @@
+from requests import PreparedRequest, Response
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPSConnectionPool
+
+from gitlab2sentry.utils.gitlab_provider import GraphQLClient
+from gitlab2sentry.utils.http_cache import CACHE_HEADER, CACHE_HIT, HTTPCache
+from gitlab2sentry.utils.retry import RetrySession
+from gitlab2sentry.utils.sentry_provider import SentryAPIClient
+from gitlab2sentry.utils.transport import HTTPTransport, http_transport
+
+
+def test_clients_share_transport():
+    sessions = [
+        GraphQLClient()._session,
+        SentryAPIClient()._session,
+        RetrySession(),
+    ]
+    for session in sessions:
+        assert session.get_adapter("https://gitlab.test") is http_transport.adapter
+        assert session.get_adapter("http://sentry.test") is http_transport.adapter
+        assert "gzip" in session.headers["Accept-Encoding"]
+    assert sessions[0].headers["PRIVATE-TOKEN"]
+    assert sessions[1].headers["Authorization"].startswith("Bearer ")
+
+
+def test_transport_pools():
+    transport = HTTPTransport(pool_size=3, timeout=5)
+    pool = transport.adapter.poolmanager.connection_from_url("https://gitlab.test")
+    assert isinstance(pool, HTTPSConnectionPool)
+    assert pool.pool.maxsize == 3
+    assert pool.block
+
+
+def test_transport_timeout(mocker):
+    send = mocker.patch.object(HTTPAdapter, "send")
+    transport = HTTPTransport(timeout=5)
+    transport.adapter.send(None)
+    assert send.call_args[1]["timeout"] == 5
+    transport.adapter.send(None, timeout=1)
+    assert send.call_args[1]["timeout"] == 1
+
+
+def test_transport_hooks(mocker):
+    transport = HTTPTransport()
+    hook = mocker.Mock()
+    transport.add_hook(mocker.Mock(side_effect=ValueError("broken")))
+    transport.add_hook(hook)
+    session = transport.get_session({"X-Test": "1"})
+    response = Response()
+    for session_hook in session.hooks["response"]:
+        session_hook(response)
+    # A failing hook does not keep the others from running
+    hook.assert_called_once_with(response)
+    assert session.headers["X-Test"] == "1"
+
+
+def test_transport_cache(tmp_path, mocker):
+    response = Response()
+    response._content = b"{}"
+    response.status_code = 200
+    response.headers["ETag"] = '"v1"'
+    send = mocker.patch.object(HTTPAdapter, "send", return_value=response)
+    transport = HTTPTransport()
+    transport.set_cache(HTTPCache(str(tmp_path / "cache.json"), ttl=60))
+    request = PreparedRequest()
+    request.prepare(method="GET", url="http://gitlab.test/api/v4/projects/1")
+    transport.adapter.send(request)
+    assert transport.adapter.send(request).headers[CACHE_HEADER] == CACHE_HIT
+    assert send.call_count == 1